@@ -0,0 +1,82 @@
+"""
+Benchmark / teste de ponta a ponta do fluxo Consultoria IA -> Dashboard -> PDF, sem a OpenAI real.
+
+Roda o streamlit_app.py em modo headless (streamlit.testing) e mede cada etapa.
+Com PEI_LLM_MODO=reproduzir a latência do modelo é zero: o tempo medido é só o custo do próprio app.
+
+Exemplos:
+    # 1) Gravar respostas contra o servidor local (ou contra a OpenAI real, com chave verdadeira)
+    python servidor_llm_local.py --latencia 0.8 &
+    OPENAI_BASE_URL=http://127.0.0.1:8765/v1 PEI_LLM_MODO=gravar python benchmark_fluxo.py
+
+    # 2) Reproduzir de forma determinística (CI)
+    PEI_LLM_MODO=reproduzir python benchmark_fluxo.py --rodadas 5
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+PASTA_APP = os.path.dirname(os.path.abspath(__file__))
+
+def localizar(widgets, rotulo):
+    for w in widgets:
+        if w.label.startswith(rotulo): return w
+    raise LookupError(f"Elemento não encontrado: {rotulo}")
+
+def cronometrar(tempos, etapa, func):
+    inicio = time.perf_counter(); func()
+    tempos.setdefault(etapa, []).append(time.perf_counter() - inicio)
+
+def verificar(at, etapa):
+    if at.exception: raise RuntimeError(f"{etapa}: {at.exception[0].message}")
+    if at.error: raise RuntimeError(f"{etapa}: {at.error[0].value}")
+
+def aguardar_tarefas(at, limite=300):
+    # As gerações rodam em segundo plano: reroda até o painel aplicar o resultado (como o fragment faria)
+    inicio = time.time()
+    while at.session_state.tarefas_ia:
+        if time.time() - inicio > limite: raise RuntimeError("Tempo esgotado aguardando a IA.")
+        time.sleep(0.05); at.run()
+
+def rodada(tempos, serie):
+    from streamlit.testing.v1 import AppTest
+    at = AppTest.from_file(os.path.join(PASTA_APP, "streamlit_app.py"), default_timeout=300)
+    at.secrets["OPENAI_API_KEY"] = os.environ.get("OPENAI_API_KEY", "sk-local")
+
+    cronometrar(tempos, "1. Abertura do app", at.run); verificar(at, "Abertura")
+    localizar(at.text_input, "Nome Completo").set_value("Ana Clara Souza")
+    localizar(at.selectbox, "Série/Ano").set_value(serie)
+    cronometrar(tempos, "2. Preenchimento (rerun)", at.run); verificar(at, "Preenchimento")
+
+    cronometrar(tempos, "3. Consultoria IA (PEI técnico)", lambda: (localizar(at.button, "✨ Criar Estratégia Técnica").click().run(), aguardar_tarefas(at)))
+    verificar(at, "Consultoria IA")
+    if not at.session_state.dados['ia_sugestao']: raise RuntimeError("O PEI não foi gerado.")
+
+    # Rerun sem IA: dashboard, extração de metas/Bloom e gerar_pdf_final rodam a cada interação
+    cronometrar(tempos, "4. Dashboard + PDF (rerun)", at.run); verificar(at, "Dashboard")
+    if not [b for b in at.get("download_button") if "PDF Oficial" in b.proto.label]: raise RuntimeError("Botão do PDF oficial ausente.")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Mede o fluxo PEI -> Dashboard -> PDF sem depender da OpenAI real.")
+    parser.add_argument("--rodadas", type=int, default=3)
+    parser.add_argument("--serie", default="3º Ano (Fund. I)")
+    parser.add_argument("--manter-pasta", action="store_true", help="Roda na pasta atual (reaproveita cache_ia/ e banco_alunos/).")
+    args = parser.parse_args()
+
+    # Caminhos relativos do app (cache_ia/, banco_alunos/) vão para pastas temporárias, salvo pedido contrário
+    os.environ["PEI_LLM_FIXTURES"] = os.path.abspath(os.environ.get("PEI_LLM_FIXTURES", os.path.join(PASTA_APP, "fixtures_llm")))
+
+    tempos = {}
+    try:
+        for _ in range(args.rodadas):
+            if not args.manter_pasta: os.chdir(tempfile.mkdtemp(prefix="pei_bench_")) # Cache frio a cada rodada
+            rodada(tempos, args.serie)
+    except Exception as e:
+        print(f"FALHOU: {e}"); sys.exit(1)
+
+    print(f"Modo LLM: {os.environ.get('PEI_LLM_MODO', 'real')} | rodadas: {args.rodadas}")
+    for etapa, valores in tempos.items():
+        print(f"{etapa:<36} mediana {statistics.median(valores) * 1000:8.1f} ms   máx {max(valores) * 1000:8.1f} ms")
@@ -0,0 +1,74 @@
+"""
+Empacotador de contexto dos prompts do PEI 360º (orçamento de tokens por seção).
+
+O streamlit_app.py monta as seções (barreiras, evidências, laudo, histórico...) e este módulo
+escolhe o que cabe: primeiro as unidades de maior peso (prioridade da seção, em dobro para termos
+clínicos), na ordem do texto em caso de empate. Os tokens só descontam do orçamento, não entram
+no ranking: uma frase longa de conclusão não perde para dezenas de linhas curtas de carimbo.
+"""
+from functools import lru_cache
+import re
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+PADRAO_TERMOS_CLINICOS = re.compile(r'diagn[óo]stic|hip[óo]tese|\bcid\b|\b[fgq]\d{2}|conclus|medica|\bmg\b|laudo|transtorno|defici[êe]ncia|recomend|encaminh', re.IGNORECASE)
+BONUS_CLINICO = 2.0
+
+# ==============================================================================
+# 1. CONTAGEM DE TOKENS
+# ==============================================================================
+@lru_cache(maxsize=1)
+def _codificador_tokens():
+    if tiktoken is None: return None
+    try: return tiktoken.get_encoding("o200k_base") # Encoding da família gpt-4o
+    except: return None
+
+def contar_tokens(texto):
+    if not texto: return 0
+    enc = _codificador_tokens()
+    if enc: return len(enc.encode(texto))
+    return len(texto) // 4 + 1 # Estimativa quando o tiktoken não está disponível
+
+# ==============================================================================
+# 2. EMPACOTAMENTO
+# ==============================================================================
+def _unidades_texto(texto, max_tokens_unidade=80):
+    # Linhas viram unidades; parágrafos longos são quebrados em frases
+    for linha in (texto or "").splitlines():
+        linha = linha.strip()
+        if not linha: continue
+        if contar_tokens(linha) <= max_tokens_unidade: yield linha
+        else:
+            for frase in re.split(r'(?<=[.;!?])\s+', linha):
+                if frase.strip(): yield frase.strip()
+
+def empacotar_contexto(secoes, orcamento_total):
+    """
+    Recebe [(chave, texto, prioridade, orcamento_secao)] e devolve {chave: texto_empacotado}.
+    Remove linhas repetidas entre seções e escolhe as unidades de maior peso
+    (prioridade da seção x bônus para termos clínicos; empate: ordem das seções e do texto)
+    enquanto couberem nos orçamentos.
+    """
+    vistos, candidatos = set(), []
+    for ordem_secao, (chave, texto, prioridade, _) in enumerate(secoes):
+        for pos, unidade in enumerate(_unidades_texto(texto)):
+            norm = re.sub(r'\W+', ' ', unidade.lower()).strip()
+            if not norm or norm in vistos: continue
+            vistos.add(norm)
+            peso = prioridade * (BONUS_CLINICO if PADRAO_TERMOS_CLINICOS.search(unidade) else 1.0)
+            candidatos.append((peso, ordem_secao, pos, chave, unidade, contar_tokens(unidade)))
+
+    restante_secao = {chave: orc for chave, _, _, orc in secoes}
+    restante_total = orcamento_total
+    escolhidos = []
+    for peso, ordem_secao, pos, chave, unidade, tokens in sorted(candidatos, key=lambda c: (-c[0], c[1], c[2])):
+        if tokens > restante_secao[chave] or tokens > restante_total: continue
+        restante_secao[chave] -= tokens; restante_total -= tokens
+        escolhidos.append((ordem_secao, pos, chave, unidade))
+
+    saida = {chave: [] for chave, _, _, _ in secoes}
+    for _, _, chave, unidade in sorted(escolhidos): saida[chave].append(unidade) # Volta à ordem original
+    return {chave: "\n".join(linhas) for chave, linhas in saida.items()}
@@ -0,0 +1,160 @@
+"""
+Pré-extração local (sem IA) do diagnóstico e da medicação dos laudos do PEI 360º.
+
+Muitos laudos trazem "CID F84.0" ou "Ritalina 10mg 1x/dia" em texto corrido: um regex de CID-10
+e um dicionário offline de remédios resolvem esses casos na hora, com uma confiança por item.
+O streamlit_app.py só chama a IA (digest do laudo) quando a confiança geral fica abaixo de CONFIANCA_MINIMA.
+"""
+import re
+import unicodedata
+
+CONFIANCA_MINIMA = 0.8
+
+# ==============================================================================
+# 1. NORMALIZAÇÃO
+# ==============================================================================
+def _normalizar(texto):
+    # Minúsculas e sem acento, caractere a caractere: as posições continuam valendo no texto original
+    return "".join(unicodedata.normalize("NFD", c)[0] for c in texto).lower()
+
+# Negações e posologias valem só na própria frase: "Descartado F90.0. CID F81.0" não descarta o F81.0
+FIM_FRASE = re.compile(r'[;\n]|\.\s')
+
+def _frase_antes(texto, pos, largura):
+    return FIM_FRASE.split(texto[max(0, pos - largura):pos])[-1]
+
+def _frase_depois(texto, pos, largura):
+    return FIM_FRASE.split(texto[pos:pos + largura])[0]
+
+# A negação vale só na oração do código: "Foi descartado F84.0, porém CID F90.0 confirmado" mantém o F90.0.
+# Antes de cortar, tira o que vem colado no código: o prefixo "(CID" / ", CID-10:" e uma lista de códigos
+# ("Descartados F84.0, F90.0"), para a negação do início da oração valer para todos eles.
+FIM_ORACAO = re.compile(r'[,;\n]|\.\s|\b(?:porem|mas|entretanto|contudo|no entanto|todavia)\b')
+PADRAO_LISTA_ANTES = re.compile(r'(?:[fgqhr]\s?\d{2}(?:\.\d{1,2})?\)?\s*(?:,|;|\be\b|/)\s*)+$')
+PADRAO_CID_ANTES = re.compile(r'(?:[,(]\s*)?\(?cid(?:-?\s?1[01])?\s*[:\-]?\s*\(?$')
+
+def _oracao_antes(texto, pos, largura=60):
+    antes = PADRAO_CID_ANTES.sub("", PADRAO_LISTA_ANTES.sub("", texto[max(0, pos - largura):pos]))
+    return FIM_ORACAO.split(antes)[-1]
+
+# Frases que a leitura local não resolve: o CID ou remédio é de um familiar ("pai com TDAH", "mãe em uso de
+# sertralina") ou o diagnóstico ainda não está fechado. Nesses casos a confiança cai e a IA lê o laudo.
+PADRAO_FAMILIAR = re.compile(r'\b(pai|mae|pais|genitora?|irma|irmao|irmaos|avo|avos|tio|tia|primo|prima|parentes?|familiar(es)?|familia)\b')
+PADRAO_HIPOTESE = re.compile(r'hipotes|suspeit|investiga|a esclarecer|a confirmar|a definir|em avaliacao|provavel|possivel|\?')
+CONFIANCA_AMBIGUA = 0.5
+
+def _frase_ambigua(texto, inicio, fim, largura=120):
+    frase = _frase_antes(texto, inicio, largura) + texto[inicio:fim] + _frase_depois(texto, fim, largura)
+    return bool(PADRAO_FAMILIAR.search(frase) or PADRAO_HIPOTESE.search(frase))
+
+# ==============================================================================
+# 2. CID-10
+# ==============================================================================
+# Capítulos que aparecem em laudos escolares. Código completo tem prioridade sobre a categoria.
+DESCRICOES_CID = {
+    **{f"F7{i}": "Deficiência Intelectual" for i in range(10)},
+    "F80": "Transtorno Específico da Fala e da Linguagem", "F81": "Transtorno Específico das Habilidades Escolares",
+    "F81.0": "Dislexia", "F81.1": "Disortografia", "F81.2": "Discalculia", "F81.3": "Transtorno Misto das Habilidades Escolares",
+    "F82": "Transtorno do Desenvolvimento da Coordenação", "F83": "Transtornos Específicos Misto do Desenvolvimento",
+    "F84": "Transtorno do Espectro Autista (TEA)", "F84.0": "Transtorno do Espectro Autista (TEA)", "F84.5": "Síndrome de Asperger (TEA)",
+    "F88": "Outros Transtornos do Desenvolvimento Psicológico", "F89": "Transtorno do Desenvolvimento Psicológico Não Especificado",
+    "F90": "TDAH", "F90.0": "TDAH", "F91": "Transtorno de Conduta", "F91.3": "Transtorno Opositor Desafiador (TOD)",
+    "F93": "Transtorno Emocional da Infância", "F94": "Transtorno do Funcionamento Social", "F95": "Transtorno de Tiques", "F95.2": "Síndrome de Tourette",
+    "F98": "Outros Transtornos Comportamentais da Infância", "F41": "Transtorno de Ansiedade", "F32": "Episódio Depressivo",
+    "G40": "Epilepsia", "G80": "Paralisia Cerebral", "Q90": "Síndrome de Down", "Q99.2": "Síndrome do X Frágil",
+    "H54": "Deficiência Visual", "H90": "Perda Auditiva", "H91": "Perda Auditiva", "R62": "Atraso do Desenvolvimento",
+}
+PADRAO_CID = re.compile(r'\b([fgqhr])\s?(\d{2})(?:\.(\d{1,2}))?\b')
+PADRAO_PREFIXO_CID = re.compile(r'cid(-?\s?1[01])?\s*[:\-]?\s*(\(?[a-z]\s?\d{2}(\.\d{1,2})?\)?[\s,;e/]*)*$')
+PADRAO_NEGACAO_CID = re.compile(r'descart|afastad|exclu[ií]|nao (ha|apresenta|preenche)|sem (sinais|criterios)')
+# Sem "CID" antes, um código solto pode ser sala, bloco ou protocolo ("Sala R 62, Bloco H54"):
+# com espaço no meio ele é ignorado, e sem pista de diagnóstico na frase fica abaixo de CONFIANCA_MINIMA
+PADRAO_PISTA_DIAGNOSTICA = re.compile(r'diagnost|conclus|compativel|quadro|transtorno|sindrome|deficiencia')
+CONFIANCA_SO_DICIONARIO = 0.6
+
+def extrair_cids(texto):
+    """
+    [(código, descrição, confiança)]: 0.95 com "CID" logo antes (lista "CID F84.0 e F90.0" inclusive),
+    0.85 pelo dicionário com pista de diagnóstico na frase ("Diagnóstico: TEA (F84.0)"), CONFIANCA_SO_DICIONARIO sem ela,
+    e CONFIANCA_AMBIGUA quando a frase fala de familiar ou de hipótese/investigação.
+    """
+    normal, achados = _normalizar(texto), {}
+    for m in PADRAO_CID.finditer(normal):
+        categoria = f"{m.group(1).upper()}{m.group(2)}"
+        codigo = f"{categoria}.{m.group(3)}" if m.group(3) else categoria
+        antes = normal[max(0, m.start() - 40):m.start()]
+        if PADRAO_NEGACAO_CID.search(_oracao_antes(normal, m.start())): continue
+        descricao = DESCRICOES_CID.get(codigo) or DESCRICOES_CID.get(categoria)
+        if PADRAO_PREFIXO_CID.search(antes): confianca = 0.95
+        elif not descricao or " " in m.group(0): continue
+        else: confianca = 0.85 if PADRAO_PISTA_DIAGNOSTICA.search(_frase_antes(normal, m.start(), 80)) else CONFIANCA_SO_DICIONARIO
+        if confianca and _frase_ambigua(normal, m.start(), m.end()): confianca = CONFIANCA_AMBIGUA
+        if confianca and confianca > achados.get(codigo, ("", 0))[1]: achados[codigo] = (descricao or "", confianca)
+    return [(codigo, descricao, confianca) for codigo, (descricao, confianca) in achados.items()]
+
+# ==============================================================================
+# 3. MEDICAÇÃO E POSOLOGIA
+# ==============================================================================
+# nome no laudo (sem acento) -> nome exibido. Nomes comerciais levam o princípio ativo junto.
+REMEDIOS = {
+    "metilfenidato": "Metilfenidato", "ritalina la": "Ritalina LA (metilfenidato)", "ritalina": "Ritalina (metilfenidato)", "concerta": "Concerta (metilfenidato)",
+    "lisdexanfetamina": "Lisdexanfetamina", "venvanse": "Venvanse (lisdexanfetamina)", "atomoxetina": "Atomoxetina",
+    "clonidina": "Clonidina", "atensina": "Atensina (clonidina)", "guanfacina": "Guanfacina",
+    "risperidona": "Risperidona", "risperdal": "Risperdal (risperidona)", "aripiprazol": "Aripiprazol", "abilify": "Abilify (aripiprazol)",
+    "periciazina": "Periciazina", "neuleptil": "Neuleptil (periciazina)", "quetiapina": "Quetiapina", "seroquel": "Seroquel (quetiapina)",
+    "olanzapina": "Olanzapina", "haloperidol": "Haloperidol", "haldol": "Haldol (haloperidol)",
+    "sertralina": "Sertralina", "zoloft": "Zoloft (sertralina)", "fluoxetina": "Fluoxetina", "prozac": "Prozac (fluoxetina)",
+    "escitalopram": "Escitalopram", "lexapro": "Lexapro (escitalopram)", "imipramina": "Imipramina", "tofranil": "Tofranil (imipramina)",
+    "acido valproico": "Ácido Valproico", "valproato de sodio": "Valproato de Sódio", "depakene": "Depakene (ácido valproico)", "depakote": "Depakote (divalproato)",
+    "carbamazepina": "Carbamazepina", "tegretol": "Tegretol (carbamazepina)", "oxcarbazepina": "Oxcarbazepina", "trileptal": "Trileptal (oxcarbazepina)",
+    "lamotrigina": "Lamotrigina", "lamictal": "Lamictal (lamotrigina)", "levetiracetam": "Levetiracetam", "keppra": "Keppra (levetiracetam)",
+    "topiramato": "Topiramato", "topamax": "Topamax (topiramato)", "fenobarbital": "Fenobarbital", "gardenal": "Gardenal (fenobarbital)",
+    "clobazam": "Clobazam", "frisium": "Frisium (clobazam)", "clonazepam": "Clonazepam", "rivotril": "Rivotril (clonazepam)",
+    "melatonina": "Melatonina", "canabidiol": "Canabidiol",
+}
+PADRAO_REMEDIO = re.compile(r'\b(' + "|".join(sorted(map(re.escape, REMEDIOS), key=len, reverse=True)) + r')\b')
+PADRAO_DOSE = re.compile(r'\d+(?:[.,]\d+)?\s*(?:mg|mcg|ml|gotas|gts|comprimidos?|cp)\b')
+PADRAO_FREQUENCIA = re.compile(
+    r'\d+\s*x\s*(?:/|ao|por)\s*dia|(?:\d+|uma|duas|tres)\s*vez(?:es)?\s*(?:ao|por)\s*dia|(?:de\s*)?\d+\s*(?:/|em)\s*\d+\s*h(?:oras)?\b'
+    r'|pela manha|pela tarde|a noite|ao deitar|antes de dormir|ao acordar|se necessario|\bsos\b')
+PADRAO_NEGACAO_REMEDIO = re.compile(r'suspens|retirad|descontinu|sem uso|nao (faz|fara) uso|nao usa|ja (fez uso|utilizou|usou)|uso previo')
+JANELA_POSOLOGIA = 80   # Caracteres depois do nome, na mesma frase
+
+def extrair_medicamentos(texto):
+    """[{nome, posologia, confianca}]: 0.95 com dose e frequência, 0.85 só com dose, 0.6 só o nome; CONFIANCA_AMBIGUA como nos CIDs."""
+    normal, achados = _normalizar(texto), {}
+    for m in PADRAO_REMEDIO.finditer(normal):
+        antes = _oracao_antes(normal, m.start(), 30)
+        depois = _frase_depois(normal, m.end(), JANELA_POSOLOGIA)
+        proximo = PADRAO_REMEDIO.search(depois) # A posologia de um remédio não invade o seguinte
+        if proximo: depois = depois[:proximo.start()]
+        if PADRAO_NEGACAO_REMEDIO.search(antes) or PADRAO_NEGACAO_REMEDIO.search(depois): continue
+        partes = [p for p in (PADRAO_DOSE.search(depois), PADRAO_FREQUENCIA.search(depois)) if p]
+        posologia = texto[m.end() + min(p.start() for p in partes):m.end() + max(p.end() for p in partes)].strip() if partes else ""
+        confianca = 0.95 if len(partes) == 2 else 0.85 if PADRAO_DOSE.search(depois) else 0.6
+        if _frase_ambigua(normal, m.start(), m.end()): confianca = min(confianca, CONFIANCA_AMBIGUA)
+        nome = REMEDIOS[m.group(1)]
+        if confianca > achados.get(nome, {}).get("confianca", 0): achados[nome] = {"nome": nome, "posologia": posologia, "confianca": confianca}
+    return list(achados.values())
+
+# ==============================================================================
+# 4. RESULTADO E CONFIANÇA GERAL
+# ==============================================================================
+PADRAO_MENCAO_MEDICACAO = re.compile(r'medicac|posologia|prescri|em uso de|\d+\s?mg\b')
+PADRAO_SEM_MEDICACAO = re.compile(r'(nao (faz|fara) uso de|sem( uso de)?) medicac\w*')
+
+def extrair_local(texto):
+    """
+    Mesmo formato do extrator por IA ({diagnostico, medicamentos}) mais cids, confianca e origem.
+    A confiança geral é a do item mais fraco; sem CID ela é zero (o diagnóstico em prosa fica com a IA),
+    e cai para 0.5 quando o laudo fala de medicação que o dicionário não reconheceu.
+    """
+    texto = texto or ""
+    cids = extrair_cids(texto)
+    medicamentos = extrair_medicamentos(texto)
+    descricoes = list(dict.fromkeys(d for _, d, _ in cids if d))
+    diagnostico = f"{'; '.join(descricoes)} (CID {', '.join(c for c, _, _ in cids)})".strip() if cids else ""
+    confianca = min(c for _, _, c in cids) if cids else 0.0
+    if medicamentos: confianca = min(confianca, *(m['confianca'] for m in medicamentos))
+    elif PADRAO_MENCAO_MEDICACAO.search(PADRAO_SEM_MEDICACAO.sub("", _normalizar(texto))): confianca = min(confianca, 0.5)
+    return {"diagnostico": diagnostico, "cids": [c for c, _, _ in cids], "medicamentos": medicamentos, "confianca": confianca, "origem": "local"}
@@ -0,0 +1,195 @@
+"""
+Fila, limitador e single-flight das chamadas à IA do PEI 360º.
+
+O estado fica no módulo, compartilhado por todas as sessões do processo (o import acontece uma vez):
+- Limitador (token bucket): todas as sessões usam a mesma OPENAI_API_KEY, então o processo respeita os
+  limites da conta (RPM/TPM) e organiza a espera em fila, em vez de mandar a rajada para a API e receber 429.
+- Single-flight: pedidos idênticos em andamento (duplo clique, duas abas) viram uma só geração.
+- Tarefas em segundo plano: o script do Streamlit agenda a geração e segue; o resultado fica guardado pelo id.
+Ajustes: PEI_IA_RPM, PEI_IA_TPM, PEI_IA_RAJADA, PEI_IA_WORKERS.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
+import os
+import threading
+import time
+import uuid
+
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+from contexto_ia import contar_tokens
+
+IA_LIMITE_RPM = int(os.environ.get("PEI_IA_RPM", 500))
+IA_LIMITE_TPM = int(os.environ.get("PEI_IA_TPM", 200000))
+IA_RAJADA_SEGUNDOS = float(os.environ.get("PEI_IA_RAJADA", 10)) # A OpenAI fiscaliza em janelas curtas: balde = 10s de limite
+CAPACIDADE_REQ = max(1.0, IA_LIMITE_RPM * IA_RAJADA_SEGUNDOS / 60)
+CAPACIDADE_TOK = max(1.0, IA_LIMITE_TPM * IA_RAJADA_SEGUNDOS / 60)
+PRIORIDADE_INTERATIVA, PRIORIDADE_SEGUNDO_PLANO = 0, 1
+IA_WORKERS = int(os.environ.get("PEI_IA_WORKERS", 32)) # Threads só esperam rede; quem dosa as chamadas é o limitador
+TAREFAS_TTL = 3600 # Resultados prontos ficam disponíveis por 1h
+
+SESSAO_IA = contextvars.ContextVar("sessao_ia", default="") # Sessão dona da chamada (também nas threads de fundo)
+
+def id_sessao_atual():
+    ctx = get_script_run_ctx(suppress_warning=True)
+    return ctx.session_id if ctx else SESSAO_IA.get()
+
+# ==============================================================================
+# 1. LIMITADOR COMPARTILHADO (TOKEN BUCKET)
+# ==============================================================================
+def _novo_limitador():
+    return {"cond": threading.Condition(), "fichas_req": CAPACIDADE_REQ, "fichas_tok": CAPACIDADE_TOK,
+            "atualizado": time.time(), "fila": [], "seq": 0, "rodada": 0, "ultima_rodada": {}}
+
+_LIMITADOR = _novo_limitador()
+
+def _repor_fichas(lim):
+    agora = time.time()
+    decorrido, lim['atualizado'] = agora - lim['atualizado'], agora
+    lim['fichas_req'] = min(CAPACIDADE_REQ, lim['fichas_req'] + decorrido * IA_LIMITE_RPM / 60)
+    lim['fichas_tok'] = min(CAPACIDADE_TOK, lim['fichas_tok'] + decorrido * IA_LIMITE_TPM / 60)
+
+def _ordem_fila(lim):
+    # Prioridade primeiro; dentro dela, rodízio entre sessões (o 2º pedido de uma sessão espera o 1º das outras)
+    return sorted(lim['fila'], key=lambda f: (f['prioridade'], f['rodada'], f['seq']))
+
+def estimar_tokens_pedido(kwargs):
+    # Mesma conta da OpenAI para o TPM: tokens de entrada + max_tokens pedido
+    entrada = sum(contar_tokens(m.get('content') if isinstance(m.get('content'), str) else "") for m in kwargs.get('messages', []))
+    return entrada + (kwargs.get('max_tokens') or 1000)
+
+def aguardar_vez_ia(tokens, prioridade=PRIORIDADE_INTERATIVA):
+    """Bloqueia até haver fichas de requisição e de tokens e este pedido ser o próximo da fila."""
+    lim = _LIMITADOR
+    tokens = min(tokens, CAPACIDADE_TOK) # Pedido maior que o balde esperaria para sempre
+    with lim['cond']:
+        lim['seq'] += 1
+        sessao = id_sessao_atual()
+        # Rodada de atendimento: uma depois da última desta sessão (ou da rodada atual, se ela estava parada)
+        rodada = max(lim['rodada'], lim['ultima_rodada'].get(sessao, 0)) + 1
+        lim['ultima_rodada'][sessao] = rodada
+        ficha = {"sessao": sessao, "prioridade": prioridade, "seq": lim['seq'], "rodada": rodada}
+        lim['fila'].append(ficha)
+        try:
+            while True:
+                _repor_fichas(lim)
+                if _ordem_fila(lim)[0] is ficha and lim['fichas_req'] >= 1 and lim['fichas_tok'] >= tokens:
+                    lim['fichas_req'] -= 1; lim['fichas_tok'] -= tokens
+                    lim['rodada'] = max(lim['rodada'], ficha['rodada'])
+                    lim['ultima_rodada'] = {k: v for k, v in lim['ultima_rodada'].items() if v > lim['rodada']}
+                    return
+                falta = max((1 - lim['fichas_req']) * 60 / IA_LIMITE_RPM, (tokens - lim['fichas_tok']) * 60 / IA_LIMITE_TPM)
+                lim['cond'].wait(timeout=min(max(falta, 0.05), 1.0))
+        finally:
+            lim['fila'].remove(ficha); lim['cond'].notify_all()
+
+def esvaziar_limitador_ia():
+    # Recebemos 429 mesmo assim (outro app na mesma conta?): todas as sessões recuam juntas
+    lim = _LIMITADOR
+    with lim['cond']:
+        _repor_fichas(lim); lim['fichas_req'] = lim['fichas_tok'] = 0.0
+
+def posicao_fila_ia(sessao=None):
+    """Posição (1 = próximo) do primeiro pedido da sessão na fila do limitador, ou None se não estiver esperando."""
+    sessao = sessao or id_sessao_atual()
+    lim = _LIMITADOR
+    with lim['cond']:
+        for i, ficha in enumerate(_ordem_fila(lim)):
+            if ficha['sessao'] == sessao: return i + 1
+    return None
+
+# ==============================================================================
+# 2. SINGLE-FLIGHT: PEDIDOS IDÊNTICOS EM ANDAMENTO VIRAM UMA SÓ GERAÇÃO
+# ==============================================================================
+# Duplo clique ou duas abas no mesmo estudante geram a mesma chave (hash dos prompts).
+# A geração roda numa thread própria: sobrevive ao rerun que interrompe o script e
+# quem chegar depois se acopla ao resultado pendente, recebendo também o que já foi transmitido.
+_VOOS = {"trava": threading.Lock(), "voos": {}}
+
+def _executar_voo(reg, chave, voo, tarefa):
+    try:
+        for pedaco in tarefa():
+            with voo['cond']:
+                voo['partes'].append(pedaco); voo['cond'].notify_all()
+    except Exception as e: voo['erro'] = str(e)
+    finally:
+        with reg['trava']: reg['voos'].pop(chave, None)
+        with voo['cond']:
+            voo['fim'] = True; voo['cond'].notify_all()
+
+def entrar_voo(chave, tarefa):
+    """
+    Devolve o voo em andamento para a chave ou inicia um novo.
+    tarefa: função sem argumentos que gera pedaços de texto (e grava o cache, se for o caso).
+    """
+    reg = _VOOS
+    with reg['trava']:
+        voo = reg['voos'].get(chave)
+        if voo: return voo
+        voo = reg['voos'][chave] = {"cond": threading.Condition(), "partes": [], "fim": False, "erro": None}
+    # copy_context: a thread leva junto a sessão dona do pedido (fila justa do limitador)
+    threading.Thread(target=contextvars.copy_context().run, args=(_executar_voo, reg, chave, voo, tarefa), daemon=True).start()
+    return voo
+
+def acompanhar_voo(voo, metricas=None):
+    """Gera os pedaços do voo (os que já chegaram e os próximos); ttft/total do ponto de vista de quem acompanha."""
+    metricas = {} if metricas is None else metricas
+    inicio, i = time.time(), 0
+    while True:
+        with voo['cond']:
+            voo['cond'].wait_for(lambda: len(voo['partes']) > i or voo['fim'])
+            novos, fim = voo['partes'][i:], voo['fim']
+        i += len(novos)
+        if novos and 'ttft' not in metricas: metricas['ttft'] = time.time() - inicio
+        yield from novos
+        if fim: break
+    metricas['total'] = time.time() - inicio
+    if voo['erro']: metricas['erro'] = voo['erro']
+
+def resultado_voo(voo):
+    texto = "".join(acompanhar_voo(voo))
+    return (None, voo['erro']) if voo['erro'] else (texto, None)
+
+# ==============================================================================
+# 3. TAREFAS EM SEGUNDO PLANO (O SCRIPT NÃO FICA PRESO NA GERAÇÃO)
+# ==============================================================================
+# Um clique em qualquer widget interrompe o script; a tarefa continua no pool e o resultado
+# fica guardado pelo id até a sessão (ou uma nova, após reconexão) buscá-lo.
+_TAREFAS = {"executor": ThreadPoolExecutor(max_workers=IA_WORKERS, thread_name_prefix="pei-ia"), "trava": threading.Lock(), "tarefas": {}}
+
+def _executar_tarefa_ia(tarefa, funcao, args, kwargs, stream):
+    SESSAO_IA.set(tarefa['sessao'])
+    tarefa.update(status="rodando", inicio=time.time())
+    try:
+        if stream:
+            metricas = tarefa['metricas']
+            for pedaco in funcao(*args, metricas=metricas, **kwargs): tarefa['parcial'] += pedaco
+            res, err = (None, metricas['erro']) if metricas.get('erro') else (metricas.get('conteudo') or tarefa['parcial'], None)
+        else: res, err = funcao(*args, **kwargs)
+    except Exception as e: res, err = None, str(e)
+    if not res and not err: err = "A IA não devolveu resposta."
+    tarefa.update(status="erro" if err else "concluida", resultado=res, erro=err, fim=time.time())
+
+def enviar_tarefa_ia(tipo, funcao, *args, stream=False, dono=None, **kwargs):
+    """
+    Agenda funcao(*args, **kwargs) -> (resultado, erro) no pool e devolve o id da tarefa.
+    Com stream=True, funcao é uma geradora de texto que recebe metricas= (o parcial fica visível).
+    dono: a quem o resultado pertence (ex.: identidade do estudante); conferido com tarefa_do_dono ao aplicar.
+    """
+    fila = _TAREFAS
+    id_tarefa = uuid.uuid4().hex[:12]
+    tarefa = {"id": id_tarefa, "tipo": tipo, "sessao": id_sessao_atual(), "dono": dono, "status": "fila", "parcial": "", "resultado": None, "erro": None,
+              "metricas": {}, "criada": time.time(), "inicio": None, "fim": None}
+    with fila['trava']:
+        for antiga in [k for k, t in fila['tarefas'].items() if t['fim'] and time.time() - t['fim'] > TAREFAS_TTL]:
+            del fila['tarefas'][antiga]
+        fila['tarefas'][id_tarefa] = tarefa
+    fila['executor'].submit(_executar_tarefa_ia, tarefa, funcao, args, kwargs, stream)
+    return id_tarefa
+
+def consultar_tarefa_ia(id_tarefa):
+    return _TAREFAS['tarefas'].get(id_tarefa)
+
+def tarefa_do_dono(tarefa, dono):
+    # Tarefa sem dono vale para qualquer um; com dono, só para o mesmo
+    return tarefa.get('dono') is None or tarefa['dono'] == dono
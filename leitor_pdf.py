@@ -0,0 +1,273 @@
+"""
+Extração de texto dos laudos em PDF do PEI 360º.
+
+O texto fica em cache por hash do conteúdo do arquivo: os reruns do Streamlit com o mesmo
+upload não reprocessam nada. Laudos longos são divididos em faixas de páginas extraídas em
+paralelo num pool de processos (o pypdf é Python puro, então threads não ajudariam por causa do GIL).
+Cabeçalhos, rodapés e carimbos repetidos (timbre da clínica, endereço, CRM, "Página x de y") são
+removidos antes de tudo. Com vários laudos do mesmo aluno, as faixas de todos os arquivos vão juntas para o pool e as
+páginas idênticas ou quase idênticas entre documentos (cópias, anexos repetidos) entram uma vez só.
+Depois, cada página recebe uma nota local (TF-IDF de termos clínicos) e só as mais relevantes
+seguem para a IA, dentro de um orçamento fixo de tokens.
+Ajustes: PEI_PDF_PROCESSOS (padrão: núcleos da máquina, até 4).
+"""
+from collections import OrderedDict
+from concurrent.futures import BrokenExecutor, ProcessPoolExecutor
+from io import BytesIO
+import hashlib
+import math
+import multiprocessing
+import os
+import re
+import threading
+import zlib
+
+from pypdf import PdfReader
+from pypdf.errors import PyPdfError
+
+PROCESSOS = int(os.environ.get("PEI_PDF_PROCESSOS", min(os.cpu_count() or 1, 4)))
+PAGINAS_MIN_PARALELO = 8   # Abaixo disso o custo de enviar o arquivo aos processos não compensa
+PAGINAS_POR_FAIXA = 4      # Menor faixa entregue a um processo
+CACHE_MAX = 32             # Laudos distintos guardados em memória
+_TRAVA = threading.Lock()
+_CACHE = OrderedDict()     # (hash, limite) -> lista de textos por página
+_POOL = {}                 # "executor"; "falhou" depois que o pool quebrou uma vez
+
+# ==============================================================================
+# 1. EXTRAÇÃO (RODA NO PROCESSO PRINCIPAL OU NOS PROCESSOS DO POOL)
+# ==============================================================================
+def _extrair_faixa(conteudo, inicio, fim):
+    reader = PdfReader(BytesIO(conteudo))
+    return [(reader.pages[i].extract_text() or "") for i in range(inicio, fim)]
+
+def _pool():
+    # "spawn": o processo do Streamlit tem várias threads, e fork com threads pode travar
+    with _TRAVA:
+        if "executor" not in _POOL:
+            _POOL["executor"] = ProcessPoolExecutor(max_workers=PROCESSOS, mp_context=multiprocessing.get_context("spawn"))
+        return _POOL["executor"]
+
+def _descartar_pool():
+    # Um pool que quebrou (falta de memória, processo morto) tende a quebrar de novo: não recria
+    with _TRAVA:
+        executor = _POOL.pop("executor", None)
+        _POOL["falhou"] = True
+    if executor: executor.shutdown(wait=False, cancel_futures=True)
+
+def _faixas(total):
+    tamanho = max(PAGINAS_POR_FAIXA, -(-total // PROCESSOS))
+    return [(i, min(i + tamanho, total)) for i in range(0, total, tamanho)]
+
+def extrair_documentos(conteudos, limite=None):
+    """Texto de cada página (até `limite` páginas por arquivo) de vários PDFs, sem cache."""
+    totais = [len(PdfReader(BytesIO(c)).pages) for c in conteudos]
+    if limite: totais = [min(t, limite) for t in totais]
+    if sum(totais) < PAGINAS_MIN_PARALELO or PROCESSOS < 2 or _POOL.get("falhou"): return [_extrair_faixa(c, 0, t) for c, t in zip(conteudos, totais)]
+    try:
+        futuros = [[_pool().submit(_extrair_faixa, c, inicio, fim) for inicio, fim in _faixas(t)] for c, t in zip(conteudos, totais)]
+        return [[texto for futuro in doc for texto in futuro.result()] for doc in futuros]
+    except (BrokenExecutor, OSError):
+        # Pool quebrado (processo morto, falta de memória): descarta e segue em série até o app reiniciar
+        _descartar_pool()
+    except Exception: pass # Erro do próprio PDF num processo: o pool continua bom, tenta aqui para ver o erro real
+    return [_extrair_faixa(c, 0, t) for c, t in zip(conteudos, totais)]
+
+def extrair_paginas(conteudo, limite=None):
+    """Texto de cada página (até `limite` páginas), sem cache."""
+    return extrair_documentos([conteudo], limite)[0]
+
+# ==============================================================================
+# 2. CACHE POR HASH DO CONTEÚDO
+# ==============================================================================
+def hash_conteudo(conteudo):
+    return hashlib.sha256(conteudo).hexdigest()
+
+def paginas_documentos(conteudos, limite=None, hashes=None):
+    """Como extrair_documentos, mas cada arquivo (mesmo hash) só é lido uma vez por processo."""
+    chaves = [(h, limite) for h in (hashes or [hash_conteudo(c) for c in conteudos])]
+    with _TRAVA:
+        resultado = [_CACHE.get(chave) for chave in chaves]
+        for chave, paginas in zip(chaves, resultado):
+            if paginas is not None: _CACHE.move_to_end(chave)
+    faltam = [i for i, paginas in enumerate(resultado) if paginas is None]
+    if faltam:
+        extraidos = extrair_documentos([conteudos[i] for i in faltam], limite)
+        with _TRAVA:
+            for i, paginas in zip(faltam, extraidos):
+                resultado[i] = _CACHE[chaves[i]] = paginas
+            while len(_CACHE) > CACHE_MAX: _CACHE.popitem(last=False)
+    return resultado
+
+# Arquivo truncado ou corrompido: o pypdf levanta PyPdfError (PdfStreamError, PdfReadError...) e,
+# com estruturas internas quebradas, ValueError/KeyError ou erro do zlib ao descompactar
+ERROS_PDF = (PyPdfError, ValueError, KeyError, zlib.error)
+
+def paginas_por_arquivo(conteudos, limite=None, hashes=None):
+    """
+    Como paginas_documentos, mas um arquivo ilegível não derruba os outros:
+    devolve as páginas de cada arquivo, com None no lugar dos que não abriram.
+    """
+    hashes = hashes or [hash_conteudo(c) for c in conteudos]
+    try: return paginas_documentos(conteudos, limite, hashes)
+    except ERROS_PDF: pass # Descobre qual arquivo falhou, um por vez (os bons ficam em cache)
+    resultado = []
+    for conteudo, hash_pdf in zip(conteudos, hashes):
+        try: resultado.append(paginas_documentos([conteudo], limite, [hash_pdf])[0])
+        except ERROS_PDF: resultado.append(None)
+    return resultado
+
+def paginas_pdf(conteudo, limite=None, hash_pdf=None):
+    """Como extrair_paginas, mas o mesmo arquivo (mesmo hash) só é lido uma vez por processo."""
+    return paginas_documentos([conteudo], limite, [hash_pdf] if hash_pdf else None)[0]
+
+# ==============================================================================
+# 3. LIMPEZA DE CABEÇALHOS, RODAPÉS E CARIMBOS
+# ==============================================================================
+# Linhas curtas que são só "papel timbrado": saem mesmo quando aparecem numa página só
+PADROES_BOILERPLATE = [
+    re.compile(r'^(p[áa]g(ina)?\.?\s*)?\d+\s*(de|/)\s*\d+$', re.IGNORECASE),               # Página 3 de 15 | 3/15
+    re.compile(r'^p[áa]g(ina)?\.?\s*\d+$', re.IGNORECASE),
+    re.compile(r'\b(crm|crp|crfa|crefito|cref)\s*[-/:]?\s*([a-z]{2}\s*[-/:]?\s*)?\d{3,}', re.IGNORECASE),
+    re.compile(r'\bcep\s*:?\s*\d{5}-?\d{3}\b', re.IGNORECASE),
+    re.compile(r'^(tel|fone|telefone|whatsapp|cel)\b.*\d{4}', re.IGNORECASE),
+    re.compile(r'^\S+@\S+\.\S+$|^(https?://|www\.)\S+$', re.IGNORECASE),
+    re.compile(r'^(documento )?assinad[oa] (digitalmente|eletronicamente)', re.IGNORECASE),
+]
+LINHA_BOILERPLATE_MAX = 120  # Caracteres: linhas maiores são conteúdo, mesmo com um CRM no meio
+FRACAO_REPETIDA = 0.5        # Linha presente em pelo menos metade das páginas = cabeçalho/rodapé
+
+LINHA_CONTADOR_MAX = 40      # Só linhas curtas (contador de página, data) ignoram os números ao comparar
+# CID e dosagem nunca saem como carimbo: repetidas no cabeçalho ("CID: F84.0"), fica a primeira ocorrência
+PADRAO_LINHA_CLINICA = re.compile(r'\bcid\b|\b[fgqhr]\d{2}(\.\d{1,2})?\b|\d+([.,]\d+)?\s?(mg|mcg|ml)\b', re.IGNORECASE)
+
+def _normalizar_linha(linha):
+    # "Página 3 de 15" e "Página 4 de 15" contam como a mesma linha; frases longas que só diferem nos números não,
+    # nem linhas clínicas ("CID F84.0" e "CID F90.0" são diagnósticos diferentes)
+    texto = " ".join(linha.lower().split())
+    return re.sub(r'\d+', '#', texto) if len(texto) <= LINHA_CONTADOR_MAX and not PADRAO_LINHA_CLINICA.search(texto) else texto
+
+def limpar_paginas(paginas):
+    """
+    Tira das páginas as linhas repetidas em boa parte do documento e os carimbos de PADROES_BOILERPLATE.
+    Linhas com CID ou dosagem ficam sempre; se repetidas, só a primeira ocorrência.
+    """
+    linhas = [p.splitlines() for p in paginas]
+    repetidas, clinicas_vistas = set(), set()
+    if len(paginas) >= 3:
+        frequencia = {}
+        for pagina in linhas:
+            for chave in {_normalizar_linha(l) for l in pagina if l.strip()}: frequencia[chave] = frequencia.get(chave, 0) + 1
+        minimo = max(2, FRACAO_REPETIDA * len(paginas))
+        repetidas = {chave for chave, n in frequencia.items() if n >= minimo}
+    def manter(linha):
+        texto = linha.strip()
+        if not texto: return False
+        chave = _normalizar_linha(texto)
+        if PADRAO_LINHA_CLINICA.search(texto):
+            if chave in repetidas and chave in clinicas_vistas: return False
+            clinicas_vistas.add(chave); return True
+        if chave in repetidas: return False
+        return len(texto) > LINHA_BOILERPLATE_MAX or not any(p.search(texto) for p in PADROES_BOILERPLATE)
+    return ["\n".join(l for l in pagina if manter(l)) for pagina in linhas]
+
+# ==============================================================================
+# 4. VÁRIOS LAUDOS: PÁGINAS REPETIDAS
+# ==============================================================================
+SEMELHANCA_DUPLICADA = 0.9   # Jaccard dos trechos de 5 palavras: acima disso é a mesma página (outro OCR, outro rodapé)
+
+def _assinatura(texto):
+    palavras = re.findall(r'\w+', texto)
+    return {hash(" ".join(palavras[i:i + 5])) for i in range(max(1, len(palavras) - 4))}
+
+def deduplicar_paginas(documentos):
+    """
+    documentos: uma lista de textos por página para cada arquivo.
+    Devolve os pares (documento, página) mantidos: só a primeira ocorrência de cada página idêntica
+    (hash do texto normalizado) ou quase idêntica (assinatura de trechos), na ordem dos arquivos.
+    """
+    exatas, vistas, mantidas = set(), [], []
+    for d, paginas in enumerate(documentos):
+        for p, texto in enumerate(paginas):
+            normal = " ".join(texto.lower().split())
+            if not normal: continue
+            resumo = hashlib.sha1(normal.encode('utf-8')).digest()
+            if resumo in exatas: continue
+            exatas.add(resumo)
+            assinatura = _assinatura(normal)
+            if any(len(assinatura & a) >= SEMELHANCA_DUPLICADA * len(assinatura | a) for a in vistas
+                   if SEMELHANCA_DUPLICADA * len(a) <= len(assinatura) <= len(a) / SEMELHANCA_DUPLICADA): continue
+            vistas.append(assinatura); mantidas.append((d, p))
+    return mantidas
+
+# ==============================================================================
+# 5. RELEVÂNCIA DAS PÁGINAS (SEM IA)
+# ==============================================================================
+# Conclusões, CID e medicação costumam estar no fim de laudos neuropsicológicos (pág. 8-15),
+# e as primeiras páginas são anamnese e identificação. termo -> peso
+TERMOS_RELEVANCIA = [
+    (re.compile(r'\b[fgq]\d{2}(\.\d+)?\b', re.IGNORECASE), 4.0),   # Código CID
+    (re.compile(r'conclus[ãa]o|conclui-se|s[íi]ntese diagn', re.IGNORECASE), 4.0),
+    (re.compile(r'\bcid\b', re.IGNORECASE), 3.0),
+    (re.compile(r'diagn[óo]stic', re.IGNORECASE), 3.0),
+    (re.compile(r'hip[óo]tese', re.IGNORECASE), 3.0),
+    (re.compile(r'parecer|impress[ãa]o cl[íi]nica', re.IGNORECASE), 3.0),
+    (re.compile(r'\d+([.,]\d+)?\s?mg\b', re.IGNORECASE), 3.0),    # Dosagem
+    (re.compile(r'medica[çc]|posologia|prescri', re.IGNORECASE), 2.0),
+    (re.compile(r'recomend|sugere-se|orienta[çc][õo]es', re.IGNORECASE), 2.0),
+    (re.compile(r'transtorno|defici[êe]ncia|s[íi]ndrome|\btdah\b|\btea\b|autis|dislexi', re.IGNORECASE), 2.0),
+    (re.compile(r'encaminh|acompanhamento', re.IGNORECASE), 1.0),
+    (re.compile(r'percentil|escore|\bqi\b|quociente|classifica[çc][ãa]o', re.IGNORECASE), 1.5),
+]
+
+def notas_paginas(paginas):
+    """
+    Nota de cada página: soma de peso * (1 + log tf) * idf dos termos clínicos.
+    O idf vem das próprias páginas do laudo, então um cabeçalho repetido em todas ("Laudo", "CID-10")
+    pesa pouco e a página que concentra o termo se destaca.
+    """
+    n = len(paginas)
+    contagens = [[len(padrao.findall(p)) for padrao, _ in TERMOS_RELEVANCIA] for p in paginas]
+    df = [sum(1 for c in contagens if c[t]) for t in range(len(TERMOS_RELEVANCIA))]
+    idf = [math.log((1 + n) / (1 + d)) + 1 for d in df]
+    return [sum(peso * (1 + math.log(c[t])) * idf[t] for t, (_, peso) in enumerate(TERMOS_RELEVANCIA) if c[t]) for c in contagens]
+
+def _nota_linha(linha):
+    return sum(peso for padrao, peso in TERMOS_RELEVANCIA if padrao.search(linha))
+
+def cortar_pagina(texto, orcamento, contar=lambda t: len(t) // 4 + 1):
+    """
+    Reduz uma página ao orçamento: ficam as linhas com termos clínicos (maior peso primeiro),
+    depois as demais na ordem do texto, e a página volta na ordem original com "[...]" nos cortes.
+    """
+    linhas = [l for l in texto.splitlines() if l.strip()]
+    marca = contar("[...]") # Cada linha mantida pode ser seguida de um corte, e o início também
+    mantidas, restante = set(), orcamento - marca
+    for i in sorted(range(len(linhas)), key=lambda i: (-_nota_linha(linhas[i]), i)):
+        tokens = contar(linhas[i]) + marca
+        if tokens > restante: continue
+        mantidas.add(i); restante -= tokens
+    if not mantidas: # Nem a melhor linha cabe inteira: vai cortada no meio
+        melhor = max(linhas, key=_nota_linha, default="")
+        return melhor[:max(0, len(melhor) * (orcamento - 2 * marca) // max(1, contar(melhor)))] + " [...]"
+    saida = []
+    for i, linha in enumerate(linhas):
+        if i in mantidas: saida.append(linha)
+        elif not saida or saida[-1] != "[...]": saida.append("[...]")
+    return "\n".join(saida)
+
+def selecionar_paginas(paginas, orcamento, contar=lambda t: len(t) // 4 + 1):
+    """
+    {índice: texto} das páginas que cabem no orçamento (tokens): primeiro as de maior nota,
+    depois as sem nota na ordem do documento. A página de maior nota nunca fica de fora:
+    se não couber inteira, vai cortada (cortar_pagina). Devolve em ordem crescente de índice.
+    """
+    notas = notas_paginas(paginas)
+    ordem = [i for i in sorted(range(len(paginas)), key=lambda i: (-notas[i], i)) if paginas[i].strip()]
+    escolhidas, restante = {}, orcamento
+    for posicao, i in enumerate(ordem):
+        tokens = contar(paginas[i])
+        if tokens <= restante: escolhidas[i] = paginas[i]
+        elif posicao == 0: escolhidas[i] = cortar_pagina(paginas[i], restante, contar)
+        else: continue
+        restante -= contar(escolhidas[i])
+    return dict(sorted(escolhidas.items()))
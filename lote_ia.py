@@ -0,0 +1,29 @@
+"""
+Formato de entrada e saída da Batch API da OpenAI (lote escolar do PEI 360º).
+
+Entrada: uma linha JSON por aluno, com custom_id = nome do arquivo em banco_alunos.
+Saída: uma linha por pedido; linha ilegível, com erro ou com resposta cortada conta como falha
+e não interrompe as demais.
+"""
+import json
+
+def linha_lote(custom_id, corpo):
+    """Linha do JSONL de entrada: corpo é o mesmo dict de parâmetros do chat.completions."""
+    return json.dumps({"custom_id": custom_id, "method": "POST", "url": "/v1/chat/completions", "body": corpo}, ensure_ascii=False)
+
+def montar_jsonl(linhas):
+    return "\n".join(linhas).encode('utf-8')
+
+def ler_saida_lote(saida):
+    """Devolve ([(custom_id, texto)], falhas) a partir do arquivo de saída do lote."""
+    respostas, falhas = [], 0
+    for linha in (saida or "").splitlines():
+        if not linha.strip(): continue
+        try:
+            item = json.loads(linha)
+            escolha = item['response']['body']['choices'][0]
+            texto = escolha['message']['content']
+            if escolha.get('finish_reason') == "length" or not texto: raise ValueError("resposta cortada ou vazia")
+            respostas.append((item['custom_id'], texto))
+        except (ValueError, KeyError, IndexError, TypeError): falhas += 1
+    return respostas, falhas
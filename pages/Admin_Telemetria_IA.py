@@ -0,0 +1,51 @@
+import streamlit as st
+import time
+import telemetria_ia
+
+# ==============================================================================
+# PAINEL DE TELEMETRIA DA IA (ADMINISTRAÇÃO)
+# ==============================================================================
+st.set_page_config(page_title="PEI 360º - Telemetria IA", page_icon="📈", layout="wide")
+
+# Se ADMIN_SENHA estiver nos secrets, a página pede a senha
+try: senha_admin = st.secrets.get("ADMIN_SENHA")
+except: senha_admin = None
+if senha_admin and st.text_input("Senha de administração", type="password") != senha_admin:
+    st.info("🔒 Informe a senha para ver a telemetria.")
+    st.stop()
+
+st.markdown("## 📈 Telemetria da IA")
+st.caption(f"Uma linha por chamada à OpenAI ou acerto de cache, gravada em `{telemetria_ia.ARQUIVO_TELEMETRIA}`. Latências em percentis só das chamadas reais concluídas.")
+
+periodo = st.radio("Período", [1, 7, 30], format_func=lambda d: "Últimas 24h" if d == 1 else f"Últimos {d} dias", horizontal=True, index=1)
+chamadas = telemetria_ia.ler_chamadas(time.time() - periodo * 86400)
+if not chamadas:
+    st.info("Nenhuma chamada registrada neste período.")
+    st.stop()
+
+c1, c2, c3, c4, c5 = st.columns(5)
+c1.metric("Chamadas", len(chamadas))
+c2.metric("Custo estimado", f"US$ {sum(c['custo'] for c in chamadas):.2f}")
+c3.metric("Tokens (entrada/saída)", f"{sum(c['tokens_entrada'] for c in chamadas):,} / {sum(c['tokens_saida'] for c in chamadas):,}".replace(",", "."))
+c4.metric("Acertos de cache", f"{100 * sum(c['cache'] == 'hit' for c in chamadas) / len(chamadas):.0f}%")
+c5.metric("Entrada em cache de prompt", f"{telemetria_ia.percentual_cache(chamadas):.0f}%", help="Tokens de entrada cobrados com desconto porque o início do prompt repetiu uma chamada recente.")
+
+st.markdown("### Por tarefa")
+st.dataframe(telemetria_ia.resumir(chamadas), hide_index=True, use_container_width=True)
+
+st.markdown("### Por dia e tarefa")
+por_dia = telemetria_ia.resumir(chamadas, por_dia=True)
+st.dataframe(por_dia, hide_index=True, use_container_width=True)
+
+# Gráfico: p90 de latência por dia, uma linha por tarefa
+dias = sorted({l['Dia'] for l in por_dia})
+tarefas = sorted({l['Tarefa'] for l in por_dia})
+p90 = {(l['Dia'], l['Tarefa']): l['p90 (s)'] for l in por_dia}
+if len(dias) > 1:
+    st.markdown("### p90 de latência (s) por dia")
+    st.line_chart({"Dia": dias, **{t: [p90.get((d, t)) for d in dias] for t in tarefas}}, x="Dia")
+
+erros = telemetria_ia.erros_por_classe(chamadas)
+if erros:
+    st.markdown("### Erros por classe")
+    st.dataframe(erros, hide_index=True, use_container_width=True)
@@ -0,0 +1,39 @@
+"""
+Seções marcadas do PEI ([TAG] ... [FIM]): localizar, listar e encaixar uma seção reescrita.
+
+Usado pela regeneração de uma seção (sem refazer o PEI inteiro) e pelo rascunho a partir de PEIs semelhantes.
+O encaixe troca só o bloco da seção e preserva o resto do texto, inclusive edições manuais do professor.
+"""
+import re
+
+# rótulo -> (tag de abertura, tag de fechamento, campo em ia_estrutura)
+SECOES_REGERAVEIS = {
+    "Metas SMART": ("METAS_SMART", "FIM_METAS_SMART", "metas"),
+    "Taxonomia de Bloom": ("TAXONOMIA_BLOOM", "/TAXONOMIA_BLOOM", "bloom"),
+    "Mapeamento BNCC": ("MAPEAMENTO_BNCC", "/MAPEAMENTO_BNCC", None),
+    "Análise Farmacológica": ("ANALISE_FARMA", "/ANALISE_FARMA", None),
+    "Campos de Experiência": ("CAMPOS_EXPERIENCIA_PRIORITARIOS", "/CAMPOS_EXPERIENCIA_PRIORITARIOS", "campos_experiencia"),
+    "Direitos de Aprendizagem": ("DIREITOS_APRENDIZAGEM", "/DIREITOS_APRENDIZAGEM", None),
+    "Objetivos de Desenvolvimento": ("OBJETIVOS_DESENVOLVIMENTO", "FIM_OBJETIVOS", None),
+}
+
+def localizar_secao(texto, secao):
+    """Posição (início, fim) do bloco [TAG]...[FIM] no texto, tags incluídas."""
+    tag_ini, tag_fim, _ = SECOES_REGERAVEIS[secao]
+    m = re.search(fr'\[{re.escape(tag_ini)}\].*?\[{re.escape(tag_fim)}\]', texto or "", re.DOTALL)
+    return (m.start(), m.end()) if m else None
+
+def secoes_presentes(texto):
+    return [s for s in SECOES_REGERAVEIS if localizar_secao(texto, s)]
+
+def normalizar_bloco(bloco, secao):
+    """Só o bloco [TAG]...[FIM] da resposta; se o modelo esqueceu as tags, embrulha o texto nelas."""
+    tag_ini, tag_fim, _ = SECOES_REGERAVEIS[secao]
+    achado = localizar_secao(bloco, secao)
+    return bloco[achado[0]:achado[1]] if achado else f"[{tag_ini}]\n{bloco.strip()}\n[{tag_fim}]"
+
+def encaixar_secao(texto, secao, bloco):
+    """Troca a seção no texto pelo bloco (normalizado). None se a seção não existe mais no texto."""
+    pos = localizar_secao(texto, secao)
+    if not pos: return None
+    return texto[:pos[0]] + normalizar_bloco(bloco, secao) + texto[pos[1]:]
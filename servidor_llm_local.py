@@ -0,0 +1,193 @@
+"""
+Servidor local que imita a API da OpenAI (chat completions, streaming, images, files e batches).
+Serve para rodar o PEI 360º sem chave real: benchmark, testes de ponta a ponta e o lote escolar.
+
+Uso:
+    python servidor_llm_local.py --porta 8765 --latencia 0.8 --tokens-por-segundo 60
+    OPENAI_BASE_URL=http://127.0.0.1:8765/v1 streamlit run streamlit_app.py
+"""
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import argparse
+import base64
+import json
+import re
+import threading
+import time
+import uuid
+
+CONFIG = {"latencia": 0.5, "tokens_por_segundo": 80.0}
+ARQUIVOS = {}   # id -> conteúdo (bytes)
+LOTES = {}      # id -> objeto batch
+PREFIXOS = set() # system prompts já vistos (imita o cache de prompt da OpenAI)
+TRAVA = threading.Lock()
+
+# ==============================================================================
+# 1. RESPOSTAS SINTÉTICAS (DETERMINÍSTICAS)
+# ==============================================================================
+def resposta_texto(mensagens):
+    sistema = " ".join(m.get("content", "") for m in mensagens if m.get("role") == "system")
+    secao = re.search(r"iniciando com \[([\w/]+)\] e terminando com \[([\w/]+)\]", sistema)
+    if secao: # Regeneração de uma seção só
+        if secao.group(1) == "METAS_SMART":
+            return "[METAS_SMART]\n- CURTO PRAZO (2 meses): Ler 30 palavras simples\n- MÉDIO PRAZO (Semestre): Ler parágrafos curtos\n- LONGO PRAZO (Ano): Interpretar textos curtos\n[FIM_METAS_SMART]"
+        return f"[{secao.group(1)}]\n- Conteúdo revisado pelo servidor local\n[{secao.group(2)}]"
+    if "Game Master" in sistema or "RPG" in sistema or "Histórias Visuais" in sistema:
+        return "# 🗺️ MAPA DE EXPLORAÇÃO\n\n🎒 **Equipamento:** Caderno e lápis mágico\n⚡ **Super Poder:** Memória visual\n🚧 **O Desafio:** Ficar sentado na roda\n🏆 **Recompensa:** Estrelinha\n🤝 **Aliados:** Professora e amigos"
+    if "EDUCAÇÃO INFANTIL" in sistema:
+        return ("👤 QUEM É O ESTUDANTE?\nCriança curiosa e afetuosa.\n\n1. 🌟 AVALIAÇÃO DE REPERTÓRIO:\n[ANALISE_FARMA] Sem impacto relevante. [/ANALISE_FARMA]\n"
+                "[CAMPOS_EXPERIENCIA_PRIORITARIOS]\n- 🤝 O eu, o outro e o nós\n- 🤸 Corpo, gestos e movimentos\n[/CAMPOS_EXPERIENCIA_PRIORITARIOS]\n"
+                "[OBJETIVOS_DESENVOLVIMENTO]\n- OBJETIVO 1: Participar da roda\n- OBJETIVO 2: Brincar com pares\n[FIM_OBJETIVOS]\n\n2. 🧩 ESTRATÉGIAS DE ACOLHIMENTO E ROTINA:\n- Rotina visual")
+    return ("👤 QUEM É O ESTUDANTE?\nEstudante criativo, com bom vínculo com a turma.\n\n1. 🌟 AVALIAÇÃO DE REPERTÓRIO:\n[ANALISE_FARMA] Sem impacto relevante. [/ANALISE_FARMA]\n"
+            "[MAPEAMENTO_BNCC]\n- **Habilidades Basais:** Leitura de palavras\n- **Habilidades Focais:** Produção de frases\n[/MAPEAMENTO_BNCC]\n"
+            "[TAXONOMIA_BLOOM] Identificar, Classificar, Aplicar [/TAXONOMIA_BLOOM]\n"
+            "[METAS_SMART]\n- CURTO PRAZO (2 meses): Ler 20 palavras simples\n- MÉDIO PRAZO (Semestre): Ler frases curtas\n- LONGO PRAZO (Ano): Ler textos curtos com autonomia\n[FIM_METAS_SMART]\n\n"
+            "2. 🧩 DIRETRIZES DE ADAPTAÇÃO:\n- Fragmentar tarefas\n- Pistas visuais")
+
+def resposta_json(mensagens):
+    return json.dumps({
+        "diagnostico": "Transtorno do Espectro Autista", "cids": ["F84.0"],
+        "medicamentos": [{"nome": "Risperidona", "posologia": "1mg à noite"}],
+        "recomendacoes_clinicas": ["Antecipar mudanças de rotina"], "observacoes_funcionais": ["Boa memória visual"],
+        "saudacoes": ["Cada estudante aprende do seu jeito."], "dicas": ["Pausas curtas ajudam a memória."],
+    }, ensure_ascii=False)
+
+def resposta_pei_json(mensagens):
+    return json.dumps({
+        "texto": resposta_texto(mensagens),
+        "metas": {"curto": "Ler 20 palavras simples", "medio": "Ler frases curtas", "longo": "Ler textos curtos com autonomia"},
+        "bloom": ["Identificar", "Classificar", "Aplicar"], "campos_experiencia": [],
+    }, ensure_ascii=False)
+
+# PNG 2x2 colorido: basta para exercitar o salvamento e as miniaturas das imagens geradas
+IMAGEM_PNG = base64.b64decode("iVBORw0KGgoAAAANSUhEUgAAAAIAAAACCAIAAAD91JpzAAAAF0lEQVR4nGP89iDuwb4LjAxF//kf7AYAOfcHwPWwbXQAAAAASUVORK5CYII=")
+
+def responder(corpo):
+    formato = corpo.get("response_format") or {}
+    if formato.get("type") == "json_schema" and formato.get("json_schema", {}).get("name") == "pei_tecnico":
+        return resposta_pei_json(corpo.get("messages", []))
+    if formato.get("type") in ("json_object", "json_schema"): return resposta_json(corpo.get("messages", []))
+    return resposta_texto(corpo.get("messages", []))
+
+def tokens_cache(mensagens):
+    # Como a OpenAI: prefixo repetido de 1024+ tokens conta em blocos de 128 (aqui o prefixo é o system prompt)
+    sistema = "".join(m.get("content", "") for m in mensagens if m.get("role") == "system")
+    tokens = len(sistema) // 4
+    with TRAVA:
+        visto = sistema in PREFIXOS
+        PREFIXOS.add(sistema)
+    return tokens // 128 * 128 if visto and tokens >= 1024 else 0
+
+def uso(mensagens, texto):
+    prompt = sum(len(m.get("content", "")) for m in mensagens) // 4 + 1
+    saida = len(texto) // 4 + 1
+    return {"prompt_tokens": prompt, "completion_tokens": saida, "total_tokens": prompt + saida, "prompt_tokens_details": {"cached_tokens": tokens_cache(mensagens)}}
+
+# ==============================================================================
+# 2. HANDLER HTTP
+# ==============================================================================
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args): pass
+
+    def _json(self, obj, status=200):
+        corpo = json.dumps(obj, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(corpo)))
+        self.end_headers(); self.wfile.write(corpo)
+
+    def _chunk(self, dados):
+        bloco = f"data: {dados}\n\n".encode("utf-8")
+        self.wfile.write(b"%x\r\n" % len(bloco) + bloco + b"\r\n"); self.wfile.flush()
+
+    def _ler_corpo(self):
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def do_POST(self):
+        if self.path.endswith("/chat/completions"): return self._chat(json.loads(self._ler_corpo() or b"{}"))
+        if self.path.endswith("/images/generations"): return self._imagem(json.loads(self._ler_corpo() or b"{}"))
+        if self.path.endswith("/files"): return self._upload(self._ler_corpo())
+        if self.path.endswith("/batches"): return self._criar_lote(json.loads(self._ler_corpo() or b"{}"))
+        self._json({"error": {"message": f"Rota não suportada: {self.path}"}}, 404)
+
+    def do_GET(self):
+        if "/batches/" in self.path: return self._consultar_lote(self.path.rsplit("/", 1)[-1])
+        if self.path.endswith("/content"):
+            conteudo = ARQUIVOS.get(self.path.split("/")[-2], b"")
+            self.send_response(200); self.send_header("Content-Length", str(len(conteudo))); self.end_headers()
+            return self.wfile.write(conteudo)
+        self._json({"error": {"message": f"Rota não suportada: {self.path}"}}, 404)
+
+    def _chat(self, corpo):
+        mensagens = corpo.get("messages", [])
+        texto = responder(corpo)
+        base = {"id": f"chatcmpl-{uuid.uuid4().hex[:12]}", "created": int(time.time()), "model": corpo.get("model", "gpt-4o-mini")}
+        time.sleep(CONFIG["latencia"]) # Tempo até o primeiro token
+
+        if not corpo.get("stream"):
+            time.sleep(len(texto) / 4 / CONFIG["tokens_por_segundo"])
+            return self._json({**base, "object": "chat.completion", "usage": uso(mensagens, texto),
+                               "choices": [{"index": 0, "message": {"role": "assistant", "content": texto}, "finish_reason": "stop"}]})
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for i in range(0, len(texto), 4): # ~1 token a cada 4 caracteres
+            self._chunk(json.dumps({**base, "object": "chat.completion.chunk", "choices": [{"index": 0, "delta": {"content": texto[i:i + 4]}, "finish_reason": None}]}, ensure_ascii=False))
+            time.sleep(1 / CONFIG["tokens_por_segundo"])
+        self._chunk(json.dumps({**base, "object": "chat.completion.chunk", "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]}))
+        if (corpo.get("stream_options") or {}).get("include_usage"):
+            self._chunk(json.dumps({**base, "object": "chat.completion.chunk", "choices": [], "usage": uso(mensagens, texto)}))
+        self._chunk("[DONE]")
+        self.wfile.write(b"0\r\n\r\n")
+
+    def _imagem(self, corpo):
+        time.sleep(CONFIG["latencia"])
+        item = {"b64_json": base64.b64encode(IMAGEM_PNG).decode()} if corpo.get("response_format") == "b64_json" else {"url": "http://127.0.0.1/imagem.png"}
+        self._json({"created": int(time.time()), "data": [{**item, "revised_prompt": corpo.get("prompt", "")}]})
+
+    def _upload(self, bruto):
+        # multipart/form-data: pega só as linhas JSON do arquivo enviado
+        linhas = [l for l in bruto.decode("utf-8", "ignore").splitlines() if l.startswith("{")]
+        id_arq = f"file-{uuid.uuid4().hex[:12]}"
+        ARQUIVOS[id_arq] = "\n".join(linhas).encode("utf-8")
+        self._json({"id": id_arq, "object": "file", "bytes": len(ARQUIVOS[id_arq]), "created_at": int(time.time()), "filename": "lote.jsonl", "purpose": "batch", "status": "processed"})
+
+    def _criar_lote(self, corpo):
+        id_lote = f"batch_{uuid.uuid4().hex[:12]}"
+        saida = []
+        for linha in ARQUIVOS.get(corpo.get("input_file_id"), b"").decode("utf-8").splitlines():
+            pedido = json.loads(linha)
+            mensagens = pedido["body"].get("messages", [])
+            texto = responder(pedido["body"])
+            saida.append(json.dumps({"id": f"req-{uuid.uuid4().hex[:8]}", "custom_id": pedido["custom_id"], "response": {"status_code": 200, "body": {
+                "object": "chat.completion", "model": pedido["body"].get("model"), "usage": uso(mensagens, texto),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": texto}, "finish_reason": "stop"}]}}}, ensure_ascii=False))
+        id_saida = f"file-{uuid.uuid4().hex[:12]}"
+        ARQUIVOS[id_saida] = "\n".join(saida).encode("utf-8")
+        with TRAVA:
+            LOTES[id_lote] = {"id": id_lote, "object": "batch", "endpoint": corpo.get("endpoint"), "input_file_id": corpo.get("input_file_id"),
+                              "completion_window": "24h", "status": "in_progress", "created_at": int(time.time()), "output_file_id": id_saida}
+        self._json(LOTES[id_lote])
+
+    def _consultar_lote(self, id_lote):
+        with TRAVA:
+            lote = LOTES.get(id_lote)
+            if not lote: return self._json({"error": {"message": "Lote não encontrado"}}, 404)
+            lote["status"] = "completed" # Conclui na primeira consulta
+        self._json(lote)
+
+# ==============================================================================
+# 3. EXECUÇÃO
+# ==============================================================================
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Servidor local que imita a API da OpenAI para o PEI 360º.")
+    parser.add_argument("--porta", type=int, default=8765)
+    parser.add_argument("--latencia", type=float, default=CONFIG["latencia"], help="Segundos até o primeiro token.")
+    parser.add_argument("--tokens-por-segundo", type=float, default=CONFIG["tokens_por_segundo"])
+    args = parser.parse_args()
+    CONFIG.update(latencia=args.latencia, tokens_por_segundo=args.tokens_por_segundo)
+    print(f"Servidor LLM local em http://127.0.0.1:{args.porta}/v1 (latência {args.latencia}s, {args.tokens_por_segundo} tokens/s)")
+    ThreadingHTTPServer(("127.0.0.1", args.porta), Handler).serve_forever()
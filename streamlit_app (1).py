@@ -2,11 +2,13 @@ import streamlit as st
 from datetime import date
 from io import BytesIO
 from docx import Document
-from docx.shared import Pt
+from docx.shared import Pt, Inches
 from openai import OpenAI
 from pypdf import PdfReader
 from fpdf import FPDF
+from PIL import Image
 import base64
+import hashlib
 import json
 import os
 import re
@@ -58,7 +60,7 @@ default_state = {
     'ia_sugestao': '', 'outros_acesso': '', 'outros_ensino': '', 
     'monitoramento_data': date.today(), 
     'status_meta': 'Não Iniciado', 'parecer_geral': 'Manter Estratégias', 'proximos_passos_select': [],
-    'dalle_image_url': ''
+    'dalle_imagem': '' # Chave (hash do prompt) da imagem salva em imagens_ia/
 }
 
 if 'dados' not in st.session_state: st.session_state.dados = default_state
@@ -66,7 +68,6 @@ else:
     for key, val in default_state.items():
         if key not in st.session_state.dados: st.session_state.dados[key] = val
 
-if 'dalle_image_url' not in st.session_state: st.session_state.dalle_image_url = ""
 if 'pdf_text' not in st.session_state: st.session_state.pdf_text = ""
 
 # ==============================================================================
@@ -311,14 +312,32 @@ def gerar_noticia_ia(api_key):
     except: return "O cérebro aprende durante toda a vida."
 
 # --- FUNÇÃO DALL-E 3 (INTEGRADA AO TEXTO) ---
-def gerar_imagem_dalle_integrada(api_key, dados_aluno, texto_estrategias):
-    if not api_key: return None, "Configure a API Key."
-    if not texto_estrategias: return None, "Texto das estratégias não encontrado."
-    try:
-        client = OpenAI(api_key=api_key)
-        hf = dados_aluno['hiperfoco'] if dados_aluno['hiperfoco'] else "aprendizado criativo"
-        
-        prompt_dalle = f"""
+# As imagens ficam no disco, endereçadas pelo hash do prompt (hiperfoco + estratégias):
+# a mesma combinação nunca é paga duas vezes e a imagem não expira como a URL temporária da OpenAI.
+PASTA_IMAGENS = "imagens_ia"
+if not os.path.exists(PASTA_IMAGENS): os.makedirs(PASTA_IMAGENS)
+TAMANHOS_IMAGEM = {"mini": 512, "pdf": 1024} # Derivados em JPEG: miniatura para a tela e versão para PDF/Word
+
+def caminho_imagem(chave, tamanho=None):
+    return os.path.join(PASTA_IMAGENS, f"{chave}.png" if not tamanho else f"{chave}_{tamanho}.jpg")
+
+def salvar_imagem_ia(png_bytes):
+    """Grava o PNG original (nome = hash do conteúdo) e os derivados em JPEG. Devolve esse hash."""
+    chave = hashlib.sha256(png_bytes).hexdigest()
+    with open(caminho_imagem(chave), 'wb') as f: f.write(png_bytes)
+    img = Image.open(BytesIO(png_bytes)).convert("RGB") # JPEG sem canal alfa: o FPDF 1.7 não lê PNG com transparência
+    for tamanho, lado in TAMANHOS_IMAGEM.items():
+        copia = img.copy(); copia.thumbnail((lado, lado))
+        copia.save(caminho_imagem(chave, tamanho), "JPEG", quality=85, optimize=True)
+    return chave
+
+def imagem_salva(chave, tamanho=None):
+    caminho = caminho_imagem(chave, tamanho) if chave else None
+    return caminho if caminho and os.path.exists(caminho) else None
+
+def montar_prompt_dalle(dados_aluno, texto_estrategias):
+    hf = dados_aluno['hiperfoco'] if dados_aluno['hiperfoco'] else "aprendizado criativo"
+    return f"""
         A creative, colorful infographic illustration of a 'Student Power Map' pinned on a corkboard.
         Title area: "MEU MAPA DE PODER".
         Theme: {hf} (use visual elements from this theme).
@@ -331,11 +350,25 @@ def gerar_imagem_dalle_integrada(api_key, dados_aluno, texto_estrategias):
         Atmosphere: Empowering, clear, fun.
         """
 
+def gerar_imagem_dalle_integrada(api_key, dados_aluno, texto_estrategias):
+    """Devolve (chave da imagem em disco, erro). Prompt repetido reaproveita a imagem sem chamar a API."""
+    if not api_key: return None, "Configure a API Key."
+    if not texto_estrategias: return None, "Texto das estratégias não encontrado."
+    prompt_dalle = montar_prompt_dalle(dados_aluno, texto_estrategias)
+    indice = os.path.join(PASTA_IMAGENS, hashlib.sha256(f"dalle-3:1024:{prompt_dalle}".encode('utf-8')).hexdigest() + ".chave")
+    try:
+        with open(indice, 'r') as f: chave = f.read().strip()
+        if imagem_salva(chave) and imagem_salva(chave, "pdf"): return chave, None
+    except: pass
+    try:
+        client = OpenAI(api_key=api_key)
         with st.spinner("🎨 A IA está desenhando o mapa com suas estratégias... (15s)"):
             response = client.images.generate(
-                model="dall-e-3", prompt=prompt_dalle, size="1024x1024", quality="standard", n=1,
+                model="dall-e-3", prompt=prompt_dalle, size="1024x1024", quality="standard", n=1, response_format="b64_json",
             )
-        return response.data[0].url, None
+        chave = salvar_imagem_ia(base64.b64decode(response.data[0].b64_json))
+        with open(indice, 'w') as f: f.write(chave)
+        return chave, None
     except Exception as e:
         return None, str(e)
 
@@ -480,6 +513,10 @@ def gerar_pdf_final(dados, tem_anexo):
             elif l.strip().endswith(':') and len(l) < 70:
                 pdf.ln(2); pdf.set_font("Arial", 'B', 10); pdf.multi_cell(0, 6, l); pdf.set_font("Arial", size=10)
             else: pdf.multi_cell(0, 6, l)
+    imagem = imagem_salva(dados.get('dalle_imagem'), "pdf")
+    if imagem:
+        pdf.add_page(); pdf.section_title("MAPA VISUAL DO ESTUDANTE")
+        pdf.image(imagem, x=35, w=140)
     return pdf.output(dest='S').encode('latin-1', 'replace')
 
 def gerar_docx_final(dados):
@@ -487,6 +524,9 @@ def gerar_docx_final(dados):
     if dados['ia_sugestao']:
         t_limpo = re.sub(r'\[.*?\]', '', dados['ia_sugestao'])
         doc.add_paragraph(t_limpo)
+    imagem = imagem_salva(dados.get('dalle_imagem'), "pdf")
+    if imagem:
+        doc.add_heading('Mapa Visual do Estudante', 1); doc.add_picture(imagem, width=Inches(5.5))
     b = BytesIO(); doc.save(b); b.seek(0); return b
 
 # ==============================================================================
@@ -857,17 +897,19 @@ with tab_mapa: # MAPA FINAL
         if st.button("✨ Criar Mapa Visual (Baseado no Texto)", type="primary", use_container_width=True):
             if texto_para_imagem and st.session_state.dados['hiperfoco']:
                 # Chama a função integrada (prompt com texto)
-                url, err = gerar_imagem_dalle_integrada(api_key, st.session_state.dados, texto_para_imagem)
-                if url:
-                    st.session_state.dalle_image_url = url
+                chave, err = gerar_imagem_dalle_integrada(api_key, st.session_state.dados, texto_para_imagem)
+                if chave:
+                    st.session_state.dados['dalle_imagem'] = chave
                     st.success("Mapa visual gerado com sucesso!")
                 else:
                     st.error(f"Erro ao gerar imagem: {err}")
             else:
                 st.warning("Certifique-se de que o plano de texto foi gerado e o Hiperfoco está definido.")
         
-        if st.session_state.dalle_image_url:
-            st.image(st.session_state.dalle_image_url, use_column_width=True, caption="Visualização das suas estratégias")
-            st.markdown(f'<a href="{st.session_state.dalle_image_url}" download="Mapa_Visual_Integrado.png" target="_blank" style="display:block; text-decoration:none; background-color:#0F52BA; color:white; padding:10px; border-radius:8px; text-align:center; margin-top:10px;">📥 Baixar Imagem do Mapa</a>', unsafe_allow_html=True)
+        miniatura = imagem_salva(st.session_state.dados['dalle_imagem'], "mini")
+        if miniatura:
+            st.image(miniatura, use_column_width=True, caption="Visualização das suas estratégias")
+            with open(caminho_imagem(st.session_state.dados['dalle_imagem']), 'rb') as f:
+                st.download_button("📥 Baixar Imagem do Mapa", f.read(), "Mapa_Visual_Integrado.png", "image/png", use_container_width=True)
 
 st.markdown("---")
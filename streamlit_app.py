@@ -2,13 +2,28 @@ import streamlit as st
 from datetime import date
 from io import BytesIO
 from docx import Document
-from openai import OpenAI
-from pypdf import PdfReader
+from openai import OpenAI, Timeout, RateLimitError, InternalServerError, APIConnectionError, APITimeoutError
+from openai.types.chat import ChatCompletion, ChatCompletionChunk
 from fpdf import FPDF
+from contexto_ia import contar_tokens, empacotar_contexto
+from fila_ia import (PRIORIDADE_INTERATIVA, PRIORIDADE_SEGUNDO_PLANO, acompanhar_voo, aguardar_vez_ia, consultar_tarefa_ia, entrar_voo,
+                     enviar_tarefa_ia, esvaziar_limitador_ia, estimar_tokens_pedido, posicao_fila_ia, resultado_voo, tarefa_do_dono)
+from lote_ia import ler_saida_lote, linha_lote, montar_jsonl
+from secoes_pei import SECOES_REGERAVEIS, encaixar_secao, localizar_secao, normalizar_bloco, secoes_presentes
+import extrator_laudo
+import leitor_pdf
+import telemetria_ia
 import base64
+import contextvars
+import copy
+import hashlib
 import json
 import os
+import random
 import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 # ==============================================================================
 # 1. CONFIGURAÇÃO INICIAL
@@ -84,6 +99,9 @@ default_state = {
     'estrategias_acesso': [], 'estrategias_ensino': [], 'estrategias_avaliacao': [], 
     'ia_sugestao': '',         # PEI TÉCNICO
     'ia_mapa_texto': '',       # ROTEIRO GAMIFICADO
+    'ia_guia_pratico': '',     # GUIA PRÁTICO (CHÃO DE SALA)
+    'laudo_digest': {}, 'laudo_hash': '', # RESUMO ESTRUTURADO DO LAUDO (1x POR ARQUIVO)
+    'ia_estrutura': {},        # METAS / BLOOM / CAMPOS DO PEI EM CAMPOS TIPADOS (MODO JSON)
     'outros_acesso': '', 'outros_ensino': '', 
     'monitoramento_data': date.today(), 
     'status_meta': 'Não Iniciado', 'parecer_geral': 'Manter Estratégias', 'proximos_passos_select': []
@@ -95,6 +113,11 @@ else:
         if key not in st.session_state.dados: st.session_state.dados[key] = val
 
 if 'pdf_text' not in st.session_state: st.session_state.pdf_text = ""
+if 'pdf_hash' not in st.session_state: st.session_state.pdf_hash = ""
+if 'pdf_resumo' not in st.session_state: st.session_state.pdf_resumo = ""
+if 'pdf_falhas' not in st.session_state: st.session_state.pdf_falhas = []
+if 'registro_aluno' not in st.session_state: st.session_state.registro_aluno = "" # Hash do backup carregado ("" = cadastro novo)
+if 'latencia_ia' not in st.session_state: st.session_state.latencia_ia = {}
 
 # ==============================================================================
 # 4. LÓGICA E UTILITÁRIOS
@@ -187,6 +210,20 @@ def extrair_campos_experiencia(texto):
     linhas = [l.strip().replace('- ','') for l in bloco.split('\n') if l.strip()]
     return linhas[:3]
 
+# Leitura direta dos campos tipados (modo JSON); as tags do texto só valem para PEIs antigos
+def metas_do_pei(dados):
+    metas = (dados.get('ia_estrutura') or {}).get('metas')
+    if metas and any(metas.values()):
+        return {"Curto": metas.get('curto') or "Definir...", "Medio": metas.get('medio') or "Definir...", "Longo": metas.get('longo') or "Definir..."}
+    return extrair_metas_estruturadas(dados['ia_sugestao'])
+
+def bloom_do_pei(dados):
+    return (dados.get('ia_estrutura') or {}).get('bloom') or extrair_bloom(dados['ia_sugestao'])
+
+def campos_do_pei(dados):
+    campos = (dados.get('ia_estrutura') or {}).get('campos_experiencia')
+    return campos[:3] if campos else extrair_campos_experiencia(dados['ia_sugestao'])
+
 def get_pro_icon(nome_profissional):
     p = nome_profissional.lower()
     if "psic" in p: return "🧠"
@@ -205,23 +242,50 @@ def get_base64_image(image_path):
     if not image_path: return ""
     with open(image_path, "rb") as img_file: return base64.b64encode(img_file.read()).decode()
 
-def ler_pdf(arquivo):
-    try:
-        reader = PdfReader(arquivo); texto = ""
-        for i, page in enumerate(reader.pages):
-            if i >= 6: break 
-            texto += page.extract_text() + "\n"
-        return texto
-    except: return ""
+PAGINAS_MAX_LAUDO = 80 # Só um limite de segurança: a escolha do que vai para a IA é por relevância
+ORCAMENTO_PAGINAS_LAUDO = 3000 # Tokens das páginas mais relevantes (o digest vê tudo isso)
+
+def ler_laudos(arquivos):
+    """
+    Vários PDFs do mesmo aluno -> (texto único para a IA, hash desse texto, resumo para a tela, nomes dos ilegíveis).
+    Cache por hash, extração em paralelo, limpeza de timbre/rodapé, páginas repetidas entre laudos
+    e seleção por relevância dentro de ORCAMENTO_PAGINAS_LAUDO: ver leitor_pdf.py
+    Um arquivo truncado ou corrompido fica de fora sem derrubar os outros.
+    """
+    conteudos = [a.getvalue() for a in arquivos]
+    hashes = [leitor_pdf.hash_conteudo(c) for c in conteudos]
+    extraidos = leitor_pdf.paginas_por_arquivo(conteudos, PAGINAS_MAX_LAUDO, hashes)
+    falhas = [a.name for a, paginas in zip(arquivos, extraidos) if paginas is None]
+    lidos = [(a, leitor_pdf.limpar_paginas(paginas)) for a, paginas in zip(arquivos, extraidos) if paginas is not None]
+    if not lidos: return "", "", "", falhas
+    arquivos, documentos = [a for a, _ in lidos], [d for _, d in lidos]
+    mantidas = leitor_pdf.deduplicar_paginas(documentos)
+    orcamento = ORCAMENTO_PAGINAS_LAUDO - 15 * len(arquivos) # Rótulos dos documentos
+    selecao = leitor_pdf.selecionar_paginas([documentos[d][p] for d, p in mantidas], orcamento, lambda t: contar_tokens(t) + 6)
+    escolhidas = {mantidas[i]: texto for i, texto in selecao.items()} # A página mais relevante pode vir cortada
+    rotular = len(arquivos) > 1 or len(escolhidas) < len(mantidas)
+    partes = []
+    for d, arquivo in enumerate(arquivos):
+        paginas = [(f"[Página {p + 1}]\n" if rotular else "") + escolhidas[(d, p)] + "\n" for p in range(len(documentos[d])) if (d, p) in escolhidas]
+        if paginas: partes.append((f"=== LAUDO: {arquivo.name} ===\n" if len(arquivos) > 1 else "") + "".join(paginas))
+    texto = "\n".join(partes)
+    # Hash do texto que vai para a IA, não dos arquivos: mudar a limpeza ou a seleção de páginas invalida o digest
+    hash_texto = hashlib.sha256(texto.encode('utf-8')).hexdigest()
+    total = sum(len(d) for d in documentos)
+    resumo = f"{len(arquivos)} laudo(s), {total} páginas: {total - len(mantidas)} repetidas ou vazias descartadas, {len(escolhidas)} enviadas à IA."
+    return texto, hash_texto, resumo, falhas
 
 def limpar_texto_pdf(texto):
     if not texto: return ""
     t = texto.replace('**', '').replace('__', '').replace('#', '')
     return t.encode('latin-1', 'ignore').decode('latin-1')
 
+def nome_arquivo_aluno(nome):
+    return re.sub(r'[^a-zA-Z0-9]', '_', nome.lower()) + ".json"
+
 def salvar_aluno(dados):
     if not dados['nome']: return False, "Nome obrigatório."
-    nome_arq = re.sub(r'[^a-zA-Z0-9]', '_', dados['nome'].lower()) + ".json"
+    nome_arq = nome_arquivo_aluno(dados['nome'])
     try:
         with open(os.path.join(PASTA_BANCO, nome_arq), 'w', encoding='utf-8') as f:
             json.dump(dados, f, default=str, ensure_ascii=False, indent=4)
@@ -229,12 +293,162 @@ def salvar_aluno(dados):
     except Exception as e: return False, str(e)
 
 def carregar_aluno(nome_arq):
-    return None
+    try:
+        with open(os.path.join(PASTA_BANCO, nome_arq), 'r', encoding='utf-8') as f: d = json.load(f)
+        if 'nasc' in d: d['nasc'] = date.fromisoformat(d['nasc'])
+        if d.get('monitoramento_data'): d['monitoramento_data'] = date.fromisoformat(d['monitoramento_data'])
+        return d
+    except: return None
+
+def listar_alunos():
+    try: return sorted(f for f in os.listdir(PASTA_BANCO) if f.endswith(".json"))
+    except: return []
+
+def atualizar_registro_aluno(nome_arq, campos):
+    # Altera só os campos indicados, preservando o restante do arquivo salvo
+    caminho = os.path.join(PASTA_BANCO, nome_arq)
+    try:
+        with open(caminho, 'r', encoding='utf-8') as f: d = json.load(f)
+        d.update(campos)
+        with open(caminho, 'w', encoding='utf-8') as f:
+            json.dump(d, f, default=str, ensure_ascii=False, indent=4)
+        return True
+    except: return False
 
 def excluir_aluno(nome_arq):
     try: os.remove(os.path.join(PASTA_BANCO, nome_arq)); return True
     except: return False
 
+# --- PEIs SEMELHANTES: ÍNDICE OFFLINE DE PERFIS EM BITSETS ---
+# Cada registro vira um inteiro por grupo (bit = item do vocabulário fixo das listas acima).
+# Níveis ordenados (alfabetização, suporte) usam bits acumulados: níveis vizinhos se parecem mais que distantes.
+ARQUIVO_INDICE_SEMELHANTES = "indice_semelhantes.json" # Fora do banco_alunos/ para não aparecer como estudante
+NIVEIS_SUPORTE = ["Autônomo", "Monitorado", "Substancial", "Muito Substancial"]
+ITENS_BARREIRAS = [(area, item) for area, itens in LISTAS_BARREIRAS.items() for item in itens]
+SEGMENTOS = ["EI", "FI", "FII", "EM", "INDEFINIDO"]
+PESOS_SEMELHANCA = {"barreiras": 0.45, "suporte": 0.2, "potencias": 0.15, "segmento": 0.1, "alfabetizacao": 0.1}
+SEMELHANCA_MINIMA = 0.35
+
+def _bits(posicoes):
+    return sum(1 << p for p in set(posicoes))
+
+def perfil_em_bits(dados):
+    selecionadas = dados.get('barreiras_selecionadas') or {}
+    niveis = dados.get('niveis_suporte') or {}
+    barreiras, suporte = [], []
+    for i, (area, item) in enumerate(ITENS_BARREIRAS):
+        if item not in selecionadas.get(area, []): continue
+        barreiras.append(i)
+        nivel = niveis.get(f"{area}_{item}", "Monitorado")
+        if nivel in NIVEIS_SUPORTE: suporte += [i * len(NIVEIS_SUPORTE) + n for n in range(NIVEIS_SUPORTE.index(nivel) + 1)]
+    alf = dados.get('nivel_alfabetizacao')
+    return {
+        "barreiras": _bits(barreiras),
+        "suporte": _bits(suporte),
+        "potencias": _bits(LISTA_POTENCIAS.index(p) for p in dados.get('potencias') or [] if p in LISTA_POTENCIAS),
+        "segmento": _bits([SEGMENTOS.index(detectar_nivel_ensino(dados.get('serie') or ""))]),
+        "alfabetizacao": _bits(range(LISTA_ALFABETIZACAO.index(alf) + 1)) if alf in LISTA_ALFABETIZACAO else 0,
+    }
+
+def semelhanca_perfis(a, b):
+    """Jaccard ponderado por grupo (0 a 1). Grupo vazio nos dois lados conta como igual."""
+    total = 0.0
+    for grupo, peso in PESOS_SEMELHANCA.items():
+        uniao = (a[grupo] | b[grupo]).bit_count()
+        total += peso * ((a[grupo] & b[grupo]).bit_count() / uniao if uniao else 1.0)
+    return total
+
+@st.cache_resource(show_spinner=False)
+def _indice_semelhantes():
+    try:
+        with open(ARQUIVO_INDICE_SEMELHANTES, 'r', encoding='utf-8') as f: entradas = json.load(f)
+    except: entradas = {}
+    return {"entradas": entradas, "trava": threading.Lock()}
+
+def atualizar_indice_semelhantes():
+    """Relê só os registros alterados desde a última vez (mtime) e grava o índice em disco."""
+    indice = _indice_semelhantes()
+    with indice['trava']:
+        entradas, mudou = indice['entradas'], False
+        arquivos = {}
+        for nome_arq in listar_alunos():
+            try: arquivos[nome_arq] = os.path.getmtime(os.path.join(PASTA_BANCO, nome_arq))
+            except: pass
+        for nome_arq in set(entradas) - set(arquivos):
+            del entradas[nome_arq]; mudou = True
+        for nome_arq, mtime in arquivos.items():
+            if nome_arq in entradas and entradas[nome_arq]['mtime'] == mtime: continue
+            try:
+                with open(os.path.join(PASTA_BANCO, nome_arq), 'r', encoding='utf-8') as f: d = json.load(f)
+            except: continue
+            entradas[nome_arq] = {"mtime": mtime, "nome": d.get('nome', ""), "serie": d.get('serie', ""),
+                                  "concluido": bool(d.get('ia_sugestao')), "bits": perfil_em_bits(d)}
+            mudou = True
+        if mudou:
+            try:
+                with open(ARQUIVO_INDICE_SEMELHANTES, 'w', encoding='utf-8') as f: json.dump(entradas, f, ensure_ascii=False)
+            except: pass
+        return entradas
+
+def _chave_perfil(dados):
+    # A aba Consultoria roda a cada tecla: a busca fica em cache pelo perfil (bits) e pelo próprio estudante
+    return tuple(sorted(perfil_em_bits(dados).items())), (nome_arquivo_aluno(dados['nome']) if dados.get('nome') else None)
+
+@st.cache_data(ttl=60, show_spinner=False) # Registros novos entram no máximo 1 min depois
+def _semelhantes_por_perfil(perfil, proprio, k, minima):
+    perfil = dict(perfil)
+    candidatos = [(semelhanca_perfis(perfil, e['bits']), nome_arq, e) for nome_arq, e in atualizar_indice_semelhantes().items()
+                  if e['concluido'] and nome_arq != proprio]
+    melhores = sorted((c for c in candidatos if c[0] >= minima), key=lambda c: -c[0])[:k]
+    return [{"arquivo": nome_arq, "nome": e['nome'], "serie": e['serie'], "semelhanca": round(sim, 3)} for sim, nome_arq, e in melhores]
+
+def buscar_peis_semelhantes(dados, k=3, minima=SEMELHANCA_MINIMA):
+    """Top-k registros com PEI pronto mais parecidos com o perfil atual (exclui o próprio estudante)."""
+    return _semelhantes_por_perfil(*_chave_perfil(dados), k, minima)
+
+def referencias_semelhantes(dados, k=2):
+    """Few-shot compacto para o prompt: metas e Bloom dos PEIs mais parecidos, sem nomes."""
+    return _referencias_por_perfil(*_chave_perfil(dados), k)
+
+@st.cache_data(ttl=60, show_spinner=False)
+def _referencias_por_perfil(perfil, proprio, k):
+    linhas = []
+    for r in _semelhantes_por_perfil(perfil, proprio, k, SEMELHANCA_MINIMA):
+        ref = carregar_aluno(r['arquivo'])
+        if not ref or not ref.get('ia_sugestao'): continue
+        ref = {**default_state, **ref}
+        metas = {k: v for k, v in (metas_do_pei(ref) or {}).items() if v not in ("Definir...", "...")}
+        barreiras = ", ".join(i for itens in ref['barreiras_selecionadas'].values() for i in itens)
+        linhas.append(f"- Perfil {detectar_nivel_ensino(ref['serie'])} ({r['semelhanca']:.0%} semelhante; barreiras: {barreiras or 'nenhuma'}). "
+                      f"Metas: {'; '.join(f'{k.lower()}: {v}' for k, v in metas.items()) or 'não extraídas'}. Bloom: {', '.join(bloom_do_pei(ref))}.")
+    return "\n".join(linhas)
+
+# Só metas e objetivos entram no rascunho. Perfil narrativo (família, histórico), análise farmacológica e o
+# texto livre do outro estudante são dados de saúde de terceiros (LGPD): nunca são copiados.
+SECOES_RASCUNHO = ["Campos de Experiência", "Direitos de Aprendizagem", "Objetivos de Desenvolvimento", "Mapeamento BNCC", "Taxonomia de Bloom", "Metas SMART"]
+ESTRATEGIAS_RASCUNHO = {"estrategias_acesso": "Acesso", "estrategias_ensino": "Ensino", "estrategias_avaliacao": "Avaliação"}
+
+def rascunho_pei_semelhante(dados, nome_arq):
+    """Ponto de partida a partir de um perfil parecido: blocos de metas/objetivos do PEI e as estratégias marcadas no registro."""
+    ref = carregar_aluno(nome_arq)
+    if not ref or not ref.get('ia_sugestao'): return None, None
+    texto_ref, blocos = ref['ia_sugestao'], []
+    for secao in SECOES_RASCUNHO:
+        pos = localizar_secao(texto_ref, secao)
+        if pos: blocos.append((pos[0], texto_ref[pos[0]:pos[1]]))
+    estrategias = [f"- **{rotulo}:** {', '.join(ref[campo])}" for campo, rotulo in ESTRATEGIAS_RASCUNHO.items() if ref.get(campo)]
+    if estrategias: blocos.append((len(texto_ref), "🧩 ESTRATÉGIAS USADAS NO PERFIL SEMELHANTE:\n" + "\n".join(estrategias)))
+    if not blocos: return None, None
+    estrutura = {k: v for k, v in (ref.get('ia_estrutura') or {}).items() if k in ('metas', 'bloom', 'campos_experiencia')}
+    # Nome e sobrenomes do outro estudante, se aparecerem dentro das metas, viram o primeiro nome do atual
+    nome_atual = ((dados.get('nome') or "").split() or ["o estudante"])[0]
+    partes_nome = [re.escape(p) for p in (ref.get('nome') or "").split() if len(p) > 2]
+    trocar = (lambda t: re.sub(fr'\b({"|".join(partes_nome)})(\s+({"|".join(partes_nome)}))*\b', nome_atual, t)) if partes_nome else (lambda t: t)
+    texto = trocar("\n\n".join(b for _, b in sorted(blocos)))
+    estrutura = json.loads(trocar(json.dumps(estrutura, ensure_ascii=False)))
+    aviso = "> ⚠️ **Rascunho** com as metas e estratégias de um estudante com perfil semelhante (sem dados pessoais ou clínicos dele). Complete e revise tudo antes de usar.\n\n"
+    return aviso + texto, estrutura
+
 def calcular_progresso():
     if st.session_state.dados['ia_sugestao']: return 100
     pontos = 0; total = 7
@@ -431,287 +645,1134 @@ aplicar_estilo_visual()
 # 6. INTELIGÊNCIA ARTIFICIAL (TÉCNICA, GAMIFICADA & EXTRAÇÃO)
 # ==============================================================================
 
-# CÉREBRO 0: EXTRATOR DE DADOS (PDF -> FORMULÁRIO)
-def extrair_dados_pdf_ia(api_key, texto_pdf):
+# --- CACHE EM DISCO DAS RESPOSTAS (COMPARTILHADO ENTRE SESSÕES) ---
+PASTA_CACHE_IA = "cache_ia"
+CACHE_IA_TTL = 7 * 24 * 3600         # Validade de cada resposta (segundos)
+CACHE_IA_MAX_BYTES = 50 * 1024 * 1024 # Acima disso remove as menos usadas (LRU)
+if not os.path.exists(PASTA_CACHE_IA): os.makedirs(PASTA_CACHE_IA)
+
+def normalizar_prompt(texto):
+    # Indentação e linhas vazias das f-strings não mudam a resposta
+    return "\n".join(l.strip() for l in (texto or "").splitlines() if l.strip())
+
+def chave_cache_ia(prompt_sys, prompt_user, modelo, modo):
+    bruto = json.dumps([normalizar_prompt(prompt_sys), normalizar_prompt(prompt_user), modelo, modo], ensure_ascii=False)
+    return hashlib.sha256(bruto.encode('utf-8')).hexdigest()
+
+def ler_cache_ia(chave):
+    caminho = os.path.join(PASTA_CACHE_IA, f"{chave}.json")
+    try:
+        with open(caminho, 'r', encoding='utf-8') as f: item = json.load(f)
+        if time.time() - item['criado_em'] > CACHE_IA_TTL:
+            os.remove(caminho); return None
+        os.utime(caminho, None) # Marca como usado recentemente (LRU)
+        return item['texto']
+    except: return None
+
+def gravar_cache_ia(chave, texto):
+    caminho = os.path.join(PASTA_CACHE_IA, f"{chave}.json")
+    tmp = f"{caminho}.{os.getpid()}.tmp"
+    try:
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump({"criado_em": time.time(), "texto": texto}, f, ensure_ascii=False)
+        os.replace(tmp, caminho) # Escrita atômica: outra sessão nunca lê arquivo pela metade
+        podar_cache_ia()
+    except: pass
+
+def podar_cache_ia():
+    try:
+        arquivos = []
+        for nome in os.listdir(PASTA_CACHE_IA):
+            if not re.fullmatch(r'[0-9a-f]{64}\.json', nome): continue
+            st_arq = os.stat(os.path.join(PASTA_CACHE_IA, nome))
+            arquivos.append((st_arq.st_mtime, st_arq.st_size, nome))
+        total = sum(a[1] for a in arquivos)
+        for _, tamanho, nome in sorted(arquivos):
+            if total <= CACHE_IA_MAX_BYTES: break
+            try: os.remove(os.path.join(PASTA_CACHE_IA, nome)); total -= tamanho
+            except: pass
+    except: pass
+
+# --- CLIENTE OPENAI COMPARTILHADO (POOL, TIMEOUTS E RETENTATIVAS) ---
+IA_TIMEOUT_CONEXAO = float(os.environ.get("PEI_IA_TIMEOUT_CONEXAO", 5))
+IA_TIMEOUT_LEITURA = float(os.environ.get("PEI_IA_TIMEOUT_LEITURA", 90))
+IA_MAX_TENTATIVAS = int(os.environ.get("PEI_IA_MAX_TENTATIVAS", 4))
+IA_BACKOFF_BASE = float(os.environ.get("PEI_IA_BACKOFF_BASE", 1.0))
+IA_BACKOFF_MAX = float(os.environ.get("PEI_IA_BACKOFF_MAX", 20.0))
+ERROS_TRANSITORIOS_IA = (RateLimitError, InternalServerError, APIConnectionError) # 429, 5xx, timeout/rede
+
+def _timeout_ia():
+    return Timeout(IA_TIMEOUT_LEITURA, connect=IA_TIMEOUT_CONEXAO)
+
+@st.cache_resource(show_spinner=False)
+def get_cliente_openai(api_key):
+    # Um cliente por chave para todo o processo: reaproveita conexões keep-alive (sem novo handshake TLS).
+    # Retentativas ficam por nossa conta (max_retries=0) para não multiplicar com as do SDK.
+    return OpenAI(api_key=api_key, timeout=_timeout_ia(), max_retries=0)
+
+def espera_backoff(tentativa, erro=None):
+    retry_after = None
+    resposta = getattr(erro, 'response', None)
+    if resposta is not None:
+        try: retry_after = float(resposta.headers.get("retry-after"))
+        except: retry_after = None
+    if retry_after is not None: return min(retry_after, IA_BACKOFF_MAX)
+    # Exponencial com "full jitter": evita que várias sessões repitam juntas
+    return random.uniform(0, min(IA_BACKOFF_MAX, IA_BACKOFF_BASE * (2 ** tentativa)))
+
+# --- BACKEND PLUGÁVEL: GRAVAR / REPRODUZIR RESPOSTAS (TESTES E BENCHMARK SEM OPENAI) ---
+# PEI_LLM_MODO=real (padrão) | gravar (chama a API e salva cada resposta) | reproduzir (só lê as gravações)
+LLM_MODO = os.environ.get("PEI_LLM_MODO", "real")
+PASTA_FIXTURES_LLM = os.environ.get("PEI_LLM_FIXTURES", "fixtures_llm")
+
+def _caminho_fixture(kwargs):
+    pedido = json.dumps(kwargs, sort_keys=True, ensure_ascii=False, default=str)
+    return os.path.join(PASTA_FIXTURES_LLM, hashlib.sha256(pedido.encode('utf-8')).hexdigest() + ".json")
+
+def _salvar_fixture(kwargs, resposta):
+    os.makedirs(PASTA_FIXTURES_LLM, exist_ok=True)
+    with open(_caminho_fixture(kwargs), 'w', encoding='utf-8') as f:
+        json.dump({"pedido": kwargs, "resposta": resposta}, f, ensure_ascii=False, indent=1, default=str)
+
+def _stream_gravado(kwargs, stream):
+    pedacos = []
+    for chunk in stream:
+        pedacos.append(chunk.model_dump()); yield chunk
+    _salvar_fixture(kwargs, pedacos) # Só grava streams que chegaram ao fim
+
+def _gravar_se_preciso(kwargs, res):
+    if LLM_MODO != "gravar": return res
+    if kwargs.get('stream'): return _stream_gravado(kwargs, res)
+    _salvar_fixture(kwargs, res.model_dump())
+    return res
+
+def reproduzir_fixture(kwargs):
+    caminho = _caminho_fixture(kwargs)
+    if not os.path.exists(caminho):
+        raise RuntimeError(f"Resposta gravada não encontrada para este pedido ({os.path.basename(caminho)}). Rode antes com PEI_LLM_MODO=gravar.")
+    with open(caminho, 'r', encoding='utf-8') as f: resposta = json.load(f)['resposta']
+    if kwargs.get('stream'): return iter([ChatCompletionChunk.model_validate(c) for c in resposta])
+    return ChatCompletion.model_validate(resposta)
+
+def _desistir(tentativa, erro, repetir_timeout):
+    # Com fallback configurado, timeout não é repetido no mesmo modelo: vai direto para o próximo
+    return tentativa == IA_MAX_TENTATIVAS - 1 or (not repetir_timeout and isinstance(erro, APITimeoutError))
+
+def criar_completion(client, repetir_timeout=True, prioridade=PRIORIDADE_INTERATIVA, info=None, **kwargs):
+    """info (opcional) acumula em 'espera_fila' o tempo parado no limitador."""
+    if LLM_MODO == "reproduzir": return reproduzir_fixture(kwargs)
+    tokens, info = estimar_tokens_pedido(kwargs), ({} if info is None else info)
+    for tentativa in range(IA_MAX_TENTATIVAS):
+        espera = time.time(); aguardar_vez_ia(tokens, prioridade)
+        info['espera_fila'] = info.get('espera_fila', 0.0) + time.time() - espera
+        try: return _gravar_se_preciso(kwargs, client.chat.completions.create(**kwargs))
+        except ERROS_TRANSITORIOS_IA as e:
+            if isinstance(e, RateLimitError): esvaziar_limitador_ia()
+            if _desistir(tentativa, e, repetir_timeout): raise
+            time.sleep(espera_backoff(tentativa, e))
+
+# --- ROTEAMENTO DE MODELOS POR TAREFA (MODELO, LIMITES, FALLBACK E CONTABILIDADE) ---
+# tarefa -> modelo, max_tokens, temperatura (None = padrão da API), timeout em segundos (None = o do cliente)
+# e fallback mais barato/rápido usado quando o principal estoura o timeout. Tarefas sem "prioridade" são interativas.
+# Ajuste sem mexer no código: PEI_ROTAS_IA='{"pei_tecnico": {"modelo": "gpt-4o", "fallback": "gpt-4o-mini"}}'
+ROTAS_IA = {
+    "pei_tecnico":  {"modelo": "gpt-4o-mini", "max_tokens": 4000, "temperatura": None, "timeout": 60,   "fallback": "gpt-4.1-nano"},
+    "guia_pratico": {"modelo": "gpt-4o-mini", "max_tokens": 2500, "temperatura": None, "timeout": 60,   "fallback": "gpt-4.1-nano"},
+    "secao_pei":    {"modelo": "gpt-4o-mini", "max_tokens": 800,  "temperatura": None, "timeout": 30,   "fallback": "gpt-4.1-nano"},
+    "roteiro":      {"modelo": "gpt-4o-mini", "max_tokens": 1500, "temperatura": None, "timeout": 30,   "fallback": "gpt-4.1-nano"},
+    "roteiro_antecipado": {"modelo": "gpt-4o-mini", "max_tokens": 1500, "temperatura": None, "timeout": 30, "fallback": "gpt-4.1-nano", "prioridade": PRIORIDADE_SEGUNDO_PLANO},
+    "digest_laudo": {"modelo": "gpt-4o-mini", "max_tokens": 1200, "temperatura": 0.0,  "timeout": None, "fallback": None},
+    "feed_inicio":  {"modelo": "gpt-4o-mini", "max_tokens": 2000, "temperatura": 0.9,  "timeout": None, "fallback": None, "prioridade": PRIORIDADE_SEGUNDO_PLANO},
+}
+try:
+    for _tarefa, _ajuste in json.loads(os.environ.get("PEI_ROTAS_IA", "{}")).items():
+        ROTAS_IA[_tarefa] = {**ROTAS_IA.get(_tarefa, ROTAS_IA["pei_tecnico"]), **_ajuste}
+except: pass
+
+# US$ por 1 milhão de tokens (entrada, entrada em cache, saída), só para a estimativa de custo
+PRECOS_MODELOS = {"gpt-4o-mini": (0.15, 0.075, 0.60), "gpt-4o": (2.50, 1.25, 10.00), "gpt-4.1": (2.00, 0.50, 8.00), "gpt-4.1-mini": (0.40, 0.10, 1.60), "gpt-4.1-nano": (0.10, 0.025, 0.40)}
+
+def parametros_rota(tarefa, modelo=None):
+    """Parâmetros do corpo da requisição (servem também para o Batch API)."""
+    rota = ROTAS_IA[tarefa]
+    parametros = {"model": modelo or rota['modelo']}
+    if rota.get('max_tokens'): parametros['max_tokens'] = rota['max_tokens']
+    if rota.get('temperatura') is not None: parametros['temperature'] = rota['temperatura']
+    return parametros
+
+def modelos_rota(tarefa):
+    rota = ROTAS_IA[tarefa]
+    return [rota['modelo']] + ([rota['fallback']] if rota.get('fallback') and rota['fallback'] != rota['modelo'] else [])
+
+def custo_estimado(modelo, tokens_entrada, tokens_saida, tokens_cache=0):
+    prefixos = [m for m in PRECOS_MODELOS if (modelo or "").startswith(m)]
+    if not prefixos: return None
+    entrada, entrada_cache, saida = PRECOS_MODELOS[max(prefixos, key=len)] # gpt-4o-mini-2024-07-18 -> gpt-4o-mini
+    return ((tokens_entrada - tokens_cache) * entrada + tokens_cache * entrada_cache + tokens_saida * saida) / 1e6
+
+def tokens_em_cache(uso):
+    # Parte do prompt servida pelo cache de prompt da OpenAI (prefixo idêntico a uma chamada recente)
+    return getattr(getattr(uso, 'prompt_tokens_details', None), 'cached_tokens', 0) or 0
+
+def registrar_uso_ia(tarefa, modelo, segundos, uso=None, fallback=False, ttft=None, espera_fila=0.0, erro=None):
+    """Uma linha na telemetria local (telemetria_ia.py) por chamada real à API, com sucesso ou erro."""
+    entrada, saida, cache = (getattr(uso, 'prompt_tokens', 0) or 0), (getattr(uso, 'completion_tokens', 0) or 0), tokens_em_cache(uso)
+    telemetria_ia.registrar_chamada(tarefa, modelo, entrada, saida, latencia=segundos, ttft=ttft, espera_fila=espera_fila,
+                                    erro=erro, fallback=fallback, custo=custo_estimado(modelo, entrada, saida, cache) or 0.0, tokens_cache=cache)
+
+def registrar_acerto_cache_ia(tarefa):
+    telemetria_ia.registrar_chamada(tarefa, cache="hit", latencia=0.0)
+
+@st.cache_data(ttl=60, show_spinner=False) # O expander da sidebar roda a cada rerun, mesmo fechado
+def resumo_uso_ia(horas=24):
+    return telemetria_ia.resumir(telemetria_ia.ler_chamadas(time.time() - horas * 3600))
+
+def _opcoes_rota(tarefa):
+    # Opções locais da chamada (não vão no corpo da requisição)
+    rota = ROTAS_IA[tarefa]
+    opcoes = {"prioridade": rota.get('prioridade', PRIORIDADE_INTERATIVA)}
+    if rota.get('timeout'): opcoes['timeout'] = rota['timeout']
+    return opcoes
+
+def criar_completion_rota(client, tarefa, info=None, **kwargs):
+    """
+    criar_completion com os parâmetros da rota; se o modelo principal estourar o tempo, tenta o fallback.
+    info (opcional) recebe o modelo usado e se houve fallback.
+    """
+    modelos, inicio = modelos_rota(tarefa), time.time() # Latência inclui a tentativa que estourou o tempo
+    info = {} if info is None else info
+    for i, modelo in enumerate(modelos):
+        ultimo, tentativa = i == len(modelos) - 1, time.time()
+        try: res = criar_completion(client, repetir_timeout=ultimo, info=info, **parametros_rota(tarefa, modelo), **_opcoes_rota(tarefa), **kwargs)
+        except Exception as e:
+            registrar_uso_ia(tarefa, modelo, time.time() - tentativa, fallback=i > 0, espera_fila=info.get('espera_fila', 0.0), erro=type(e).__name__)
+            if ultimo or not isinstance(e, APITimeoutError): raise
+            continue
+        info.update(modelo=modelo, fallback=i > 0)
+        # Streams são contabilizados por transmitir_resposta_ia, quando terminam
+        if not kwargs.get('stream'): registrar_uso_ia(tarefa, res.model or modelo, time.time() - inicio, res.usage, fallback=i > 0, espera_fila=info.get('espera_fila', 0.0))
+        return res
+
+# DIGEST DO LAUDO: UM RESUMO ESTRUTURADO POR ARQUIVO, REAPROVEITADO EM TODAS AS CHAMADAS
+VERSAO_DIGEST_LAUDO = 3 # Subir ao mudar o prompt ou o empacotamento do digest (o hash já cobre o texto do laudo)
+
+def chave_digest_laudo(hash_pdf):
+    return hashlib.sha256(f"digest-v{VERSAO_DIGEST_LAUDO}:{hash_pdf}".encode('utf-8')).hexdigest()
+
+def digest_laudo_em_cache(hash_pdf):
+    try: return json.loads(ler_cache_ia(chave_digest_laudo(hash_pdf)) or "null")
+    except: return None
+
+def gerar_digest_laudo(api_key, texto_pdf, hash_pdf=None):
     if not api_key: return None, "Configure a Chave API."
+    if not texto_pdf: return None, "Laudo sem texto."
+    hash_pdf = hash_pdf or hashlib.sha256(texto_pdf.encode('utf-8')).hexdigest()
+    chave = chave_digest_laudo(hash_pdf)
+    em_cache = ler_cache_ia(chave)
+    if em_cache:
+        registrar_acerto_cache_ia("digest_laudo"); return json.loads(em_cache), None
     try:
-        client = OpenAI(api_key=api_key)
+        client = get_cliente_openai(api_key)
         prompt = f"""
-        Analise o texto deste laudo médico/escolar e extraia:
-        1. A hipótese diagnóstica ou diagnóstico (CID se houver).
-        2. Medicamentos mencionados (nome e posologia).
+        Analise o texto deste laudo médico/escolar e produza um resumo estruturado e enxuto.
+        Use frases curtas. Não invente nada que não esteja no texto.
         
         Retorne APENAS um JSON neste formato:
         {{
-            "diagnostico": "Texto do diagnóstico",
+            "diagnostico": "Hipótese diagnóstica ou diagnóstico",
+            "cids": ["F84.0"],
             "medicamentos": [
                 {{"nome": "Nome do remédio", "posologia": "Dosagem"}}
-            ]
+            ],
+            "recomendacoes_clinicas": ["Recomendação dos especialistas para a escola"],
+            "observacoes_funcionais": ["Como o estudante funciona: atenção, linguagem, motor, social..."]
         }}
         
         Texto do Laudo:
-        {texto_pdf[:4000]}
+        {empacotar_contexto([("laudo", texto_pdf, 1, ORCAMENTO_LAUDO_DIGEST)], ORCAMENTO_LAUDO_DIGEST)["laudo"]}
         """
         
-        res = client.chat.completions.create(
-            model="gpt-4o-mini", 
+        res = criar_completion_rota(
+            client, "digest_laudo",
             messages=[{"role": "user", "content": prompt}],
             response_format={"type": "json_object"}
         )
-        return json.loads(res.choices[0].message.content), None
+        digest = json.loads(res.choices[0].message.content)
+        gravar_cache_ia(chave, json.dumps(digest, ensure_ascii=False))
+        return digest, None
     except Exception as e: return None, str(e)
 
+def formatar_digest_laudo(digest):
+    if not digest: return ""
+    linhas = []
+    if digest.get('diagnostico'): linhas.append(f"Diagnóstico: {digest['diagnostico']}")
+    if digest.get('cids'): linhas.append(f"CID: {', '.join(digest['cids'])}")
+    for m in digest.get('medicamentos') or []: linhas.append(f"Medicação: {m.get('nome', '')} {m.get('posologia', '')}".strip())
+    for r in digest.get('recomendacoes_clinicas') or []: linhas.append(f"Recomendação clínica: {r}")
+    for o in digest.get('observacoes_funcionais') or []: linhas.append(f"Observação funcional: {o}")
+    return "\n".join(linhas)
+
+def preparar_contexto_laudo(api_key, dados, texto_pdf, hash_pdf):
+    """Garante o digest do PDF atual (uma chamada por arquivo) e devolve o texto a enviar nos prompts."""
+    if texto_pdf and hash_pdf and (dados.get('laudo_hash') != hash_pdf or not dados.get('laudo_digest')):
+        digest, _ = gerar_digest_laudo(api_key, texto_pdf, hash_pdf)
+        if not digest: return texto_pdf # Sem digest, o empacotador ainda limita o texto bruto
+        dados['laudo_digest'] = digest; dados['laudo_hash'] = hash_pdf
+    if dados.get('laudo_digest'): return formatar_digest_laudo(dados['laudo_digest'])
+    return texto_pdf
+
+def com_contexto_laudo(funcao):
+    """
+    Embrulha uma geração funcao(api_key, dados, contexto_pdf, ...) para receber (texto_pdf, hash_pdf) no lugar
+    do contexto: o digest (que pode chamar a IA) é feito dentro da tarefa em segundo plano, não no script.
+    """
+    def gerar(api_key, dados, laudo, *args, **kwargs):
+        return funcao(api_key, dados, preparar_contexto_laudo(api_key, dados, *laudo), *args, **kwargs)
+    return gerar
 
-# CÉREBRO 1: O PEDAGOGO TÉCNICO (CONSULTORIA IA)
-@st.cache_data(ttl=3600)
-def gerar_saudacao_ia(api_key):
-    if not api_key: return "Bem-vindo ao PEI 360º."
+def laudo_sessao():
+    return st.session_state.pdf_text, st.session_state.pdf_hash
+
+def guardar_digest_sessao():
+    # O digest foi feito dentro da tarefa (sobre uma cópia dos dados): copia do cache para o registro do aluno, sem chamar a IA
+    dados, hash_pdf = st.session_state.dados, st.session_state.pdf_hash
+    if hash_pdf and (dados.get('laudo_hash') != hash_pdf or not dados.get('laudo_digest')):
+        digest = digest_laudo_em_cache(hash_pdf)
+        if digest: dados['laudo_digest'], dados['laudo_hash'] = digest, hash_pdf
+
+# CÉREBRO 0: EXTRATOR DE DADOS (PDF -> FORMULÁRIO)
+def extrair_dados_pdf_ia(api_key, texto_pdf, hash_pdf=None):
+    # Reaproveita o digest: se ele já existe para este arquivo, não há chamada nova
+    digest, err = gerar_digest_laudo(api_key, texto_pdf, hash_pdf)
+    if not digest: return None, err
+    diagnostico = digest.get("diagnostico", "")
+    if digest.get("cids") and not any(c in diagnostico for c in digest["cids"]):
+        diagnostico = f"{diagnostico} (CID {', '.join(digest['cids'])})".strip()
+    return {"diagnostico": diagnostico, "medicamentos": digest.get("medicamentos") or []}, None
+
+def aplicar_dados_laudo(api_key, dados_extraidos):
+    local = dados_extraidos.get("origem") == "local"
+    if not local: guardar_digest_sessao()
+    # Preenche Diagnóstico
+    if dados_extraidos.get("diagnostico"):
+        st.session_state.dados['diagnostico'] = dados_extraidos["diagnostico"]
+    
+    # Preenche Medicamentos (adiciona à lista existente)
+    if dados_extraidos.get("medicamentos"):
+        for med in dados_extraidos["medicamentos"]:
+            st.session_state.dados['lista_medicamentos'].append({
+                "nome": med.get("nome", "Não ident."),
+                "posologia": med.get("posologia", ""),
+                "obs": f"Extraído do Laudo (automático, confiança {med['confianca']:.0%})" if local else "Extraído do Laudo",
+                "escola": False
+            })
+
+
+# FEED DA ABA INÍCIO: UM LOTE DE FRASES GERADO DE VEZ EM QUANDO, RODÍZIO LOCAL
+ARQUIVO_FEED_INICIO = os.path.join(PASTA_CACHE_IA, "feed_inicio.json")
+FEED_TTL = 7 * 24 * 3600        # Renova o lote uma vez por semana
+FEED_TTL_FALHA = 10 * 60        # Se a IA falhar, só tenta de novo depois de 10 min
+FEED_PADRAO = {
+    "saudacoes": ["A inclusão transforma vidas.", "Cada estudante aprende do seu jeito.", "Planejar é acolher a diferença."],
+    "dicas": ["O cérebro aprende quando emocionado.", "Pausas curtas ajudam a consolidar a memória.", "Rotinas previsíveis reduzem a ansiedade em sala."]
+}
+
+@st.cache_resource(show_spinner=False)
+def _trava_feed_inicio():
+    return threading.Lock()
+
+def _ler_feed_inicio():
+    try:
+        with open(ARQUIVO_FEED_INICIO, 'r', encoding='utf-8') as f: return json.load(f)
+    except: return None
+
+def _renovar_feed_inicio(api_key):
+    prompt = """
+    Gere frases para a tela inicial de um sistema de PEI (educação inclusiva).
+    Retorne APENAS um JSON neste formato:
+    {"saudacoes": ["..."], "dicas": ["..."]}
+    - "saudacoes": 30 frases muito curtas e motivadoras para professores de educação inclusiva.
+    - "dicas": 30 dicas relâmpago (1 frase cada) sobre neurociência na escola ou legislação de inclusão.
+    """
+    feed = dict(FEED_PADRAO, gerado_em=time.time(), falhou=True)
+    try:
+        client = get_cliente_openai(api_key)
+        res = criar_completion_rota(client, "feed_inicio", messages=[{"role": "user", "content": prompt}], response_format={"type": "json_object"})
+        dados_feed = json.loads(res.choices[0].message.content)
+        saudacoes = [x.strip() for x in dados_feed.get("saudacoes", []) if isinstance(x, str) and x.strip()]
+        dicas = [x.strip() for x in dados_feed.get("dicas", []) if isinstance(x, str) and x.strip()]
+        if saudacoes and dicas: feed = {"saudacoes": saudacoes, "dicas": dicas, "gerado_em": time.time(), "falhou": False}
+    except: pass
+    tmp = f"{ARQUIVO_FEED_INICIO}.{os.getpid()}.tmp"
+    try:
+        with open(tmp, 'w', encoding='utf-8') as f: json.dump(feed, f, ensure_ascii=False)
+        os.replace(tmp, ARQUIVO_FEED_INICIO)
+    except: pass
+    return feed
+
+def _feed_vencido(feed):
+    if not feed: return True
+    return time.time() - feed.get('gerado_em', 0) > (FEED_TTL_FALHA if feed.get('falhou') else FEED_TTL)
+
+def _renovar_feed_se_vencido(api_key, trava):
     try:
-        client = OpenAI(api_key=api_key)
-        res = client.chat.completions.create(model="gpt-4o-mini", messages=[{"role": "user", "content": "Frase curta inspiradora para professor sobre inclusão."}], temperature=0.9)
-        return res.choices[0].message.content
-    except: return "A inclusão transforma vidas."
+        if _feed_vencido(_ler_feed_inicio()): _renovar_feed_inicio(api_key) # Outra sessão pode ter renovado antes da trava
+        return True, None
+    finally: trava.release()
+
+def carregar_feed_inicio(api_key):
+    """
+    Lê o lote salvo em disco e devolve na hora (o vencido, ou o FEED_PADRAO na primeira vez).
+    Quando ele venceu, uma tarefa em segundo plano renova (1 chamada para todas as sessões).
+    """
+    feed = _ler_feed_inicio()
+    if api_key and _feed_vencido(feed):
+        trava = _trava_feed_inicio()
+        if trava.acquire(blocking=False): # Se outra sessão já está renovando, não espera nem repete
+            try: enviar_tarefa_ia("Feed Início", _renovar_feed_se_vencido, api_key, trava)
+            except Exception: trava.release()
+    return feed or FEED_PADRAO
+
+def _item_do_rodizio(lista, deslocamento=0):
+    # Troca de frase a cada hora, sem rede: o índice vem do relógio
+    return lista[(int(time.time() // 3600) + deslocamento) % len(lista)]
+
+def gerar_saudacao_ia(api_key):
+    return _item_do_rodizio(carregar_feed_inicio(api_key).get("saudacoes") or FEED_PADRAO["saudacoes"])
 
-@st.cache_data(ttl=3600)
 def gerar_noticia_ia(api_key):
-    if not api_key: return "Dica: Mantenha o PEI sempre atualizado."
+    return _item_do_rodizio(carregar_feed_inicio(api_key).get("dicas") or FEED_PADRAO["dicas"], deslocamento=7)
+
+# --- EMPACOTADOR DE CONTEXTO (ORÇAMENTO DE TOKENS POR SEÇÃO): ver contexto_ia.py ---
+# (rótulo, prioridade, orçamento máximo em tokens) - o total ainda respeita ORCAMENTO_CONTEXTO_PEI
+SECOES_CONTEXTO_PEI = {
+    "barreiras": ("BARREIRAS", 5, 250),
+    "evidencias": ("EVIDÊNCIAS", 4, 150),
+    "laudo": ("LAUDO", 3, 1100),
+    "historico": ("HISTÓRICO ESCOLAR", 2, 300),
+    "familia": ("DINÂMICA FAMILIAR", 1, 200),
+    "referencias": ("PEIs SEMELHANTES", 1, 250),
+}
+ORCAMENTO_CONTEXTO_PEI = 1600
+ORCAMENTO_LAUDO_DIGEST = 3000 # Roda uma vez por arquivo, então pode ver mais do laudo
+
+def contexto_pei_empacotado(dados, contexto_pdf="", referencias=""):
+    barreiras = "\n".join(
+        f"- {area}: " + ", ".join(f"{item} ({dados['niveis_suporte'].get(f'{area}_{item}', 'Monitorado')})" for item in itens)
+        for area, itens in dados['barreiras_selecionadas'].items() if itens
+    )
+    evid = "\n".join([f"- {k.replace('?', '')}" for k, v in dados['checklist_evidencias'].items() if v])
+    textos = {"barreiras": barreiras, "evidencias": evid, "laudo": contexto_pdf, "historico": dados['historico'], "familia": dados['familia'], "referencias": referencias}
+    secoes = [(chave, textos[chave], prioridade, orc) for chave, (_, prioridade, orc) in SECOES_CONTEXTO_PEI.items()]
+    return empacotar_contexto(secoes, ORCAMENTO_CONTEXTO_PEI)
+
+# CÉREBRO 1: O PEDAGOGO TÉCNICO (CONSULTORIA IA)
+
+# --- SAÍDA ESTRUTURADA (JSON SCHEMA) DO PEI TÉCNICO ---
+SCHEMA_PEI = {
+    "type": "object",
+    "properties": {
+        "texto": {"type": "string"}, # Primeiro campo: permite exibir a prosa durante o streaming
+        "metas": {
+            "type": "object",
+            "properties": {"curto": {"type": "string"}, "medio": {"type": "string"}, "longo": {"type": "string"}},
+            "required": ["curto", "medio", "longo"], "additionalProperties": False
+        },
+        "bloom": {"type": "array", "items": {"type": "string"}},
+        "campos_experiencia": {"type": "array", "items": {"type": "string"}}
+    },
+    "required": ["texto", "metas", "bloom", "campos_experiencia"], "additionalProperties": False
+}
+FORMATO_PEI_JSON = {"type": "json_schema", "json_schema": {"name": "pei_tecnico", "strict": True, "schema": SCHEMA_PEI}}
+INSTRUCAO_PEI_JSON = """
+FORMATO DE SAÍDA (JSON):
+- "texto": o documento completo em Markdown, exatamente na estrutura acima (com as tags).
+- "metas": as metas SMART de curto (2 meses), médio (semestre) e longo prazo (ano); na Educação Infantil use os objetivos de desenvolvimento.
+- "bloom": os 3 verbos de comando da Taxonomia de Bloom (lista vazia na Educação Infantil).
+- "campos_experiencia": os Campos de Experiência prioritários (lista vazia fora da Educação Infantil).
+"""
+
+def interpretar_resposta_pei(conteudo):
+    """Separa a prosa (ia_sugestao) dos campos tipados. Respostas em texto puro voltam sem estrutura."""
     try:
-        client = OpenAI(api_key=api_key)
-        res = client.chat.completions.create(model="gpt-4o-mini", messages=[{"role": "user", "content": "Dica curta sobre legislação de inclusão ou neurociência (máx 2 frases)."}], temperature=0.7)
-        return res.choices[0].message.content
-    except: return "O cérebro aprende durante toda a vida."
+        obj = json.loads(conteudo)
+        if isinstance(obj, dict) and isinstance(obj.get('texto'), str):
+            return obj['texto'], {k: obj.get(k) for k in ('metas', 'bloom', 'campos_experiencia')}
+    except: pass
+    return conteudo, {}
 
-def consultar_gpt_pedagogico(api_key, dados, contexto_pdf="", modo_pratico=False):
-    if not api_key: return None, "⚠️ Configure a Chave API."
+# finish_reason == "length": o JSON veio cortado e não pode ser aplicado nem ir para o cache
+ERRO_RESPOSTA_CORTADA = "A resposta da IA foi cortada pelo limite de tokens e não foi aplicada. Tente novamente (ou reduza o histórico/laudo)."
+
+def resposta_pei_completa(conteudo):
     try:
-        client = OpenAI(api_key=api_key)
-        familia = ", ".join(dados['composicao_familiar_tags']) if dados['composicao_familiar_tags'] else "Não informado"
-        evid = "\n".join([f"- {k.replace('?', '')}" for k, v in dados['checklist_evidencias'].items() if v])
-        
-        meds_info = "Nenhuma medicação informada."
-        if dados['lista_medicamentos']:
-            meds_info = "\n".join([f"- {m['nome']} ({m['posologia']}). Admin Escola: {'Sim' if m.get('escola') else 'Não'}." for m in dados['lista_medicamentos']])
+        obj = json.loads(conteudo)
+        return isinstance(obj, dict) and isinstance(obj.get('texto'), str)
+    except: return False
+
+def ler_cache_pei(chave, estruturado):
+    # Cache gravado antes da checagem de finish_reason pode ter JSON cortado: vale como miss
+    em_cache = ler_cache_ia(chave)
+    return em_cache if em_cache and (not estruturado or resposta_pei_completa(em_cache)) else None
+
+def aplicar_resposta_pei(dados, conteudo):
+    dados['ia_sugestao'], dados['ia_estrutura'] = interpretar_resposta_pei(conteudo)
+
+def _prosa_parcial(json_parcial):
+    # Decodifica o valor (ainda incompleto) do campo "texto" de um JSON que está chegando
+    m = re.search(r'"texto"\s*:\s*"', json_parcial)
+    if not m: return ""
+    bruto, i = [], m.end()
+    while i < len(json_parcial):
+        c = json_parcial[i]
+        if c == '\\':
+            if i + 1 >= len(json_parcial): break
+            tam = 6 if json_parcial[i + 1] == 'u' else 2
+            if i + tam > len(json_parcial): break
+            bruto.append(json_parcial[i:i + tam]); i += tam; continue
+        if c == '"': break
+        bruto.append(c); i += 1
+    try: return json.loads('"' + "".join(bruto) + '"')
+    except: return ""
 
-        # --- SELEÇÃO DE PERSONALIDADE POR SEGMENTO ---
-        serie = dados['serie'] or ""
-        nivel_ensino = detectar_nivel_ensino(serie)
+# --- PROMPT DO PEI: PREFIXO FIXO POR SEGMENTO + DADOS DO ESTUDANTE NO FIM ---
+# O system prompt não leva NENHUM dado do estudante: é o mesmo para todos do segmento/modo, e tudo
+# que varia vai na mensagem do usuário, no final. O cache de prompt da OpenAI só vale a partir de 1024
+# tokens idênticos; os prefixos têm ~310-540, e completar com instruções extras sairia mais caro
+# do que o desconto (o texto acrescentado também é cobrado), então ficam sem enchimento.
+PERFIS_SEGMENTO = {
+    "EI": """
+        Você é um Especialista em EDUCAÇÃO INFANTIL e Inclusão.
+        FOCO: BNCC (Campos de Experiência e Direitos de Aprendizagem).
+        NÃO use Taxonomia de Bloom. NÃO foque em alfabetização formal ou notas.
+        Foque em: Brincar heurístico, interações, corpo, gestos e movimentos.
+        """,
+    "FI": "Você é um Especialista em ANOS INICIAIS (Fund I). Foco: Alfabetização, Letramento e BNCC.",
+    "FII": "Você é um Especialista em ANOS FINAIS (Fund II). Foco: Autonomia, Identidade, Organização e Habilidades BNCC.",
+    "EM": "Você é um Especialista em ENSINO MÉDIO. Foco: Projeto de Vida e Habilidades BNCC.",
+}
+
+PROMPT_IDENTIDADE = """
+    [PERFIL_NARRATIVO]
+    Inicie OBRIGATORIAMENTE com uma seção "👤 QUEM É O ESTUDANTE?".
+    Escreva um parágrafo humanizado sintetizando o histórico familiar, escolar e as potencialidades (pontos fortes).
+    Mostre quem é a criança por trás do diagnóstico.
+    [/PERFIL_NARRATIVO]
+    """
+
+# A fase de escrita vem nos dados; a regra fica fixa e condicional para não quebrar o prefixo
+PROMPT_LITERACIA = """
+         [ATENÇÃO CRÍTICA: ALFABETIZAÇÃO]
+         Se o NÍVEL ALFABETIZAÇÃO informado for anterior ao Alfabético (Pré-Silábico, Silábico ou Silábico-Alfabético):
+         OBRIGATÓRIO: Dentro das estratégias de adaptação, inclua 2 ações específicas de consciência fonológica ou conversão grafema-fonema para avançar para a próxima hipótese de escrita.
+         [/ATENÇÃO CRÍTICA]
+         """
+
+ESTRUTURA_EI = f"""
+        ESTRUTURA OBRIGATÓRIA (EI):
+        
+        {PROMPT_IDENTIDADE}
         
-        alfabetizacao = dados.get('nivel_alfabetizacao', 'Não Avaliado')
+        1. 🌟 AVALIAÇÃO DE REPERTÓRIO:
+        [ANALISE_FARMA] Analise os fármacos (se houver) e impacto no comportamento. [/ANALISE_FARMA]
         
-        # PROMPT DE IDENTIDADE
-        prompt_identidade = """
-        [PERFIL_NARRATIVO]
-        Inicie OBRIGATORIAMENTE com uma seção "👤 QUEM É O ESTUDANTE?".
-        Escreva um parágrafo humanizado sintetizando o histórico familiar, escolar e as potencialidades (pontos fortes).
-        Mostre quem é a criança por trás do diagnóstico.
-        [/PERFIL_NARRATIVO]
+        [CAMPOS_EXPERIENCIA_PRIORITARIOS]
+        Destaque 2 ou 3 Campos de Experiência da BNCC essenciais para este caso.
+        Use emojis para ilustrar cada campo.
+        [/CAMPOS_EXPERIENCIA_PRIORITARIOS]
+        
+        [DIREITOS_APRENDIZAGEM]
+        Liste como garantir: Conviver, Brincar, Participar, Explorar, Expressar, Conhecer-se.
+        [/DIREITOS_APRENDIZAGEM]
+        
+        [OBJETIVOS_DESENVOLVIMENTO]
+        - OBJETIVO 1: ...
+        - OBJETIVO 2: ...
+        [FIM_OBJETIVOS]
+        
+        2. 🧩 ESTRATÉGIAS DE ACOLHIMENTO E ROTINA:
+        (Descreva adaptações sensoriais e de rotina).
         """
 
-        # LÓGICA DE ALFABETIZAÇÃO
-        prompt_literacia = ""
-        if "Alfabético" not in alfabetizacao and alfabetizacao != "Não se aplica (Educação Infantil)":
-             prompt_literacia = f"""
-             [ATENÇÃO CRÍTICA: ALFABETIZAÇÃO]
-             O aluno está na fase: {alfabetizacao}.
-             OBRIGATÓRIO: Dentro das estratégias de adaptação, inclua 2 ações específicas de consciência fonológica ou conversão grafema-fonema para avançar para a próxima hipótese de escrita.
-             [/ATENÇÃO CRÍTICA]
-             """
-
-        if nivel_ensino == "EI":
-            # === EDUCAÇÃO INFANTIL (BNCC) ===
-            perfil_ia = """
-            Você é um Especialista em EDUCAÇÃO INFANTIL e Inclusão.
-            FOCO: BNCC (Campos de Experiência e Direitos de Aprendizagem).
-            NÃO use Taxonomia de Bloom. NÃO foque em alfabetização formal ou notas.
-            Foque em: Brincar heurístico, interações, corpo, gestos e movimentos.
-            """
-            estrutura_req = f"""
-            ESTRUTURA OBRIGATÓRIA (EI):
-            
-            {prompt_identidade}
-            
-            1. 🌟 AVALIAÇÃO DE REPERTÓRIO:
-            [ANALISE_FARMA] Analise os fármacos (se houver) e impacto no comportamento. [/ANALISE_FARMA]
-            
-            [CAMPOS_EXPERIENCIA_PRIORITARIOS]
-            Destaque 2 ou 3 Campos de Experiência da BNCC essenciais para este caso.
-            Use emojis para ilustrar cada campo.
-            [/CAMPOS_EXPERIENCIA_PRIORITARIOS]
-            
-            [DIREITOS_APRENDIZAGEM]
-            Liste como garantir: Conviver, Brincar, Participar, Explorar, Expressar, Conhecer-se.
-            [/DIREITOS_APRENDIZAGEM]
-            
-            [OBJETIVOS_DESENVOLVIMENTO]
-            - OBJETIVO 1: ...
-            - OBJETIVO 2: ...
-            [FIM_OBJETIVOS]
-            
-            2. 🧩 ESTRATÉGIAS DE ACOLHIMENTO E ROTINA:
-            (Descreva adaptações sensoriais e de rotina).
-            """
-            
-        else:
-            # === FUNDAMENTAL E MÉDIO (BLOOM, SMART) ===
-            if nivel_ensino == "FI":
-                perfil_ia = "Você é um Especialista em ANOS INICIAIS (Fund I). Foco: Alfabetização, Letramento e BNCC."
-            elif nivel_ensino == "FII":
-                perfil_ia = "Você é um Especialista em ANOS FINAIS (Fund II). Foco: Autonomia, Identidade, Organização e Habilidades BNCC."
-            elif nivel_ensino == "EM":
-                perfil_ia = "Você é um Especialista em ENSINO MÉDIO. Foco: Projeto de Vida e Habilidades BNCC."
-            else:
-                perfil_ia = "Você é um Especialista em Inclusão Escolar."
+ESTRUTURA_PADRAO = f"""
+        ESTRUTURA OBRIGATÓRIA (Padrão):
+        
+        {PROMPT_IDENTIDADE}
+        
+        1. 🌟 AVALIAÇÃO DE REPERTÓRIO:
+        [ANALISE_FARMA] Analise os fármacos. [/ANALISE_FARMA]
+        
+        [MAPEAMENTO_BNCC]
+        - **Habilidades Basais (Defasagem/Anos Anteriores):** Quais pré-requisitos precisam ser resgatados?
+        - **Habilidades Focais (Ano Atual):** Quais habilidades essenciais do ano devem ser priorizadas/adaptadas?
+        [/MAPEAMENTO_BNCC]
+        
+        [TAXONOMIA_BLOOM] Liste 3 verbos de comando. [/TAXONOMIA_BLOOM]
+        
+        [METAS_SMART]
+        - CURTO PRAZO (2 meses): ...
+        - MÉDIO PRAZO (Semestre): ...
+        - LONGO PRAZO (Ano): ...
+        [FIM_METAS_SMART]
+        
+        2. 🧩 DIRETRIZES DE ADAPTAÇÃO:
+        (Adaptações curriculares e de acesso).
+        {PROMPT_LITERACIA}
+        """
 
-            estrutura_req = f"""
-            ESTRUTURA OBRIGATÓRIA (Padrão):
-            
-            {prompt_identidade}
-            
-            1. 🌟 AVALIAÇÃO DE REPERTÓRIO:
-            [ANALISE_FARMA] Analise os fármacos. [/ANALISE_FARMA]
-            
-            [MAPEAMENTO_BNCC]
-            - **Habilidades Basais (Defasagem/Anos Anteriores):** Quais pré-requisitos precisam ser resgatados?
-            - **Habilidades Focais (Ano Atual):** Quais habilidades essenciais do ano devem ser priorizadas/adaptadas?
-            [/MAPEAMENTO_BNCC]
-            
-            [TAXONOMIA_BLOOM] Liste 3 verbos de comando. [/TAXONOMIA_BLOOM]
-            
-            [METAS_SMART]
-            - CURTO PRAZO (2 meses): ...
-            - MÉDIO PRAZO (Semestre): ...
-            - LONGO PRAZO (Ano): ...
-            [FIM_METAS_SMART]
-            
-            2. 🧩 DIRETRIZES DE ADAPTAÇÃO:
-            (Adaptações curriculares e de acesso).
-            {prompt_literacia}
-            """
-
-        # --- SELEÇÃO DE FORMATO (TÉCNICO VS PRÁTICO) ---
-        if modo_pratico:
-            prompt_sys = f"""
-            {perfil_ia}
-            SUA MISSÃO: Criar um GUIA PRÁTICO E DIRETO para o professor usar em sala de aula AMANHÃ.
-            
-            ESTRUTURA DE RESPOSTA OBRIGATÓRIA (Texto corrido e tópicos, sem blocos técnicos):
-            
-            # GUIA PRÁTICO PARA {serie.upper()}
-            
-            {prompt_identidade}
-            
-            1. 🎯 O QUE FAZER AMANHÃ:
-            (3 ações simples e imediatas para adaptação de atividade e comportamento).
-            {prompt_literacia}
-            
-            2. 🗣️ COMO FALAR:
-            (Exemplos de comandos ou feedbacks que funcionam para este perfil).
-            
-            3. 🏠 ROTINA E AMBIENTE:
-            (Dicas de onde sentar, como organizar a mesa, pausas).
-            """
-        else:
-            prompt_sys = f"""
-            {perfil_ia}
-            SUA MISSÃO: Cruzar dados para criar um PEI Técnico Oficial.
-            {estrutura_req}
-            """
+def prefixo_prompt_pei(nivel_ensino, modo_pratico=False, estruturado=False):
+    """System prompt do PEI: depende só do segmento e do modo, nunca do estudante."""
+    perfil_ia = PERFIS_SEGMENTO.get(nivel_ensino, "Você é um Especialista em Inclusão Escolar.")
+    if modo_pratico:
+        prompt_sys = f"""
+        {perfil_ia}
+        SUA MISSÃO: Criar um GUIA PRÁTICO E DIRETO para o professor usar em sala de aula AMANHÃ.
+        
+        ESTRUTURA DE RESPOSTA OBRIGATÓRIA (Texto corrido e tópicos, sem blocos técnicos):
+        
+        # GUIA PRÁTICO PARA (SÉRIE DO ESTUDANTE, EM MAIÚSCULAS)
+        
+        {PROMPT_IDENTIDADE}
         
-        prompt_user = f"""
-        ALUNO: {dados['nome']} | SÉRIE: {serie}
-        HISTÓRICO ESCOLAR: {dados['historico']}
-        DINÂMICA FAMILIAR: {dados['familia']}
-        POTENCIALIDADES: {', '.join(dados['potencias'])}
-        DIAGNÓSTICO: {dados['diagnostico']}
-        NÍVEL ALFABETIZAÇÃO: {alfabetizacao}
-        MEDICAÇÃO: {meds_info}
-        HIPERFOCO: {dados['hiperfoco']}
-        BARREIRAS: {json.dumps(dados['barreiras_selecionadas'], ensure_ascii=False)}
-        EVIDÊNCIAS: {evid}
-        LAUDO: {contexto_pdf[:3000] if contexto_pdf else "Nenhum."}
+        1. 🎯 O QUE FAZER AMANHÃ:
+        (3 ações simples e imediatas para adaptação de atividade e comportamento).
+        {PROMPT_LITERACIA if nivel_ensino != "EI" else ""}
+        
+        2. 🗣️ COMO FALAR:
+        (Exemplos de comandos ou feedbacks que funcionam para este perfil).
+        
+        3. 🏠 ROTINA E AMBIENTE:
+        (Dicas de onde sentar, como organizar a mesa, pausas).
         """
+    else:
+        prompt_sys = f"""
+        {perfil_ia}
+        SUA MISSÃO: Cruzar dados para criar um PEI Técnico Oficial.
+        {ESTRUTURA_EI if nivel_ensino == "EI" else ESTRUTURA_PADRAO}
+        """
+        if estruturado: prompt_sys += INSTRUCAO_PEI_JSON
+    return prompt_sys
+
+def montar_prompts_pedagogicos(dados, contexto_pdf="", modo_pratico=False, estruturado=False, referencias=""):
+    meds_info = "Nenhuma medicação informada."
+    if dados['lista_medicamentos']:
+        meds_info = "\n".join([f"- {m['nome']} ({m['posologia']}). Admin Escola: {'Sim' if m.get('escola') else 'Não'}." for m in dados['lista_medicamentos']])
+
+    serie = dados['serie'] or ""
+    alfabetizacao = dados.get('nivel_alfabetizacao', 'Não Avaliado')
+    prompt_sys = prefixo_prompt_pei(detectar_nivel_ensino(serie), modo_pratico, estruturado)
+    
+    ctx = contexto_pei_empacotado(dados, contexto_pdf, referencias)
+    prompt_user = f"""
+    ALUNO: {dados['nome']} | SÉRIE: {serie}
+    HISTÓRICO ESCOLAR: {ctx['historico']}
+    DINÂMICA FAMILIAR: {ctx['familia']}
+    POTENCIALIDADES: {', '.join(dados['potencias'])}
+    DIAGNÓSTICO: {dados['diagnostico']}
+    NÍVEL ALFABETIZAÇÃO: {alfabetizacao}
+    MEDICAÇÃO: {meds_info}
+    HIPERFOCO: {dados['hiperfoco']}
+    BARREIRAS:
+    {ctx['barreiras'] or "Nenhuma selecionada."}
+    EVIDÊNCIAS:
+    {ctx['evidencias']}
+    LAUDO:
+    {ctx['laudo'] or "Nenhum."}
+    """
+    if ctx['referencias']: # Few-shot de perfis parecidos: a IA parte de metas já validadas em vez de começar do zero
+        prompt_user += f"""
+    REFERÊNCIAS (PEIs de estudantes com perfil semelhante; adapte, não copie):
+    {ctx['referencias']}
+    """
+    return prompt_sys, prompt_user
+
+# --- STREAMING (TEXTO APARECE ENQUANTO A IA ESCREVE) ---
+def transmitir_resposta_ia(client, tarefa, mensagens, metricas, **extra):
+    """Gera os pedaços de texto do stream e mede o tempo até o primeiro token (ttft); metricas['finish_reason'] no fim."""
+    inicio, uso, info = time.time(), None, {}
+    stream = criar_completion_rota(client, tarefa, info, messages=mensagens, stream=True, stream_options={"include_usage": True}, **extra)
+    try:
+        for chunk in stream:
+            if chunk.usage: uso = chunk.usage # Último chunk (include_usage) traz a contagem de tokens
+            if not chunk.choices: continue
+            if chunk.choices[0].finish_reason: metricas['finish_reason'] = chunk.choices[0].finish_reason
+            pedaco = chunk.choices[0].delta.content
+            if pedaco:
+                if 'ttft' not in metricas: metricas['ttft'] = time.time() - inicio
+                yield pedaco
+    except Exception as e:
+        registrar_uso_ia(tarefa, info.get('modelo'), time.time() - inicio, uso, info.get('fallback', False), metricas.get('ttft'), info.get('espera_fila', 0.0), type(e).__name__)
+        raise
+    metricas['total'] = time.time() - inicio
+    registrar_uso_ia(tarefa, info.get('modelo'), metricas['total'], uso, info.get('fallback', False), metricas.get('ttft'), info.get('espera_fila', 0.0))
+
+def consultar_gpt_pedagogico(api_key, dados, contexto_pdf="", modo_pratico=False, ignorar_cache=False, estruturado=None, referencias=""):
+    """
+    No modo técnico (padrão estruturado) a resposta é o JSON do SCHEMA_PEI;
+    use aplicar_resposta_pei para separar prosa e campos. O guia prático é texto puro.
+    """
+    if not api_key: return None, "⚠️ Configure a Chave API."
+    if estruturado is None: estruturado = not modo_pratico
+    try:
+        rota = "guia_pratico" if modo_pratico else "pei_tecnico"
+        prompt_sys, prompt_user = montar_prompts_pedagogicos(dados, contexto_pdf, modo_pratico, estruturado, referencias)
+        chave = chave_cache_ia(prompt_sys, prompt_user, ROTAS_IA[rota]['modelo'], "pratico" if modo_pratico else "tecnico")
+        if not ignorar_cache:
+            em_cache = ler_cache_pei(chave, estruturado)
+            if em_cache:
+                registrar_acerto_cache_ia(rota); return em_cache, None
         
-        res = client.chat.completions.create(model="gpt-4o-mini", messages=[{"role": "system", "content": prompt_sys}, {"role": "user", "content": prompt_user}])
-        return res.choices[0].message.content, None
+        client = get_cliente_openai(api_key)
+        extra = {"response_format": FORMATO_PEI_JSON} if estruturado else {}
+        def tarefa():
+            res = criar_completion_rota(client, rota, messages=[{"role": "system", "content": prompt_sys}, {"role": "user", "content": prompt_user}], **extra)
+            if res.choices[0].finish_reason == "length": raise RuntimeError(ERRO_RESPOSTA_CORTADA)
+            texto = res.choices[0].message.content
+            gravar_cache_ia(chave, texto)
+            yield texto
+        return resultado_voo(entrar_voo(chave, tarefa))
     except Exception as e: return None, str(e)
 
-# CÉREBRO 2: GAME MASTER (SEGMENTADO E BLINDADO)
-def gerar_roteiro_gamificado(api_key, dados, pei_tecnico):
-    if not api_key: return None, "Configure a API."
+def registrar_latencia_ia(tarefa, metricas):
+    if metricas.get('erro'): return
+    st.session_state.latencia_ia[tarefa] = {"ttft": metricas.get('ttft'), "total": metricas.get('total')}
+
+# --- TAREFAS DA SESSÃO: AGENDAR, ACOMPANHAR (FRAGMENTS) E APLICAR O RESULTADO ---
+def _sincronizar_url_tarefas():
+    # Os ids também vão na URL: após uma reconexão, a sessão nova reassume as tarefas
+    if st.session_state.tarefas_ia: st.query_params["tarefas_ia"] = ",".join(st.session_state.tarefas_ia.values())
+    elif "tarefas_ia" in st.query_params: del st.query_params["tarefas_ia"]
+
+def recuperar_tarefas_sessao():
+    if 'tarefas_ia' in st.session_state: return
+    st.session_state.tarefas_ia, st.session_state.avisos_ia = {}, []
+    for id_tarefa in filter(None, st.query_params.get("tarefas_ia", "").split(",")):
+        tarefa = consultar_tarefa_ia(id_tarefa)
+        if tarefa: st.session_state.tarefas_ia[tarefa['tipo']] = id_tarefa
+        # Sessão nova (reconexão) ainda sem estudante: assume o estudante das tarefas recuperadas
+        if tarefa and tarefa.get('dono') and identidade_aluno() == ("", ""):
+            st.session_state.dados['nome'], st.session_state.registro_aluno = tarefa['dono']
+    _sincronizar_url_tarefas()
+
+def identidade_aluno(dados=None):
+    """Nome normalizado + hash do registro carregado: o resultado só é aplicado no mesmo estudante."""
+    return (" ".join(((dados or st.session_state.dados).get('nome') or "").split()), st.session_state.registro_aluno)
+
+def agendar_tarefa_sessao(tipo, funcao, *args, **kwargs):
+    st.session_state.tarefas_ia[tipo] = enviar_tarefa_ia(tipo, funcao, *args, dono=identidade_aluno(), **kwargs)
+    _sincronizar_url_tarefas()
+    st.rerun() # O painel da sidebar passa a acompanhar a tarefa
+
+def tarefa_pendente(tipos):
+    for tipo in tipos:
+        tarefa = consultar_tarefa_ia(st.session_state.tarefas_ia.get(tipo, ""))
+        if tarefa and tarefa['status'] in ("fila", "rodando"): return tarefa
+    return None
+
+def aplicar_tarefa_ia(tarefa, api_key):
+    tipo, res, dados = tarefa['tipo'], tarefa['resultado'], st.session_state.dados
+    if tarefa['status'] != "concluida":
+        st.session_state.avisos_ia.append(("erro", f"{tipo}: {tarefa['erro']}")); return
+    if not tarefa_do_dono(tarefa, identidade_aluno()):
+        # Trocaram de estudante (Carregar Backup) com a geração em andamento: não grava no estudante errado
+        pedido_para = tarefa['dono'][0] or "um estudante sem nome"
+        st.session_state.avisos_ia.append(("erro", f"{tipo} descartado: foi pedido para {pedido_para}, mas o estudante aberto agora é outro. Gere novamente.")); return
+    if tipo in ("PEI Técnico", "Guia Prático", "Gerar Tudo"): guardar_digest_sessao()
+    if tipo == "PEI Técnico": pedir_antecipacao_roteiro()
+    if tipo == "PEI Técnico": aplicar_resposta_pei(dados, res)
+    elif tipo == "Guia Prático": dados['ia_guia_pratico'] = res
+    elif tipo == "Roteiro Gamificado": dados['ia_mapa_texto'] = limpar_roteiro(res)
+    elif tipo == "Leitura do Laudo": aplicar_dados_laudo(api_key, res)
+    elif tipo == "Refazer Seção":
+        secao, bloco = res
+        novo = encaixar_secao(dados['ia_sugestao'], secao, bloco)
+        if novo is None:
+            st.session_state.avisos_ia.append(("erro", f"{tipo}: a seção '{secao}' não está mais no PEI (foi apagada na edição).")); return
+        dados['ia_sugestao'], dados['ia_estrutura'] = novo, _atualizar_estrutura_secao(dados.get('ia_estrutura'), SECOES_REGERAVEIS[secao][2], bloco)
+    elif tipo == "Gerar Tudo":
+        falhas = [erro for _, (_, erro) in res.items() if erro]
+        for campo, (texto, erro) in res.items():
+            if not erro: dados[campo] = texto
+        if falhas: st.session_state.avisos_ia.append(("erro", " | ".join(falhas)))
+    if tipo in ("PEI Técnico", "Gerar Tudo", "Refazer Seção"): st.session_state.pop("editor_ia", None) # O editor volta a mostrar o texto novo
+    registrar_latencia_ia(tipo, tarefa['metricas'])
+    st.session_state.avisos_ia.append(("festa" if tipo == "PEI Técnico" else "ok", f"{tipo} pronto em {tarefa['fim'] - tarefa['criada']:.1f}s!"))
+
+@st.fragment(run_every=1)
+def painel_tarefas_ia(api_key):
+    """Só roda enquanto houver tarefa da sessão; ao concluir, aplica o resultado e reroda o app."""
+    prontas = False
+    for tipo, id_tarefa in list(st.session_state.tarefas_ia.items()):
+        tarefa = consultar_tarefa_ia(id_tarefa)
+        if tarefa and tarefa['status'] in ("fila", "rodando"):
+            posicao = posicao_fila_ia(tarefa['sessao'])
+            if posicao: estado = f"aguardando a vez na fila da escola (posição {posicao})"
+            elif tarefa['status'] == "fila": estado = "na fila"
+            else: estado = f"gerando há {time.time() - tarefa['inicio']:.0f}s"
+            st.caption(f"⏳ {tipo}: {estado}"); continue
+        del st.session_state.tarefas_ia[tipo]
+        if tarefa: aplicar_tarefa_ia(tarefa, api_key)
+        prontas = True
+    if prontas:
+        _sincronizar_url_tarefas(); st.rerun()
+
+def mostrar_avisos_tarefas():
+    while st.session_state.avisos_ia:
+        nivel, msg = st.session_state.avisos_ia.pop(0)
+        if nivel == "erro": st.error(msg); continue
+        st.toast(msg)
+        if nivel == "festa": st.balloons()
+
+@st.fragment(run_every=1)
+def previa_tarefa_ia(tipos):
+    tarefa = tarefa_pendente(tipos)
+    if not tarefa: return
+    with st.container(border=True):
+        posicao = posicao_fila_ia(tarefa['sessao'])
+        if posicao: st.caption(f"⏳ Muitos professores usando a IA agora: você é o {posicao}º da fila. O pedido segue sozinho, pode continuar preenchendo as outras abas.")
+        else: st.caption(f"⏳ {tarefa['tipo']} em geração. Você pode continuar preenchendo as outras abas.")
+        if tarefa['parcial']: st.markdown(tarefa['parcial'])
+
+def render_latencia_ia(tarefas):
+    for tarefa in tarefas:
+        m = st.session_state.latencia_ia.get(tarefa)
+        if m and m.get('ttft') is not None:
+            st.caption(f"⏱️ {tarefa}: primeiro token em {m['ttft']:.1f}s · total {m['total']:.1f}s")
+
+def consultar_gpt_pedagogico_stream(api_key, dados, contexto_pdf="", modo_pratico=False, ignorar_cache=False, metricas=None, estruturado=None, referencias=""):
+    """
+    Versão em streaming: erros ficam em metricas['erro'] e só a resposta completa vai para o cache.
+    Em modo JSON, exibe só a prosa do campo "texto" e deixa o JSON completo em metricas['conteudo'].
+    """
+    metricas = {} if metricas is None else metricas
+    if not api_key:
+        metricas['erro'] = "⚠️ Configure a Chave API."; return
+    if estruturado is None: estruturado = not modo_pratico
     try:
-        client = OpenAI(api_key=api_key)
-        serie = dados['serie'] or ""
-        nivel_ensino = detectar_nivel_ensino(serie) 
-        hiperfoco = dados['hiperfoco'] or "brincadeiras"
+        rota = "guia_pratico" if modo_pratico else "pei_tecnico"
+        prompt_sys, prompt_user = montar_prompts_pedagogicos(dados, contexto_pdf, modo_pratico, estruturado, referencias)
+        chave = chave_cache_ia(prompt_sys, prompt_user, ROTAS_IA[rota]['modelo'], "pratico" if modo_pratico else "tecnico")
+        if not ignorar_cache:
+            em_cache = ler_cache_pei(chave, estruturado)
+            if em_cache:
+                registrar_acerto_cache_ia(rota)
+                metricas['ttft'] = metricas['total'] = 0.0
+                metricas['conteudo'] = em_cache
+                yield interpretar_resposta_pei(em_cache)[0]; return
         
-        # --- FIREWALL DE CONTEXTO ---
-        contexto_seguro = f"""
-        ALUNO: {dados['nome'].split()[0]}
-        HIPERFOCO: {hiperfoco}
-        PONTOS FORTES: {', '.join(dados['potencias'])}
+        client = get_cliente_openai(api_key)
+        extra = {"response_format": FORMATO_PEI_JSON} if estruturado else {}
+        def tarefa():
+            partes, fim = [], {}
+            for pedaco in transmitir_resposta_ia(client, rota, [{"role": "system", "content": prompt_sys}, {"role": "user", "content": prompt_user}], fim, **extra):
+                partes.append(pedaco); yield pedaco
+            if fim.get('finish_reason') == "length": raise RuntimeError(ERRO_RESPOSTA_CORTADA)
+            gravar_cache_ia(chave, "".join(partes))
+        partes, exibido = [], 0
+        for pedaco in acompanhar_voo(entrar_voo(chave, tarefa), metricas):
+            partes.append(pedaco)
+            if not estruturado: yield pedaco; continue
+            prosa = _prosa_parcial("".join(partes))
+            if len(prosa) > exibido: yield prosa[exibido:]; exibido = len(prosa)
+        if not metricas.get('erro'): metricas['conteudo'] = "".join(partes)
+    except Exception as e: metricas['erro'] = str(e)
+
+# --- REGENERAÇÃO DE UMA SEÇÃO (SEM REFAZER O PEI INTEIRO) ---
+def montar_prompts_secao(dados, texto_atual, secao, pedido=""):
+    tag_ini, tag_fim, _ = SECOES_REGERAVEIS[secao]
+    # Reaproveita o modelo da seção que já está no prompt do PEI completo
+    prompt_pei, _ = montar_prompts_pedagogicos(dados)
+    m = re.search(fr'\[{re.escape(tag_ini)}\].*?\[{re.escape(tag_fim)}\]', prompt_pei, re.DOTALL)
+    modelo_secao = "\n".join(l.strip() for l in m.group(0).splitlines()) if m else f"[{tag_ini}] ... [{tag_fim}]"
+    prompt_sys = f"""
+    Você é o mesmo especialista em Inclusão Escolar que redigiu o PEI enviado pelo usuário.
+    SUA MISSÃO: Reescrever APENAS a seção "{secao}", mantendo coerência com o restante do documento.
+    MODELO DA SEÇÃO:
+    {modelo_secao}
+    Responda somente com o bloco, iniciando com [{tag_ini}] e terminando com [{tag_fim}]. Não repita o resto do documento.
+    """
+    prompt_user = f"""
+    ALUNO: {dados['nome']} | SÉRIE: {dados['serie']} | DIAGNÓSTICO: {dados['diagnostico']}
+    PEDIDO DO PROFESSOR: {pedido.strip() or "Torne a seção mais específica e aplicável para este estudante."}
+    PEI ATUAL:
+    {texto_atual}
+    """
+    return prompt_sys, prompt_user
+
+def _atualizar_estrutura_secao(estrutura, campo, texto):
+    # Mantém os campos tipados alinhados com a seção reescrita (os demais ficam como estavam)
+    if not estrutura or not campo: return estrutura
+    estrutura = dict(estrutura)
+    if campo == "metas":
+        m = extrair_metas_estruturadas(texto) or {}
+        estrutura['metas'] = {"curto": m.get("Curto", ""), "medio": m.get("Medio", ""), "longo": m.get("Longo", "")}
+    elif campo == "bloom": estrutura['bloom'] = extrair_bloom(texto)
+    elif campo == "campos_experiencia": estrutura['campos_experiencia'] = extrair_campos_experiencia(texto)
+    return estrutura
+
+def regenerar_secao_pei(api_key, dados, secao, pedido="", ignorar_cache=False):
+    """
+    Pede à IA só a seção escolhida. Devolve ((secao, bloco), erro): o bloco é encaixado ao aplicar a tarefa,
+    no ia_sugestao daquele momento (preserva edições manuais feitas durante a geração).
+    """
+    if not api_key: return None, "⚠️ Configure a Chave API."
+    texto_atual = dados.get('ia_sugestao') or ""
+    if not localizar_secao(texto_atual, secao): return None, f"Seção '{secao}' não encontrada no PEI atual."
+    try:
+        prompt_sys, prompt_user = montar_prompts_secao(dados, texto_atual, secao, pedido)
+        chave = chave_cache_ia(prompt_sys, prompt_user, ROTAS_IA["secao_pei"]['modelo'], "secao")
+        bloco = None if ignorar_cache else ler_cache_ia(chave)
+        if bloco: registrar_acerto_cache_ia("secao_pei")
+        else:
+            client = get_cliente_openai(api_key)
+            def tarefa():
+                res = criar_completion_rota(client, "secao_pei", messages=[{"role": "system", "content": prompt_sys}, {"role": "user", "content": prompt_user}])
+                bloco = (res.choices[0].message.content or "").strip()
+                if bloco: gravar_cache_ia(chave, bloco)
+                yield bloco
+            bloco, err = resultado_voo(entrar_voo(chave, tarefa))
+            if err: return None, err
+            if not bloco: return None, "A IA não devolveu a seção."
+        return (secao, normalizar_bloco(bloco, secao)), None
+    except Exception as e: return None, str(e)
+
+# CÉREBRO 2: GAME MASTER (SEGMENTADO E BLINDADO)
+def montar_prompts_roteiro(dados):
+    serie = dados['serie'] or ""
+    nivel_ensino = detectar_nivel_ensino(serie) 
+    hiperfoco = dados['hiperfoco'] or "brincadeiras"
+    
+    # --- FIREWALL DE CONTEXTO ---
+    contexto_seguro = f"""
+    ALUNO: {dados['nome'].split()[0]}
+    HIPERFOCO: {hiperfoco}
+    PONTOS FORTES: {', '.join(dados['potencias'])}
+    """
+    
+    regras_ouro = """
+    REGRA DE OURO: JAMAIS mencione medicamentos, laudos, CIDs, médicos ou termos clínicos. 
+    Este documento é para a criança/jovem se sentir potente. Fale de habilidades e desafios como se fosse um jogo/história.
+    """
+
+    # --- LÓGICA DE SEGMENTAÇÃO DO MAPA ---
+    if nivel_ensino == "EI":
+        prompt_sys = f"""
+        Você é um Criador de Histórias Visuais para crianças pequenas (4-5 anos).
+        {regras_ouro}
+        
+        SUA MISSÃO: Criar um Roteiro Visual usando MUITOS EMOJIS e pouquíssimo texto.
+        Estrutura obrigatória:
+        
+        # ☀️ MINHA AVENTURA DO DIA
+        
+        🧸 **Chegada:** (Emoji e frase curta sobre chegar na escola feliz)
+        🎨 **Atividades:** (Emoji e frase sobre pintar/brincar)
+        🍎 **Lanche:** (Emoji sobre comer e lavar as mãos)
+        🧘 **Descanso:** (Emoji sobre ficar calmo/soneca)
+        👋 **Saída:** (Emoji sobre abraçar a família)
         """
         
-        regras_ouro = """
-        REGRA DE OURO: JAMAIS mencione medicamentos, laudos, CIDs, médicos ou termos clínicos. 
-        Este documento é para a criança/jovem se sentir potente. Fale de habilidades e desafios como se fosse um jogo/história.
+    elif nivel_ensino == "FI":
+        prompt_sys = f"""
+        Você é um Game Master para crianças de 6 a 10 anos.
+        {regras_ouro}
+        
+        SUA MISSÃO: Criar um "Quadro de Missões" empolgante.
+        Estrutura obrigatória:
+        
+        # 🗺️ MAPA DE EXPLORAÇÃO
+        
+        🎒 **Equipamento:** (Materiais escolares como itens de aventura)
+        ⚡ **Super Poder:** (O ponto forte do aluno transformado em habilidade)
+        🚧 **O Desafio:** (O que é difícil na escola, transformado em obstáculo a pular)
+        🏆 **Recompensa:** (O que ganha ao terminar: tempo livre, estrelinha)
+        🤝 **Aliados:** (Professora e amigos)
         """
-
-        # --- LÓGICA DE SEGMENTAÇÃO DO MAPA ---
-        if nivel_ensino == "EI":
-            prompt_sys = f"""
-            Você é um Criador de Histórias Visuais para crianças pequenas (4-5 anos).
-            {regras_ouro}
-            
-            SUA MISSÃO: Criar um Roteiro Visual usando MUITOS EMOJIS e pouquíssimo texto.
-            Estrutura obrigatória:
-            
-            # ☀️ MINHA AVENTURA DO DIA
-            
-            🧸 **Chegada:** (Emoji e frase curta sobre chegar na escola feliz)
-            🎨 **Atividades:** (Emoji e frase sobre pintar/brincar)
-            🍎 **Lanche:** (Emoji sobre comer e lavar as mãos)
-            🧘 **Descanso:** (Emoji sobre ficar calmo/soneca)
-            👋 **Saída:** (Emoji sobre abraçar a família)
-            """
-            
-        elif nivel_ensino == "FI":
-            prompt_sys = f"""
-            Você é um Game Master para crianças de 6 a 10 anos.
-            {regras_ouro}
-            
-            SUA MISSÃO: Criar um "Quadro de Missões" empolgante.
-            Estrutura obrigatória:
-            
-            # 🗺️ MAPA DE EXPLORAÇÃO
-            
-            🎒 **Equipamento:** (Materiais escolares como itens de aventura)
-            ⚡ **Super Poder:** (O ponto forte do aluno transformado em habilidade)
-            🚧 **O Desafio:** (O que é difícil na escola, transformado em obstáculo a pular)
-            🏆 **Recompensa:** (O que ganha ao terminar: tempo livre, estrelinha)
-            🤝 **Aliados:** (Professora e amigos)
-            """
-            
-        else: # FII e EM
-            prompt_sys = f"""
-            Você é um Narrador de RPG para adolescentes.
-            {regras_ouro}
-            
-            SUA MISSÃO: Criar uma "Ficha de Personagem" ou "Jornada do Herói".
-            Estrutura obrigatória:
-            
-            # ⚔️ FICHA DE PERSONAGEM
-            
-            📜 **A Quest (Missão):** (Terminar o ano, aprender tal coisa, ou foco pessoal)
-            🔮 **Skills (Habilidades):** (Pontos fortes cognitivos e sociais)
-            🛡️ **Buffs (Apoios):** (O que ajuda: fone de ouvido, sentar na frente, tempo extra)
-            👹 **Boss (Desafio):** (A dificuldade principal: ansiedade, barulho, organização)
-            🧪 **Mana (Energia):** (Como recarregar no intervalo)
-            """
         
-        res = client.chat.completions.create(model="gpt-4o-mini", messages=[{"role": "system", "content": prompt_sys}, {"role": "user", "content": f"Gere o roteiro para: {contexto_seguro}"}])
-        return res.choices[0].message.content, None
+    else: # FII e EM
+        prompt_sys = f"""
+        Você é um Narrador de RPG para adolescentes.
+        {regras_ouro}
+        
+        SUA MISSÃO: Criar uma "Ficha de Personagem" ou "Jornada do Herói".
+        Estrutura obrigatória:
+        
+        # ⚔️ FICHA DE PERSONAGEM
+        
+        📜 **A Quest (Missão):** (Terminar o ano, aprender tal coisa, ou foco pessoal)
+        🔮 **Skills (Habilidades):** (Pontos fortes cognitivos e sociais)
+        🛡️ **Buffs (Apoios):** (O que ajuda: fone de ouvido, sentar na frente, tempo extra)
+        👹 **Boss (Desafio):** (A dificuldade principal: ansiedade, barulho, organização)
+        🧪 **Mana (Energia):** (Como recarregar no intervalo)
+        """
+    
+    return prompt_sys, f"Gere o roteiro para: {contexto_seguro}"
+
+def chave_roteiro(dados):
+    # Só nome, hiperfoco, potências e segmento entram no prompt: a chave muda exatamente quando o roteiro fica velho
+    prompt_sys, prompt_user = montar_prompts_roteiro(dados)
+    return chave_cache_ia(prompt_sys, prompt_user, ROTAS_IA["roteiro"]['modelo'], "roteiro")
+
+def gerar_roteiro_gamificado(api_key, dados, pei_tecnico, rota="roteiro"):
+    if not api_key: return None, "Configure a API."
+    try:
+        client = get_cliente_openai(api_key)
+        prompt_sys, prompt_user = montar_prompts_roteiro(dados)
+        def tarefa():
+            res = criar_completion_rota(client, rota, messages=[{"role": "system", "content": prompt_sys}, {"role": "user", "content": prompt_user}])
+            yield res.choices[0].message.content
+        # Mesma chave do modo streaming e da antecipação: um clique durante a geração antecipada só espera por ela
+        return resultado_voo(entrar_voo(chave_roteiro(dados), tarefa))
+    except Exception as e: return None, str(e)
+
+def gerar_roteiro_gamificado_stream(api_key, dados, metricas):
+    if not api_key:
+        metricas['erro'] = "Configure a API."; return
+    try:
+        client = get_cliente_openai(api_key)
+        prompt_sys, prompt_user = montar_prompts_roteiro(dados)
+        tarefa = lambda: transmitir_resposta_ia(client, "roteiro", [{"role": "system", "content": prompt_sys}, {"role": "user", "content": prompt_user}], {})
+        yield from acompanhar_voo(entrar_voo(chave_roteiro(dados), tarefa), metricas)
+    except Exception as e: metricas['erro'] = str(e)
+
+def limpar_roteiro(texto_game):
+    return texto_game.replace("[MAPA_TEXTO_GAMIFICADO]", "").replace("[FIM_MAPA_TEXTO_GAMIFICADO]", "").strip()
+
+# ROTEIRO ANTECIPADO: COM O PEI PRONTO AS ENTRADAS DO ROTEIRO JÁ ESTÃO FIXAS, ENTÃO ELE É GERADO EM SEGUNDO PLANO
+def pedir_antecipacao_roteiro():
+    # Chamado só quando um PEI novo chega da IA: editar nome, hiperfoco ou potências depois não gera outra chamada paga
+    st.session_state.antecipar_roteiro = True
+
+def antecipar_roteiro(api_key):
+    """Roda no fim do script (dados já atualizados pelos widgets). No máximo uma antecipação por PEI gerado."""
+    if not st.session_state.pop('antecipar_roteiro', False): return
+    dados = st.session_state.dados
+    if not api_key or not dados['ia_sugestao'] or dados['ia_mapa_texto'] or not dados['nome'].strip(): return
+    if tarefa_pendente(["Roteiro Gamificado", "Gerar Tudo"]): return # O professor já pediu o roteiro
+    st.session_state.roteiro_antecipado = {"chave": chave_roteiro(dados), "texto": None, "id": enviar_tarefa_ia(
+        "Roteiro antecipado", gerar_roteiro_gamificado, api_key, copy.deepcopy(dados), dados['ia_sugestao'], rota="roteiro_antecipado")}
+
+def aplicar_roteiro_antecipado():
+    """
+    Usa o roteiro antecipado se as entradas não mudaram e descarta o que ficou velho.
+    Devolve True quando o roteiro exibido foi descartado.
+    """
+    antecipado, dados = st.session_state.get('roteiro_antecipado'), st.session_state.dados
+    if not antecipado: return False
+    valido = bool(dados['nome'].strip()) and antecipado['chave'] == chave_roteiro(dados)
+    if antecipado['texto']:
+        if valido or dados['ia_mapa_texto'] != antecipado['texto']: return False
+        dados['ia_mapa_texto'] = "" # Entradas mudaram: o roteiro antecipado não vale mais
+        return True
+    tarefa = consultar_tarefa_ia(antecipado['id'])
+    if valido and not dados['ia_mapa_texto'] and tarefa and tarefa['status'] == "concluida":
+        dados['ia_mapa_texto'] = antecipado['texto'] = limpar_roteiro(tarefa['resultado'])
+    return False
+
+def roteiro_antecipado_pendente():
+    antecipado = st.session_state.get('roteiro_antecipado')
+    tarefa = consultar_tarefa_ia(antecipado['id']) if antecipado else None
+    return tarefa if tarefa and tarefa['status'] in ("fila", "rodando") else None
+
+@st.fragment(run_every=1)
+def aguardar_roteiro_antecipado():
+    if roteiro_antecipado_pendente(): st.caption("⏳ O roteiro já está sendo preparado em segundo plano a partir do PEI...")
+    else: st.rerun() # Pronto: o começo do script aplica o resultado
+
+# PIPELINE: PEI TÉCNICO + GUIA PRÁTICO + ROTEIRO EM PARALELO
+def gerar_tudo_ia(api_key, dados, contexto_pdf="", ignorar_cache=False, referencias=""):
+    """
+    Dispara as três gerações independentes ao mesmo tempo, pelo mesmo caminho dos botões avulsos
+    (cache, single-flight e rotas): dois cliques, ou um Gerar Tudo e um PEI Técnico, viram uma só chamada.
+    Devolve {campo: (texto, erro)}.
+    """
+    if not api_key: return None, "⚠️ Configure a Chave API."
+    geracoes = {
+        'ia_sugestao': (consultar_gpt_pedagogico, (api_key, dados, contexto_pdf), {"ignorar_cache": ignorar_cache, "referencias": referencias}),
+        'ia_guia_pratico': (consultar_gpt_pedagogico, (api_key, dados, contexto_pdf), {"modo_pratico": True, "ignorar_cache": ignorar_cache, "referencias": referencias}),
+        'ia_mapa_texto': (gerar_roteiro_gamificado, (api_key, dados, dados['ia_sugestao']), {}),
+    }
+    # copy_context: cada thread leva a sessão dona do pedido (fila justa do limitador)
+    with ThreadPoolExecutor(max_workers=len(geracoes)) as pool:
+        futuros = {campo: pool.submit(contextvars.copy_context().run, funcao, *args, **kwargs) for campo, (funcao, args, kwargs) in geracoes.items()}
+    saida = {}
+    for campo, futuro in futuros.items():
+        texto, erro = futuro.result()
+        if erro or not texto: saida[campo] = (None, erro or "A IA não devolveu resposta.")
+        elif campo == 'ia_sugestao':
+            texto, estrutura = interpretar_resposta_pei(texto)
+            saida[campo] = (texto, None); saida['ia_estrutura'] = (estrutura, None)
+        else: saida[campo] = (limpar_roteiro(texto) if campo == 'ia_mapa_texto' else texto, None)
+    return saida, None
+
+# LOTE ESCOLAR: BATCH API DA OPENAI PARA TODOS OS ALUNOS DO BANCO
+PASTA_LOTES = "lotes_ia"
+if not os.path.exists(PASTA_LOTES): os.makedirs(PASTA_LOTES)
+
+def montar_jsonl_lote(nomes_arq, rota="pei_tecnico", sobrescrever=False):
+    """
+    Monta o JSONL do Batch API com os mesmos prompts de consultar_gpt_pedagogico (modo técnico).
+    Registros que já têm PEI (possivelmente editado pelo professor) ficam de fora, salvo sobrescrever=True.
+    """
+    linhas, chaves = [], {}
+    for nome_arq in nomes_arq:
+        dados = carregar_aluno(nome_arq)
+        if not dados or (dados.get('ia_sugestao') and not sobrescrever): continue
+        dados = {**default_state, **dados}
+        prompt_sys, prompt_user = montar_prompts_pedagogicos(dados, formatar_digest_laudo(dados.get('laudo_digest')), False, True, referencias_semelhantes(dados))
+        chaves[nome_arq] = chave_cache_ia(prompt_sys, prompt_user, ROTAS_IA[rota]['modelo'], "tecnico")
+        linhas.append(linha_lote(nome_arq, {**parametros_rota(rota), "messages": [{"role": "system", "content": prompt_sys}, {"role": "user", "content": prompt_user}], "response_format": FORMATO_PEI_JSON}))
+    return montar_jsonl(linhas), chaves
+
+def salvar_info_lote(info):
+    with open(os.path.join(PASTA_LOTES, f"{info['id']}.json"), 'w', encoding='utf-8') as f:
+        json.dump(info, f, ensure_ascii=False, indent=4)
+
+def listar_lotes():
+    lotes = []
+    for nome in os.listdir(PASTA_LOTES):
+        try:
+            with open(os.path.join(PASTA_LOTES, nome), 'r', encoding='utf-8') as f: lotes.append(json.load(f))
+        except: pass
+    return sorted(lotes, key=lambda l: l.get('criado_em', 0), reverse=True)
+
+def enviar_lote_pei(api_key, nomes_arq, sobrescrever=False):
+    if not api_key: return None, "Configure a Chave API."
+    try:
+        conteudo, chaves = montar_jsonl_lote(nomes_arq, sobrescrever=sobrescrever)
+        if not chaves: return None, "Nenhum registro sem PEI em banco_alunos." if not sobrescrever else "Nenhum registro válido em banco_alunos."
+        client = get_cliente_openai(api_key)
+        arquivo = client.files.create(file=("lote_pei.jsonl", conteudo), purpose="batch")
+        lote = client.batches.create(input_file_id=arquivo.id, endpoint="/v1/chat/completions", completion_window="24h")
+        info = {"id": lote.id, "status": lote.status, "criado_em": time.time(), "chaves_cache": chaves, "aplicado": False, "sobrescrever": sobrescrever}
+        salvar_info_lote(info)
+        return info, None
     except Exception as e: return None, str(e)
 
+def verificar_lote_pei(api_key, info):
+    """Consulta o lote; quando concluído, grava ia_sugestao em cada registro (e no cache da consultoria)."""
+    if not api_key: return info, "Configure a Chave API."
+    try:
+        client = get_cliente_openai(api_key)
+        lote = client.batches.retrieve(info['id'])
+        info['status'] = lote.status
+        if lote.status == "completed" and not info.get('aplicado') and lote.output_file_id:
+            respostas, falhas = ler_saida_lote(client.files.content(lote.output_file_id).text)
+            ok, ignorados = 0, 0
+            for nome_arq, texto in respostas:
+                # PEI criado ou editado depois do envio: não sobrescreve sem o pedido explícito
+                if not info.get('sobrescrever') and (carregar_aluno(nome_arq) or {}).get('ia_sugestao'):
+                    ignorados += 1; continue
+                prosa, estrutura = interpretar_resposta_pei(texto)
+                if prosa and atualizar_registro_aluno(nome_arq, {'ia_sugestao': prosa, 'ia_estrutura': estrutura}):
+                    ok += 1
+                    if info['chaves_cache'].get(nome_arq): gravar_cache_ia(info['chaves_cache'][nome_arq], texto)
+                else: falhas += 1
+            info.update({"aplicado": True, "sucessos": ok, "falhas": falhas, "ignorados": ignorados})
+        salvar_info_lote(info)
+        return info, None
+    except Exception as e: return info, str(e)
+
 # ==============================================================================
 # 7. GERADOR PDF (DESIGN FLAT & CLEAN - COMPATÍVEL ZAPFDINGBATS)
 # ==============================================================================
@@ -837,12 +1898,13 @@ def gerar_pdf_final(dados, tem_anexo):
                     nivel = dados['niveis_suporte'].get(f"{area}_{item}", "Monitorado")
                     pdf.add_flat_icon_item(f"{item} (Nível: {nivel})", 'check')
 
-    # 4. ESTRATÉGIA IA (Texto Limpo)
-    if dados['ia_sugestao']:
+    # 4. ESTRATÉGIA IA (Texto Limpo) E 5. GUIA PRÁTICO
+    for campo, titulo in (('ia_sugestao', "Estratégias Pedagógicas"), ('ia_guia_pratico', "Guia Prático (Chão de Sala)")):
+        if not dados.get(campo): continue
         pdf.add_page()
-        pdf.section_title("Estratégias Pedagógicas")
+        pdf.section_title(titulo)
         
-        texto_limpo = limpar_texto_pdf(dados['ia_sugestao'])
+        texto_limpo = limpar_texto_pdf(dados[campo])
         # Remove tags técnicas do texto final
         texto_limpo = re.sub(r'\[.*?\]', '', texto_limpo) 
         
@@ -894,6 +1956,9 @@ def gerar_docx_final(dados):
     if dados['ia_sugestao']:
         t_limpo = re.sub(r'\[.*?\]', '', dados['ia_sugestao'])
         doc.add_paragraph(t_limpo)
+    if dados.get('ia_guia_pratico'):
+        doc.add_heading('Guia Prático (Chão de Sala)', 1)
+        doc.add_paragraph(re.sub(r'\[.*?\]', '', dados['ia_guia_pratico']))
     b = BytesIO(); doc.save(b); b.seek(0); return b
 
 # ==============================================================================
@@ -905,6 +1970,11 @@ with st.sidebar:
     if logo: st.image(logo, width=120)
     if 'OPENAI_API_KEY' in st.secrets: api_key = st.secrets['OPENAI_API_KEY']; st.success("✅ OpenAI OK")
     else: api_key = st.text_input("Chave OpenAI:", type="password")
+    modo_stream = st.toggle("⚡ Mostrar texto enquanto a IA escreve", value=True, help="Exibe o PEI e o roteiro aos poucos, sem esperar a resposta completa.")
+    recuperar_tarefas_sessao()
+    if st.session_state.tarefas_ia: painel_tarefas_ia(api_key)
+    mostrar_avisos_tarefas()
+    aplicar_roteiro_antecipado()
     
     st.info("⚠️ **Aviso de IA:** O conteúdo é gerado por inteligência artificial. Revise todas as informações antes de aplicar. O professor é o responsável final pelo documento.")
     
@@ -915,7 +1985,8 @@ with st.sidebar:
             d = json.load(uploaded_json)
             if 'nasc' in d: d['nasc'] = date.fromisoformat(d['nasc'])
             if d.get('monitoramento_data'): d['monitoramento_data'] = date.fromisoformat(d['monitoramento_data'])
-            st.session_state.dados.update(d); st.success("Carregado!")
+            st.session_state.dados.update(d); st.session_state.registro_aluno = hashlib.sha256(uploaded_json.getvalue()).hexdigest()[:16]
+            st.success("Carregado!")
         except: st.error("Erro no arquivo.")
     st.markdown("---")
     if st.button("💾 Registrar Aluno", use_container_width=True):
@@ -924,6 +1995,29 @@ with st.sidebar:
         else: st.error(msg)
     st.markdown("---")
 
+    with st.expander("🏫 Geração em Lote (Escola)"):
+        st.caption("Gera o PEI técnico dos alunos registrados que ainda não têm PEI, pela Batch API da OpenAI (mais barato, resultado em até 24h).")
+        alunos_banco = listar_alunos()
+        st.write(f"{len(alunos_banco)} registro(s) em `{PASTA_BANCO}/`")
+        sobrescrever_lote = st.checkbox("Incluir alunos que já têm PEI (substitui o texto atual, inclusive edições)", value=False)
+        if st.button("📤 Enviar Lote", use_container_width=True, disabled=not alunos_banco):
+            info, err = enviar_lote_pei(api_key, alunos_banco, sobrescrever_lote)
+            if info: st.success(f"Lote {info['id']} enviado.")
+            else: st.error(err)
+        for info in listar_lotes()[:3]:
+            st.markdown(f"`{info['id']}` · **{info['status']}**" + (f" · {info.get('sucessos', 0)} PEIs gravados" + (f", {info['ignorados']} já tinham PEI" if info.get('ignorados') else "") if info.get('aplicado') else ""))
+            if not info.get('aplicado') and info['status'] not in ("failed", "expired", "cancelled") and st.button("🔄 Verificar", key=f"lote_{info['id']}", use_container_width=True):
+                info, err = verificar_lote_pei(api_key, info)
+                if err: st.error(err)
+                else: st.rerun()
+    with st.expander("📊 Custo e Latência por Tarefa"):
+        st.caption("Últimas 24h, todas as sessões (atualizado a cada minuto). Modelos e limites por tarefa: ROTAS_IA / PEI_ROTAS_IA.")
+        uso_ia = resumo_uso_ia()
+        if uso_ia: st.dataframe(uso_ia, hide_index=True, use_container_width=True)
+        else: st.write("Nenhuma chamada à IA ainda.")
+        st.page_link("pages/Admin_Telemetria_IA.py", label="Abrir painel de telemetria", icon="📈")
+    st.markdown("---")
+
 # HEADER
 logo_path = finding_logo(); b64_logo = get_base64_image(logo_path); mime = "image/png"
 img_html = f'<img src="data:{mime};base64,{b64_logo}" style="height: 110px;">' if logo_path else ""
@@ -951,14 +2045,8 @@ tab0, tab1, tab2, tab3, tab4, tab5, tab6, tab7, tab8, tab_mapa = st.tabs(abas)
 
 with tab0: # INÍCIO (SEM TÍTULO FUNDAMENTOS)
     if api_key:
-        with st.spinner("Conectando à IA..."):
-            try:
-                client = OpenAI(api_key=api_key)
-                saudacao = client.chat.completions.create(model="gpt-4o-mini", messages=[{"role": "user", "content": "Frase muito curta e motivadora para professor de educação inclusiva."}], max_tokens=30).choices[0].message.content
-                noticia = client.chat.completions.create(model="gpt-4o-mini", messages=[{"role": "user", "content": "Dica relâmpago (1 frase) sobre neurociência na escola."}], max_tokens=40).choices[0].message.content
-            except:
-                saudacao = "A inclusão transforma vidas."
-                noticia = "O cérebro aprende quando emocionado."
+        saudacao = gerar_saudacao_ia(api_key)
+        noticia = gerar_noticia_ia(api_key)
         
         # HERO BANNER
         st.markdown(f"""
@@ -1042,34 +2130,27 @@ with tab1: # ESTUDANTE
     # --- NOVO BLOCO: UPLOAD DE LAUDO ---
     col_pdf, col_btn_ia = st.columns([2, 1])
     with col_pdf:
-        st.markdown("**📎 Upload de Laudo Médico/Escolar (PDF)**")
-        up = st.file_uploader("Arraste o arquivo aqui", type="pdf", label_visibility="collapsed")
-        if up: st.session_state.pdf_text = ler_pdf(up)
+        st.markdown("**📎 Upload de Laudos Médicos/Escolares (PDF)**")
+        ups = st.file_uploader("Arraste os arquivos aqui (neuropediatra, fono, TO, psicopedagogia...)", type="pdf", accept_multiple_files=True, label_visibility="collapsed")
+        ids = tuple(up.file_id for up in ups)
+        if ups and ids != st.session_state.get('pdf_ids'): # Mesmos uploads: nada a refazer neste rerun
+            st.session_state.pdf_text, st.session_state.pdf_hash, st.session_state.pdf_resumo, st.session_state.pdf_falhas = ler_laudos(ups)
+            st.session_state.pdf_ids = ids
+        if ups and st.session_state.pdf_resumo: st.caption(st.session_state.pdf_resumo)
+        if ups and st.session_state.pdf_falhas: # Fica visível enquanto o arquivo ruim estiver no upload
+            st.error(f"Não foi possível ler: {', '.join(st.session_state.pdf_falhas)}. O arquivo pode estar corrompido ou incompleto; remova e envie de novo."
+                     + (" Os demais laudos foram lidos." if st.session_state.pdf_text else ""))
     
     with col_btn_ia:
         st.write("") # Espaço para alinhar
         st.write("") 
-        if st.button("✨ Extrair Dados do Laudo", type="primary", use_container_width=True, disabled=(not st.session_state.pdf_text), help="A IA lerá o PDF e preencherá automaticamente o Diagnóstico e a Medicação abaixo."):
-            with st.spinner("Analisando laudo..."):
-                dados_extraidos, erro = extrair_dados_pdf_ia(api_key, st.session_state.pdf_text)
-                if dados_extraidos:
-                    # Preenche Diagnóstico
-                    if dados_extraidos.get("diagnostico"):
-                        st.session_state.dados['diagnostico'] = dados_extraidos["diagnostico"]
-                    
-                    # Preenche Medicamentos (adiciona à lista existente)
-                    if dados_extraidos.get("medicamentos"):
-                        for med in dados_extraidos["medicamentos"]:
-                            st.session_state.dados['lista_medicamentos'].append({
-                                "nome": med.get("nome", "Não ident."),
-                                "posologia": med.get("posologia", ""),
-                                "obs": "Extraído do Laudo",
-                                "escola": False
-                            })
-                    st.success("Dados extraídos com sucesso!")
-                    st.rerun()
-                else:
-                    st.error(f"Erro na extração: {erro}")
+        em_leitura = tarefa_pendente(["Leitura do Laudo"]) is not None
+        if st.button("⏳ Analisando laudo..." if em_leitura else "✨ Extrair Dados do Laudo", type="primary", use_container_width=True, disabled=(not st.session_state.pdf_text) or em_leitura, help="CID e remédios escritos de forma explícita são lidos na hora; nos demais casos a IA lê os PDFs. Preenche automaticamente o Diagnóstico e a Medicação abaixo."):
+            local = extrator_laudo.extrair_local(st.session_state.pdf_text)
+            if local['confianca'] >= extrator_laudo.CONFIANCA_MINIMA: # CID e remédios explícitos: preenche na hora, sem chamada à IA
+                aplicar_dados_laudo(api_key, local)
+                st.toast(f"Laudo lido localmente (confiança {local['confianca']:.0%}).")
+            else: agendar_tarefa_sessao("Leitura do Laudo", extrair_dados_pdf_ia, api_key, st.session_state.pdf_text, st.session_state.pdf_hash)
     # -----------------------------------
 
     st.divider()
@@ -1219,23 +2300,52 @@ with tab7: # IA (CONSULTORIA PEDAGÓGICA)
         
         st.warning("⚠️ **Atenção:** A IA pode cometer erros. Revise todo o conteúdo gerado.")
 
+        forcar_nova = st.checkbox("🔁 Forçar nova geração", help="Ignora o resultado salvo para estes mesmos dados e pede uma resposta nova à IA.")
+
+        semelhantes = buscar_peis_semelhantes(st.session_state.dados)
+        # Desligado por padrão: ligado, o prompt (e a chave do cache) passa a depender dos PEIs salvos de outros estudantes
+        usar_referencias = st.checkbox("📎 Usar PEIs semelhantes como referência", value=False, disabled=not semelhantes,
+                                       help="Envia à IA, de forma resumida, as metas de PEIs já prontos de estudantes com perfil parecido.")
+        referencias = referencias_semelhantes(st.session_state.dados) if usar_referencias else ""
+
         # Botão 1: PEI Técnico Padrão
+        # As gerações rodam em segundo plano sobre uma cópia dos dados: o professor segue editando as outras abas
+        consulta = consultar_gpt_pedagogico_stream if modo_stream else consultar_gpt_pedagogico
         if st.button(f"✨ Criar Estratégia Técnica (PEI)", type="primary", use_container_width=True):
-            res, err = consultar_gpt_pedagogico(api_key, st.session_state.dados, st.session_state.pdf_text, modo_pratico=False)
-            if res: 
-                st.session_state.dados['ia_sugestao'] = res
-                st.balloons()
-            else: st.error(err)
+            agendar_tarefa_sessao("PEI Técnico", com_contexto_laudo(consulta), api_key, copy.deepcopy(st.session_state.dados), laudo_sessao(), modo_pratico=False, ignorar_cache=forcar_nova, referencias=referencias, stream=modo_stream)
             
         # Botão 2: PEI Prático (Novo)
         st.write("")
         st.markdown("**Opções Avançadas:**")
         if st.button("🔄 Criar Guia Prático (Chão de Sala)", use_container_width=True, help="Gera um guia direto de manejo e adaptação, sem termos técnicos complexos."):
-             res, err = consultar_gpt_pedagogico(api_key, st.session_state.dados, st.session_state.pdf_text, modo_pratico=True)
-             if res:
-                 st.session_state.dados['ia_sugestao'] = res
-                 st.toast("Estratégia Prática Gerada com Sucesso!")
-             else: st.error(err)
+             agendar_tarefa_sessao("Guia Prático", com_contexto_laudo(consulta), api_key, copy.deepcopy(st.session_state.dados), laudo_sessao(), modo_pratico=True, ignorar_cache=forcar_nova, referencias=referencias, stream=modo_stream)
+
+        st.write("")
+        if st.button("🚀 Gerar Tudo (PEI + Guia + Roteiro)", use_container_width=True, help="Cria o PEI técnico, o guia prático e o roteiro gamificado ao mesmo tempo."):
+            agendar_tarefa_sessao("Gerar Tudo", com_contexto_laudo(gerar_tudo_ia), api_key, copy.deepcopy(st.session_state.dados), laudo_sessao(), ignorar_cache=forcar_nova, referencias=referencias)
+
+        render_latencia_ia(["PEI Técnico", "Guia Prático"])
+
+        if semelhantes:
+            with st.expander(f"🧬 PEIs Semelhantes ({len(semelhantes)})"):
+                st.caption("Estudantes do banco com barreiras, níveis de suporte, potencialidades e segmento parecidos, já com PEI pronto.")
+                for i, r in enumerate(semelhantes):
+                    iniciais = ".".join(p[0] for p in r['nome'].split()[:2]).upper() or "?"
+                    st.markdown(f"**{iniciais}.** · {r['serie'] or 'Série não informada'} · {r['semelhanca']:.0%} semelhante")
+                    if st.button("📋 Usar como rascunho", key=f"rascunho_semelhante_{i}", use_container_width=True):
+                        texto, estrutura = rascunho_pei_semelhante(st.session_state.dados, r['arquivo'])
+                        if texto:
+                            st.session_state.dados['ia_sugestao'], st.session_state.dados['ia_estrutura'] = texto, estrutura
+                            st.session_state.pop("editor_ia", None)
+                            st.rerun()
+
+        secoes = secoes_presentes(st.session_state.dados['ia_sugestao'])
+        if secoes:
+            with st.expander("✂️ Refazer Só Uma Seção"):
+                secao = st.selectbox("Seção", secoes, key="secao_regerar")
+                pedido = st.text_input("O que mudar? (opcional)", placeholder="Ex: metas mais curtas e mensuráveis", key="pedido_secao")
+                if st.button("♻️ Refazer Seção", use_container_width=True, disabled=bool(tarefa_pendente(["Refazer Seção"]))):
+                    agendar_tarefa_sessao("Refazer Seção", regenerar_secao_pei, api_key, copy.deepcopy(st.session_state.dados), secao, pedido, ignorar_cache=forcar_nova)
 
         with st.expander("📚 Base Técnica & Legal"):
             st.markdown("""
@@ -1245,15 +2355,20 @@ with tab7: # IA (CONSULTORIA PEDAGÓGICA)
             """)
 
     with col_right:
+        if tarefa_pendente(["PEI Técnico", "Guia Prático", "Gerar Tudo"]): previa_tarefa_ia(["PEI Técnico", "Guia Prático", "Gerar Tudo"])
         if st.session_state.dados['ia_sugestao']:
             with st.expander("🔍 Entenda a Lógica (Calibragem)"):
                 st.markdown("""**Como este plano foi construído:**\n* **Filtro Vygotsky:** Identificação da Zona de Desenvolvimento Proximal.\n* **Análise Farmacológica:** Impacto da medicação na aprendizagem.""")
             st.markdown(st.session_state.dados['ia_sugestao'])
             st.info("📝 **Personalize:** O texto acima é editável.")
             novo_texto = st.text_area("Editor de Conteúdo", value=st.session_state.dados['ia_sugestao'], height=400, key="editor_ia")
+            if novo_texto != st.session_state.dados['ia_sugestao']: st.session_state.dados['ia_estrutura'] = {} # Texto editado: o dashboard volta a ler as tags
             st.session_state.dados['ia_sugestao'] = novo_texto
         else:
             st.info(f"👈 Clique no botão ao lado para gerar o plano de {nome_aluno}.")
+        if st.session_state.dados['ia_guia_pratico']:
+            with st.expander("🧭 Guia Prático (Chão de Sala)", expanded=not st.session_state.dados['ia_sugestao']):
+                st.markdown(st.session_state.dados['ia_guia_pratico'])
 
 with tab8: # DASHBOARD & DOCS (RENOMEADO)
     render_progresso()
@@ -1302,7 +2417,7 @@ with tab8: # DASHBOARD & DOCS (RENOMEADO)
             else:
                 st.markdown(f"""<div class="soft-card sc-green"><div class="sc-head"><i class="ri-checkbox-circle-fill" style="color:#38A169;"></i> Medicação</div><div class="sc-body">Nenhuma medicação informada.</div><div class="bg-icon">✅</div></div>""", unsafe_allow_html=True)
             st.write("")
-            metas = extrair_metas_estruturadas(st.session_state.dados['ia_sugestao'])
+            metas = metas_do_pei(st.session_state.dados)
             if metas:
                 html_metas = f"""<div class="meta-row"><span style="font-size:1.2rem;">🏁</span> <b>Curto:</b> {metas['Curto']}</div><div class="meta-row"><span style="font-size:1.2rem;">🧗</span> <b>Médio:</b> {metas['Medio']}</div><div class="meta-row"><span style="font-size:1.2rem;">🏔️</span> <b>Longo:</b> {metas['Longo']}</div>"""
             else: html_metas = "Gere o plano na aba IA."
@@ -1314,13 +2429,13 @@ with tab8: # DASHBOARD & DOCS (RENOMEADO)
             is_ei = nivel == "EI"
             
             if is_ei:
-                direitos = extrair_campos_experiencia(st.session_state.dados['ia_sugestao'])
+                direitos = campos_do_pei(st.session_state.dados)
                 html_tags = "".join([f'<span class="bloom-tag">{d}</span>' for d in direitos])
                 card_title = "Campos de Experiência (BNCC)"
                 card_desc = "Foco pedagógico prioritário:"
                 card_icon = "🧸"
             else:
-                verbos = extrair_bloom(st.session_state.dados['ia_sugestao'])
+                verbos = bloom_do_pei(st.session_state.dados)
                 html_tags = "".join([f'<span class="bloom-tag">{v}</span>' for v in verbos])
                 card_title = "Taxonomia de Bloom (Verbos)"
                 card_desc = "Verbos de comando sugeridos para atividades:"
@@ -1351,7 +2466,7 @@ with tab8: # DASHBOARD & DOCS (RENOMEADO)
             target.markdown(f"""<div class="dna-bar-container"><div class="dna-bar-flex"><span>{area}</span><span>{qtd} barreiras</span></div><div class="dna-bar-bg"><div class="dna-bar-fill" style="width:{val}%; background:{color};"></div></div></div>""", unsafe_allow_html=True)
         
         st.divider()
-        if st.session_state.dados['ia_sugestao']:
+        if st.session_state.dados['ia_sugestao'] or st.session_state.dados['ia_guia_pratico']:
             c1, c2 = st.columns(2)
             with c1:
                 pdf = gerar_pdf_final(st.session_state.dados, len(st.session_state.pdf_text)>0)
@@ -1383,20 +2498,16 @@ with tab_mapa: # ABA NOVA (JORNADA DO ALUNO)
     if st.session_state.dados['ia_sugestao']:
         # Botão para Gerar o Mapa (Chama a IA Gamificada)
         if st.button("🎮 Criar Roteiro Gamificado", type="primary"):
-            with st.spinner("O Game Master está criando o roteiro..."):
-                texto_game, err = gerar_roteiro_gamificado(api_key, st.session_state.dados, st.session_state.dados['ia_sugestao'])
-                
-                if texto_game:
-                    clean = texto_game.replace("[MAPA_TEXTO_GAMIFICADO]", "").replace("[FIM_MAPA_TEXTO_GAMIFICADO]", "").strip()
-                    st.session_state.dados['ia_mapa_texto'] = clean
-                    st.rerun()
-                else:
-                    st.error(f"Erro ao gerar: {err}")
+            if modo_stream: agendar_tarefa_sessao("Roteiro Gamificado", gerar_roteiro_gamificado_stream, api_key, copy.deepcopy(st.session_state.dados), stream=True)
+            else: agendar_tarefa_sessao("Roteiro Gamificado", gerar_roteiro_gamificado, api_key, copy.deepcopy(st.session_state.dados), st.session_state.dados['ia_sugestao'])
+        if tarefa_pendente(["Roteiro Gamificado"]): previa_tarefa_ia(["Roteiro Gamificado"])
+        elif not st.session_state.dados['ia_mapa_texto'] and roteiro_antecipado_pendente(): aguardar_roteiro_antecipado()
         
         # Exibição do Mapa (TEXTO PURO)
         if st.session_state.dados['ia_mapa_texto']:
             st.markdown("### 📜 Roteiro de Poderes")
             st.markdown(st.session_state.dados['ia_mapa_texto']) # Renderiza Markdown nativo
+            render_latencia_ia(["Roteiro Gamificado"])
             
             st.divider()
             
@@ -1411,5 +2522,10 @@ with tab_mapa: # ABA NOVA (JORNADA DO ALUNO)
     else:
         st.warning("⚠️ Gere o PEI Técnico na aba 'Consultoria IA' primeiro.")
 
+# Roteiro antecipado: no fim do script, quando os widgets já atualizaram os dados
+roteiro_descartado = aplicar_roteiro_antecipado()
+antecipar_roteiro(api_key)
+if roteiro_descartado: st.rerun()
+
 # Footer final
 st.markdown("<div class='footer-signature'>PEI 360º v116.0 Gold Edition - Desenvolvido por Rodrigo A. Queiroz</div>", unsafe_allow_html=True)
@@ -0,0 +1,133 @@
+"""
+Telemetria local das chamadas à IA do PEI 360º (SQLite, só acrescenta linhas).
+
+O streamlit_app.py grava uma linha por chamada (ou acerto de cache) e a página
+"Admin Telemetria IA" lê os percentis por tarefa e por dia.
+Caminho do banco: PEI_TELEMETRIA_DB (padrão telemetria_ia.sqlite3 na pasta do app).
+"""
+from datetime import datetime
+import os
+import sqlite3
+import threading
+import time
+
+ARQUIVO_TELEMETRIA = os.environ.get("PEI_TELEMETRIA_DB", "telemetria_ia.sqlite3")
+_TRAVA = threading.Lock()
+_CONEXOES = {}
+
+ESQUEMA = """
+CREATE TABLE IF NOT EXISTS chamadas_ia (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    quando REAL NOT NULL,
+    dia TEXT NOT NULL,
+    tarefa TEXT NOT NULL,
+    modelo TEXT,
+    tokens_entrada INTEGER NOT NULL DEFAULT 0,
+    tokens_saida INTEGER NOT NULL DEFAULT 0,
+    tokens_cache INTEGER NOT NULL DEFAULT 0,
+    latencia REAL,
+    ttft REAL,
+    espera_fila REAL NOT NULL DEFAULT 0,
+    cache TEXT NOT NULL,
+    erro TEXT,
+    fallback INTEGER NOT NULL DEFAULT 0,
+    custo REAL NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_chamadas_ia_dia ON chamadas_ia (dia, tarefa);
+"""
+# Colunas acrescentadas depois da primeira versão: bancos antigos ganham a coluna na abertura
+MIGRACOES = {"tokens_cache": "ALTER TABLE chamadas_ia ADD COLUMN tokens_cache INTEGER NOT NULL DEFAULT 0"}
+
+# ==============================================================================
+# 1. GRAVAÇÃO
+# ==============================================================================
+def _conexao():
+    # Uma conexão por arquivo para o processo todo (o caminho absoluto muda se o cwd mudar)
+    caminho = os.path.abspath(ARQUIVO_TELEMETRIA)
+    con = _CONEXOES.get(caminho)
+    if con is None:
+        con = sqlite3.connect(caminho, check_same_thread=False, timeout=5)
+        con.execute("PRAGMA journal_mode=WAL")
+        con.executescript(ESQUEMA)
+        colunas = {linha[1] for linha in con.execute("PRAGMA table_info(chamadas_ia)")}
+        for coluna, sql in MIGRACOES.items():
+            if coluna not in colunas: con.execute(sql)
+        con.commit()
+        _CONEXOES[caminho] = con
+    return con
+
+def registrar_chamada(tarefa, modelo=None, tokens_entrada=0, tokens_saida=0, latencia=None, ttft=None,
+                      espera_fila=0.0, cache="miss", erro=None, fallback=False, custo=0.0, tokens_cache=0):
+    """Acrescenta uma linha. Falha de telemetria nunca derruba a geração do PEI."""
+    agora = time.time()
+    try:
+        with _TRAVA:
+            con = _conexao()
+            con.execute(
+                "INSERT INTO chamadas_ia (quando, dia, tarefa, modelo, tokens_entrada, tokens_saida, tokens_cache, latencia, ttft, espera_fila, cache, erro, fallback, custo) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (agora, datetime.fromtimestamp(agora).strftime("%Y-%m-%d"), tarefa, modelo, int(tokens_entrada or 0), int(tokens_saida or 0), int(tokens_cache or 0),
+                 latencia, ttft, float(espera_fila or 0), cache, erro, int(bool(fallback)), float(custo or 0))
+            )
+            con.commit()
+        return True
+    except: return False
+
+# ==============================================================================
+# 2. CONSULTA (PÁGINA DE ADMINISTRAÇÃO)
+# ==============================================================================
+def ler_chamadas(desde):
+    try:
+        with _TRAVA:
+            cur = _conexao().execute("SELECT * FROM chamadas_ia WHERE quando >= ? ORDER BY quando", (desde,))
+            colunas = [c[0] for c in cur.description]
+            return [dict(zip(colunas, linha)) for linha in cur.fetchall()]
+    except: return []
+
+def percentil(valores, p):
+    """Percentil com interpolação linear (p de 0 a 100); None se não houver valores."""
+    valores = sorted(v for v in valores if v is not None)
+    if not valores: return None
+    pos = (len(valores) - 1) * p / 100
+    base = int(pos)
+    if base + 1 >= len(valores): return valores[-1]
+    return valores[base] + (valores[base + 1] - valores[base]) * (pos - base)
+
+def _arredondar(valor, casas=2):
+    return round(valor, casas) if valor is not None else None
+
+def resumir(chamadas, por_dia=False):
+    """Agrupa por tarefa (e dia): latência/ttft/espera em percentis só das chamadas reais que deram certo."""
+    grupos = {}
+    for c in chamadas:
+        grupos.setdefault((c['dia'] if por_dia else "", c['tarefa']), []).append(c)
+    linhas = []
+    for (dia, tarefa), itens in sorted(grupos.items()):
+        reais = [c for c in itens if c['cache'] == "miss" and not c['erro']]
+        latencias = [c['latencia'] for c in reais]
+        linha = {"Dia": dia} if por_dia else {}
+        linha.update({
+            "Tarefa": tarefa, "Chamadas": len(itens),
+            "Cache hit (%)": round(100 * sum(c['cache'] == "hit" for c in itens) / len(itens), 1),
+            "Erros": sum(1 for c in itens if c['erro']),
+            "p50 (s)": _arredondar(percentil(latencias, 50)), "p90 (s)": _arredondar(percentil(latencias, 90)), "p99 (s)": _arredondar(percentil(latencias, 99)),
+            "p50 1º token (s)": _arredondar(percentil([c['ttft'] for c in reais], 50)),
+            "p90 fila (s)": _arredondar(percentil([c['espera_fila'] for c in reais], 90)),
+            "Tokens entrada": sum(c['tokens_entrada'] for c in itens), "Tokens saída": sum(c['tokens_saida'] for c in itens),
+            "Entrada em cache (%)": percentual_cache(itens),
+            "Custo (US$)": round(sum(c['custo'] for c in itens), 4),
+            "Fallbacks": sum(c['fallback'] for c in itens),
+        })
+        linhas.append(linha)
+    return linhas
+
+def percentual_cache(chamadas):
+    """Fração dos tokens de entrada servida pelo cache de prompt da OpenAI."""
+    entrada = sum(c['tokens_entrada'] for c in chamadas)
+    return round(100 * sum(c['tokens_cache'] for c in chamadas) / entrada, 1) if entrada else 0.0
+
+def erros_por_classe(chamadas):
+    contagem = {}
+    for c in chamadas:
+        if c['erro']: contagem[(c['tarefa'], c['erro'])] = contagem.get((c['tarefa'], c['erro']), 0) + 1
+    return [{"Tarefa": t, "Erro": e, "Ocorrências": n} for (t, e), n in sorted(contagem.items(), key=lambda x: -x[1])]
@@ -0,0 +1,30 @@
+from contexto_ia import contar_tokens, empacotar_contexto
+
+
+def test_frase_clinica_longa_vence_linhas_curtas_de_preenchimento():
+    sessoes = [f"Paciente compareceu à sessão {n}" for n in range(1, 61)]
+    conclusao = ("Conclusão: o conjunto das avaliações realizadas ao longo do acompanhamento indica "
+                 "quadro compatível com Transtorno do Espectro Autista (TEA), CID F84.0, com necessidade "
+                 "de suporte nível 1 e acompanhamento fonoaudiológico e psicopedagógico contínuo.")
+    laudo = "\n".join(sessoes[:30] + [conclusao] + sessoes[30:])
+    pacote = empacotar_contexto([("laudo", laudo, 3, 300)], 300)["laudo"]
+    assert conclusao in pacote
+    assert contar_tokens(pacote) <= 300 + pacote.count("\n") + 1
+
+
+def test_empate_mantem_ordem_do_texto_e_respeita_orcamento():
+    linhas = [f"Linha de observação número {n}" for n in range(20)]
+    pacote = empacotar_contexto([("historico", "\n".join(linhas), 1, 40)], 40)["historico"].splitlines()
+    assert pacote == linhas[:len(pacote)]
+    assert 0 < len(pacote) < 20
+
+
+def test_prioridade_da_secao_e_orcamento_total():
+    secoes = [("familia", "Mora com a avó", 1, 100), ("barreiras", "- Cognitivas: Atenção (Substancial)", 5, 100)]
+    pacote = empacotar_contexto(secoes, contar_tokens("- Cognitivas: Atenção (Substancial)"))
+    assert pacote == {"familia": "", "barreiras": "- Cognitivas: Atenção (Substancial)"}
+
+
+def test_linhas_repetidas_entre_secoes_entram_uma_vez():
+    pacote = empacotar_contexto([("laudo", "Diagnóstico: TDAH", 3, 100), ("historico", "Diagnóstico: TDAH\nRetenção no 2º ano", 2, 100)], 200)
+    assert pacote == {"laudo": "Diagnóstico: TDAH", "historico": "Retenção no 2º ano"}
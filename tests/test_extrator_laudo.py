@@ -0,0 +1,38 @@
+from extrator_laudo import CONFIANCA_MINIMA, extrair_cids, extrair_local, extrair_medicamentos
+
+
+def test_cid_e_remedio_explicitos_do_estudante_sao_lidos_localmente():
+    laudo = "Conclusão: TEA, CID F84.0 e F90.0. Em uso de Ritalina 10mg 1x/dia e risperidona 0,5 mg à noite."
+    local = extrair_local(laudo)
+    assert local["cids"] == ["F84.0", "F90.0"]
+    assert [m["nome"] for m in local["medicamentos"]] == ["Ritalina (metilfenidato)", "Risperidona"]
+    assert local["medicamentos"][0]["posologia"] == "10mg 1x/dia"
+    assert local["confianca"] >= CONFIANCA_MINIMA
+
+
+def test_cid_e_remedio_de_familiar_vao_para_a_ia():
+    laudo = "pai com diagnóstico de TDAH (CID F90.0). Mãe em uso de sertralina 50mg 1x/dia."
+    assert all(c < CONFIANCA_MINIMA for _, _, c in extrair_cids(laudo))
+    assert all(m["confianca"] < CONFIANCA_MINIMA for m in extrair_medicamentos(laudo))
+    assert extrair_local(laudo)["confianca"] < CONFIANCA_MINIMA
+
+
+def test_hipotese_em_investigacao_vai_para_a_ia():
+    assert extrair_local("Hipótese diagnóstica: F90.0, em investigação")["confianca"] < CONFIANCA_MINIMA
+    assert extrair_local("Suspeita de TEA (CID F84.0), a esclarecer.")["confianca"] < CONFIANCA_MINIMA
+
+
+def test_negacao_vale_so_na_oracao_do_codigo():
+    assert [c for c, _, _ in extrair_cids("Foi descartado F84.0, porém CID F90.0 confirmado")] == ["F90.0"]
+    assert [c for c, _, _ in extrair_cids("Descartados F84.0, F90.0. CID F81.0")] == ["F81.0"]
+    assert extrair_cids("Descartado TDAH (CID F90.0)") == []
+    assert [c for c, _, _ in extrair_cids("Exclui-se F84.0. CID F90.0")] == ["F90.0"]
+    assert extrair_cids("Quadro que exclui F84") == []
+    assert [m["nome"] for m in extrair_medicamentos("Suspensa a ritalina, porém mantém risperidona 1mg à noite.")] == ["Risperidona"]
+
+
+def test_codigo_solto_sem_cid_nao_vira_diagnostico():
+    assert extrair_cids("Atendimento na Sala R 62, Bloco H 54.") == []
+    local = extrair_local("Atendimento na Sala R62, Bloco H54.")
+    assert local["confianca"] < CONFIANCA_MINIMA
+    assert extrair_local("Diagnóstico: TEA (F84.0).")["confianca"] >= CONFIANCA_MINIMA
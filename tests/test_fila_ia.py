@@ -0,0 +1,93 @@
+import threading
+import time
+
+import fila_ia
+
+
+def _esperar_tarefa(id_tarefa, limite=5):
+    fim = time.time() + limite
+    while time.time() < fim:
+        tarefa = fila_ia.consultar_tarefa_ia(id_tarefa)
+        if tarefa['fim']: return tarefa
+        time.sleep(0.01)
+    raise AssertionError("tarefa não terminou")
+
+
+def test_limitador_alterna_sessoes_na_mesma_prioridade(monkeypatch):
+    monkeypatch.setattr(fila_ia, "IA_LIMITE_RPM", 240) # Uma ficha a cada 0,25s
+    monkeypatch.setattr(fila_ia, "CAPACIDADE_REQ", 1.0)
+    lim = fila_ia._novo_limitador()
+    lim['fichas_req'] = 0.0
+    monkeypatch.setattr(fila_ia, "_LIMITADOR", lim)
+    ordem = []
+
+    def pedir(sessao, rotulo):
+        fila_ia.SESSAO_IA.set(sessao)
+        fila_ia.aguardar_vez_ia(10)
+        ordem.append(rotulo)
+
+    threads = [threading.Thread(target=pedir, args=a) for a in [("a", "a1"), ("a", "a2"), ("b", "b1")]]
+    for t in threads: t.start(); time.sleep(0.02)
+    assert fila_ia.posicao_fila_ia("b") == 2
+    for t in threads: t.join(5)
+    assert ordem == ["a1", "b1", "a2"]
+    assert fila_ia.posicao_fila_ia("b") is None
+
+
+def test_pedidos_identicos_viram_uma_so_geracao():
+    chamadas, liberar = [], threading.Event()
+
+    def tarefa():
+        chamadas.append(1)
+        yield "PEI "
+        liberar.wait(5)
+        yield "pronto"
+
+    primeiro = fila_ia.entrar_voo("chave-teste", tarefa)
+    segundo = fila_ia.entrar_voo("chave-teste", tarefa)
+    assert primeiro is segundo
+    liberar.set()
+    assert fila_ia.resultado_voo(primeiro) == ("PEI pronto", None)
+    assert fila_ia.resultado_voo(segundo) == ("PEI pronto", None)
+    assert len(chamadas) == 1
+    # Terminado o voo, a mesma chave gera de novo
+    assert fila_ia.entrar_voo("chave-teste", tarefa) is not primeiro
+
+
+def test_erro_do_voo_chega_a_quem_acompanha():
+    def tarefa():
+        yield "meio"
+        raise RuntimeError("timeout")
+
+    metricas = {}
+    assert list(fila_ia.acompanhar_voo(fila_ia.entrar_voo("chave-erro", tarefa), metricas)) == ["meio"]
+    assert metricas['erro'] == "timeout"
+
+
+def test_tarefa_guarda_resultado_erro_e_sessao():
+    fila_ia.SESSAO_IA.set("sessao-x")
+    ok = _esperar_tarefa(fila_ia.enviar_tarefa_ia("PEI", lambda a, b: (a + b, None), "P", "EI"))
+    assert (ok['status'], ok['resultado'], ok['sessao']) == ("concluida", "PEI", "sessao-x")
+
+    def quebra(): raise ValueError("sem chave")
+    assert _esperar_tarefa(fila_ia.enviar_tarefa_ia("PEI", quebra))['erro'] == "sem chave"
+    assert _esperar_tarefa(fila_ia.enviar_tarefa_ia("PEI", lambda: (None, None)))['status'] == "erro"
+
+
+def test_tarefa_em_stream_mostra_o_parcial():
+    def gerar(metricas=None):
+        yield "Olá, "
+        yield "turma"
+
+    tarefa = _esperar_tarefa(fila_ia.enviar_tarefa_ia("Roteiro", gerar, stream=True))
+    assert (tarefa['parcial'], tarefa['resultado']) == ("Olá, turma", "Olá, turma")
+
+
+def test_resultado_de_outro_estudante_nao_e_aplicado():
+    ana, bia = ("Ana Souza", ""), ("Bia Lima", "3f9a")
+    tarefa = _esperar_tarefa(fila_ia.enviar_tarefa_ia("PEI Técnico", lambda: ("PEI da Ana", None), dono=ana))
+    assert tarefa['dono'] == ana
+    assert fila_ia.tarefa_do_dono(tarefa, ana)
+    assert not fila_ia.tarefa_do_dono(tarefa, bia) # Carregaram o backup da Bia com a geração em andamento
+    assert not fila_ia.tarefa_do_dono(tarefa, ("Ana Souza", "3f9a")) # Mesmo nome, outro registro
+    assert fila_ia.tarefa_do_dono(_esperar_tarefa(fila_ia.enviar_tarefa_ia("Feed", lambda: ("ok", None))), bia)
@@ -0,0 +1,73 @@
+import leitor_pdf
+from leitor_pdf import cortar_pagina, selecionar_paginas
+
+contar = lambda t: len(t) // 4 + 1
+
+
+def test_pagina_de_maior_nota_maior_que_o_orcamento_entra_cortada():
+    anamnese = "\n".join(f"Relato da mãe sobre a rotina da criança no período {n}." for n in range(80))
+    conclusao = "CONCLUSÃO: quadro compatível com TEA, CID F84.0. Em uso de risperidona 1mg à noite."
+    pagina_longa = anamnese + "\n" + conclusao
+    paginas = ["Identificação do paciente e da escola.", pagina_longa]
+    selecao = selecionar_paginas(paginas, 200, contar)
+    assert 1 in selecao
+    assert conclusao in selecao[1] and "[...]" in selecao[1]
+    assert sum(contar(t) for t in selecao.values()) <= 200
+
+
+def test_paginas_que_cabem_continuam_inteiras_e_em_ordem():
+    paginas = ["Diagnóstico: TDAH, CID F90.0.", "Sem informações relevantes.", "Recomenda-se mediação em sala."]
+    assert selecionar_paginas(paginas, 1000, contar) == dict(enumerate(paginas))
+
+
+def test_cortar_pagina_respeita_orcamento_mesmo_com_uma_linha_enorme():
+    linha = "Diagnóstico " + "muito detalhado " * 200
+    cortada = cortar_pagina(linha, 50, contar)
+    assert cortada.startswith("Diagnóstico") and cortada.endswith("[...]")
+    assert contar(cortada) <= 50
+
+
+def _pdf_em_branco(paginas):
+    from io import BytesIO
+    from pypdf import PdfWriter
+    escritor, saida = PdfWriter(), BytesIO()
+    for _ in range(paginas): escritor.add_blank_page(width=200, height=200)
+    escritor.write(saida)
+    return saida.getvalue()
+
+
+def test_pool_quebrado_nao_e_recriado(monkeypatch):
+    from concurrent.futures.process import BrokenProcessPool
+    criados = []
+
+    class PoolQuebrado:
+        def __init__(self, *args, **kwargs): criados.append(self)
+        def submit(self, *args): raise BrokenProcessPool("processo morto")
+        def shutdown(self, **kwargs): pass
+
+    monkeypatch.setattr(leitor_pdf, "PROCESSOS", 2)
+    monkeypatch.setattr(leitor_pdf, "ProcessPoolExecutor", PoolQuebrado)
+    monkeypatch.setattr(leitor_pdf, "_POOL", {})
+    pdf = _pdf_em_branco(10)
+    assert leitor_pdf.extrair_paginas(pdf) == [""] * 10
+    assert leitor_pdf.extrair_paginas(pdf) == [""] * 10
+    assert len(criados) == 1
+
+
+def test_cabecalho_com_cid_fica_uma_vez_e_paginacao_sai():
+    paginas = [f"Clínica Exemplo\nCID: F84.0\nTexto da página {n} sobre a avaliação de linguagem e atenção em sala.\nPágina {n} de 4" for n in range(1, 5)]
+    limpas = leitor_pdf.limpar_paginas(paginas)
+    assert "\n".join(limpas).count("CID: F84.0") == 1
+    assert "Clínica Exemplo" not in "\n".join(limpas) and "Página" not in "\n".join(limpas)
+    assert all(f"Texto da página {n}" in limpas[n - 1] for n in range(1, 5))
+
+
+def test_cids_diferentes_nao_se_confundem_ao_comparar_linhas():
+    paginas = ["CID F84.0\nAnamnese.", "CID F90.0\nAvaliação.", "CID F81.0\nConclusão.", "Encaminhamentos."]
+    limpas = leitor_pdf.limpar_paginas(paginas)
+    assert [l.splitlines()[0] for l in limpas[:3]] == ["CID F84.0", "CID F90.0", "CID F81.0"]
+
+
+def test_pdf_corrompido_nao_derruba_os_outros_laudos():
+    bom, truncado = _pdf_em_branco(2), _pdf_em_branco(3)[:200]
+    assert leitor_pdf.paginas_por_arquivo([bom, truncado, b"nao e pdf"]) == [["", ""], None, None]
@@ -0,0 +1,28 @@
+import json
+
+from lote_ia import ler_saida_lote, linha_lote, montar_jsonl
+
+
+def _saida(custom_id, conteudo, finish_reason="stop"):
+    return json.dumps({"custom_id": custom_id, "response": {"status_code": 200, "body": {
+        "choices": [{"message": {"content": conteudo}, "finish_reason": finish_reason}]}}})
+
+
+def test_linha_de_entrada_leva_o_corpo_do_chat():
+    corpo = {"model": "gpt-4o-mini", "messages": [{"role": "user", "content": "Ana"}]}
+    linhas = montar_jsonl([linha_lote("ana.json", corpo), linha_lote("joão.json", corpo)]).decode('utf-8').splitlines()
+    itens = [json.loads(l) for l in linhas]
+    assert [i['custom_id'] for i in itens] == ["ana.json", "joão.json"]
+    assert itens[0]['url'] == "/v1/chat/completions" and itens[0]['body'] == corpo
+
+
+def test_linhas_ruins_contam_como_falha_sem_parar_as_demais():
+    saida = "\n".join([
+        _saida("ana.json", "PEI da Ana"),
+        _saida("bia.json", "PEI cort", finish_reason="length"),
+        json.dumps({"custom_id": "caio.json", "response": None, "error": {"message": "rate limit"}}),
+        "{não é json",
+        "",
+        _saida("davi.json", "PEI do Davi"),
+    ])
+    assert ler_saida_lote(saida) == ([("ana.json", "PEI da Ana"), ("davi.json", "PEI do Davi")], 3)
@@ -0,0 +1,27 @@
+from secoes_pei import encaixar_secao, secoes_presentes
+
+PEI = """Introdução editada pelo professor.
+[METAS_SMART]
+- Curto: ler sílabas simples
+[FIM_METAS_SMART]
+[TAXONOMIA_BLOOM]
+Lembrar, Compreender
+[/TAXONOMIA_BLOOM]
+Observações finais."""
+
+
+def test_encaixe_troca_so_a_secao_e_preserva_o_resto():
+    novo = encaixar_secao(PEI, "Metas SMART", "Segue:\n[METAS_SMART]\n- Curto: ler palavras\n[FIM_METAS_SMART]\nEspero ter ajudado.")
+    assert "- Curto: ler palavras" in novo and "ler sílabas" not in novo
+    assert novo.startswith("Introdução editada pelo professor.") and novo.endswith("Observações finais.")
+    assert "Espero ter ajudado" not in novo and "Lembrar, Compreender" in novo
+
+
+def test_bloco_sem_tags_e_embrulhado():
+    novo = encaixar_secao(PEI, "Taxonomia de Bloom", "Aplicar, Analisar")
+    assert "[TAXONOMIA_BLOOM]\nAplicar, Analisar\n[/TAXONOMIA_BLOOM]" in novo
+    assert secoes_presentes(novo) == ["Metas SMART", "Taxonomia de Bloom"]
+
+
+def test_secao_apagada_pelo_professor_nao_e_encaixada():
+    assert encaixar_secao("PEI reescrito à mão, sem tags.", "Metas SMART", "[METAS_SMART]\nx\n[FIM_METAS_SMART]") is None